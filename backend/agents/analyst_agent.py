@@ -1,10 +1,17 @@
 """Analyst Agent — User stories from requirements + inception."""
 
-import json
+import os
 
+from agents.context import ContextBuilder
+from agents.fanout import fan_out, renumber
 from agents.state import PipelineState
-from services.llm_service import call_llm_json
-from services.db_service import save_artifact, log_decision
+from agents.streaming import ArtifactStreamer
+from services.llm_service import call_llm_json, call_llm_json_stream
+from services.db_service import log_decision
+from models.schemas import UserStoriesOutput
+
+# One concurrent call per inception phase (0 = all phases in one call)
+ANALYST_FANOUT = os.getenv("ANALYST_FANOUT", "1") not in ("0", "false", "False")
 
 SYSTEM_PROMPT = """You are a Business Analyst agent in a software development pipeline.
 Your job is to generate clear, testable User Stories from Requirements and Inception/MVP information.
@@ -24,12 +31,12 @@ RULES:
 - Do NOT invent features unrelated to the requirements.
 - Respond ONLY with valid JSON, no extra text."""
 
-USER_PROMPT_TEMPLATE = """Given the following project artifacts, generate user stories with acceptance criteria.
+USER_PROMPT_TEMPLATE = """Given the following project artifacts (one JSON object per line), generate user stories with acceptance criteria.
 
 ## Requirements (source of truth)
 {requirements}
 
-## Inception / MVP (scope, risks, success criteria)
+## Inception / MVP scope per phase
 {inception}
 
 Return this exact JSON structure:
@@ -59,42 +66,113 @@ Guidelines:
 - Respond ONLY with JSON."""
 
 async def run_analyst_agent(state: PipelineState) -> dict:
-    """Receive REQs + INC and generate US-001, US-002... with acceptance criteria."""
+    """Receive REQs + INC and generate US-001, US-002... with acceptance criteria.
+
+    With several inception phases, stories are generated by one concurrent
+    call per phase, scoped to that phase's requirements (see ``agents.fanout``).
+    """
     run_id = state["run_id"]
     requirements = state.get("requirements") or {}
     inception = state.get("inception") or {}
 
+    phases = _phases(inception, requirements)
+    if ANALYST_FANOUT and len(phases) > 1:
+        return await _run_phases(state, phases, requirements)
+
+    context = ContextBuilder("analyst_agent")
+    context.add("requirements", requirements)
+    context.add("inceptions", inception, items_key="inceptions")
+    sections = context.render()
+
     await log_decision(run_id, "analyst_agent", "started", {
         "input_reqs": len(requirements.get("artifacts", [])),
         "has_inception": bool(inception),
+        "context": context.report,
     })
 
+    prompt = _prompt(sections, state.get("hitl_feedback"))
+
+    # Each user story is saved and published as soon as the LLM finishes writing it
+    streamer = ArtifactStreamer(run_id, "analyst_agent", "artifacts", _to_artifact)
+    result = await call_llm_json_stream(prompt, SYSTEM_PROMPT, streamer.on_item, schema=UserStoriesOutput)
+    await streamer.finish(result, {"user_stories_generated": len(result.get("artifacts", []))})
+
+    return {"user_stories": result}
+
+
+def _prompt(sections: dict[str, str], feedback: str | None) -> str:
     prompt = USER_PROMPT_TEMPLATE.format(
-        requirements=json.dumps(requirements, indent=2, ensure_ascii=False),
-        inception=json.dumps(inception, indent=2, ensure_ascii=False),
+        requirements=sections["requirements"],
+        inception=sections["inceptions"],
     )
-
     # If there's HITL feedback from the previous gate, include it so the agent fixes issues
-    feedback = state.get("hitl_feedback")
     if feedback:
         prompt += f"\n\n## HITL Feedback (address this in your output)\n{feedback}"
+    return prompt
+
+
+def _to_artifact(us: dict) -> dict:
+    return {"id": us["id"], "type": "user_story", "content": us,
+            "parent_ids": us.get("requirement_ids", []) or []}
+
+
+def _phases(inception: dict, requirements: dict) -> list[tuple[dict, list[str]]]:
+    """Each inception with the requirement IDs it includes, every requirement in its first phase only."""
+    known = {r.get("id") for r in requirements.get("artifacts", []) if isinstance(r, dict)}
+    seen: set[str] = set()
+    phases = []
+    for inc in inception.get("inceptions", []):
+        if not isinstance(inc, dict):
+            continue
+        scope = (inc.get("mvp_scope") or {}).get("included_reqs") or inc.get("requirement_ids") or []
+        req_ids = [rid for rid in dict.fromkeys(scope) if rid in known and rid not in seen]
+        seen.update(req_ids)
+        if req_ids:
+            phases.append((inc, req_ids))
+    return phases
 
-    result = await call_llm_json(prompt, SYSTEM_PROMPT)
-
-    # Save each user story as an artifact
-    for us in result.get("artifacts", []):
-        req_ids = us.get("requirement_ids", []) or []
-        await save_artifact(
-            run_id=run_id,
-            artifact_id=us["id"],
-            agent="analyst_agent",
-            artifact_type="user_story",
-            content=us,
-            parent_ids=req_ids,
-        )
-
-    await log_decision(run_id, "analyst_agent", "completed", {
-        "user_stories_generated": len(result.get("artifacts", [])),
-    })
 
+async def _run_phases(state: PipelineState, phases: list[tuple[dict, list[str]]], requirements: dict) -> dict:
+    run_id = state["run_id"]
+    all_requirements = [r for r in requirements.get("artifacts", []) if isinstance(r, dict)]
+
+    await log_decision(run_id, "analyst_agent", "started", {
+        "input_reqs": len(all_requirements),
+        "has_inception": True,
+        "phases": {inc.get("id", "?"): req_ids for inc, req_ids in phases},
+    })
+    streamer = ArtifactStreamer(run_id, "analyst_agent", "artifacts", _to_artifact)
+
+    async def run_phase(index: int, phase: tuple[dict, list[str]]) -> list[dict]:
+        inc, req_ids = phase
+        scope = set(req_ids)
+        context = ContextBuilder("analyst_agent")
+        context.add("requirements", [r for r in all_requirements if r.get("id") in scope])
+        context.add("inceptions", [inc])
+        result = await call_llm_json(_prompt(context.render(), state.get("hitl_feedback")),
+                                     SYSTEM_PROMPT, schema=UserStoriesOutput)
+        stories = []
+        for story in result.get("artifacts", []):
+            in_scope = [rid for rid in story.get("requirement_ids", []) if rid in scope]
+            stories.append({**story, "requirement_ids": in_scope or story.get("requirement_ids", [])})
+        return stories
+
+    stories, covered, duplicates = [], set(), 0
+    for phase_stories in await fan_out(run_id, "analyst_agent", phases, run_phase):
+        phase_keys = set()
+        for story in phase_stories:
+            # A story for requirements an earlier phase already covered is a duplicate
+            key = tuple(sorted(story.get("requirement_ids", [])))
+            if key and key in covered:
+                duplicates += 1
+                continue
+            phase_keys.add(key)
+            stories.append(story)
+        covered |= phase_keys
+    renumber(stories, "US")
+
+    result = {"artifacts": stories}
+    await streamer.finish(result, {
+        "user_stories_generated": len(stories), "phases": len(phases), "duplicates_dropped": duplicates,
+    })
     return {"user_stories": result}
@@ -1,8 +1,10 @@
 """BA Agent — Requirements extraction from brief."""
 
 from agents.state import PipelineState
-from services.llm_service import call_llm_json
-from services.db_service import save_artifact, log_decision
+from agents.streaming import ArtifactStreamer
+from services.llm_service import call_llm_json_stream
+from services.db_service import log_decision
+from models.schemas import RequirementsOutput
 
 SYSTEM_PROMPT = """You are a Software Requirements Analyst (BA) agent in a SDLC pipeline.
 Your job is to extract well-formed engineering requirements from the provided brief.
@@ -69,21 +71,13 @@ Responde SOLO con JSON.
     if feedback:
         prompt += f"\n\n## Feedback del revisor (aplícalo en tu respuesta)\n{feedback}"
 
-    result = await call_llm_json(prompt, SYSTEM_PROMPT)
-
-    for item in result.get("artifacts", []):
-        await save_artifact(
-            run_id=run_id,
-            artifact_id=item["id"],
-            agent="ba_agent",
-            artifact_type="requirement",
-            content=item,
-            parent_ids=[],
-        )
-
-    await log_decision(run_id, "ba_agent", "completed", {
-        "requirements_generated": len(result.get("artifacts", [])),
-    })
+    # Each requirement is saved and published as soon as the LLM finishes writing it
+    streamer = ArtifactStreamer(
+        run_id, "ba_agent", "artifacts",
+        lambda item: {"id": item["id"], "type": "requirement", "content": item, "parent_ids": []},
+    )
+    result = await call_llm_json_stream(prompt, SYSTEM_PROMPT, streamer.on_item, schema=RequirementsOutput)
+    await streamer.finish(result, {"requirements_generated": len(result.get("artifacts", []))})
 
     return {"requirements": result}
 
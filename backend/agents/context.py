@@ -0,0 +1,125 @@
+"""Upstream artifacts rendered as compact, budgeted prompt context.
+
+Each agent only sees the fields it needs from each artifact type
+(``PROJECTIONS``), serialized as one compact JSON object per line. If the
+sections together exceed the agent's token budget (``context_tokens`` in
+``llm_models``), they are reduced deterministically: first long texts are
+shortened and string lists cut, then items are dropped from the end of the
+largest section and replaced by a line listing the omitted IDs, so the model
+can still reference them.
+"""
+
+import json
+from typing import Any
+
+from services.llm_models import selector
+from services.llm_providers import estimate_tokens
+
+# Fields each agent needs from each upstream artifact type
+PROJECTIONS: dict[str, dict[str, tuple[str, ...]]] = {
+    "product_agent": {
+        "requirements": ("id", "title", "description", "priority"),
+    },
+    "analyst_agent": {
+        "requirements": ("id", "title", "description", "type", "priority", "actors"),
+        "inceptions": ("id", "phase", "mvp_scope"),
+    },
+    "qa_agent": {
+        "user_stories": ("id", "title", "requirement_ids", "story", "acceptance_criteria"),
+        "requirements": ("id", "title"),
+    },
+    "design_agent": {
+        "requirements": ("id", "title", "description", "actors"),
+        "inceptions": ("id", "phase", "mvp_scope"),
+        "user_stories": ("id", "title", "requirement_ids", "story"),
+    },
+}
+
+SUMMARY_TEXT_CHARS = 160  # strings are cut to this length when over budget
+SUMMARY_LIST_ITEMS = 2    # and lists of strings to this many entries
+
+
+def compact(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _summarize(value: Any, key: str = "") -> Any:
+    # ID lists (``requirement_ids``, ``included_reqs``...) carry traceability and are never cut
+    if key == "id" or key.endswith(("_ids", "_reqs")):
+        return value
+    if isinstance(value, str) and len(value) > SUMMARY_TEXT_CHARS:
+        return value[:SUMMARY_TEXT_CHARS] + "…"
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return [_summarize(v) for v in value[:SUMMARY_LIST_ITEMS]]
+    if isinstance(value, dict):
+        return {k: _summarize(v, k) for k, v in value.items()}
+    return value
+
+
+class ContextBuilder:
+    """Collect upstream sections for ``agent`` and render them within its token budget.
+
+    After ``render()``, ``report`` holds the token estimate of the sections as
+    previously embedded (indented JSON of the whole document) and as rendered,
+    plus how many items were omitted per section.
+    """
+
+    def __init__(self, agent: str, budget_tokens: int | None = None):
+        self.agent = agent
+        self.budget = budget_tokens if budget_tokens is not None else selector.context_tokens(agent)
+        self.sections: dict[str, list[dict]] = {}
+        self._original_tokens = 0
+        self.report: dict = {}
+
+    def add(self, name: str, document: Any, items_key: str = "artifacts") -> "ContextBuilder":
+        """Add ``document[items_key]`` (or ``document`` itself if it is a list) projected for this agent."""
+        self._original_tokens += estimate_tokens(json.dumps(document, indent=2, ensure_ascii=False))
+        items = document if isinstance(document, list) else (document or {}).get(items_key, [])
+        fields = PROJECTIONS.get(self.agent, {}).get(name)
+        self.sections[name] = [
+            {f: item[f] for f in fields if f in item} if fields else item
+            for item in items if isinstance(item, dict)
+        ]
+        return self
+
+    def render(self) -> dict[str, str]:
+        """Serialized sections by name, reduced as needed to fit the budget."""
+        sections = {name: list(items) for name, items in self.sections.items()}
+        omitted: dict[str, list[str]] = {name: [] for name in sections}
+
+        def _render() -> dict[str, str]:
+            rendered = {}
+            for name, items in sections.items():
+                lines = [compact(item) for item in items]
+                if omitted[name]:
+                    lines.append(compact({"omitted": len(omitted[name]), "ids": omitted[name]}))
+                rendered[name] = "\n".join(lines)
+            return rendered
+
+        def _tokens(rendered: dict[str, str]) -> int:
+            return sum(estimate_tokens(text) for text in rendered.values())
+
+        rendered = _render()
+        summarized = False
+        if _tokens(rendered) > self.budget:
+            sections = {name: [_summarize(item) for item in items] for name, items in sections.items()}
+            summarized = True
+            rendered = _render()
+        while _tokens(rendered) > self.budget:
+            # Largest section first; ties broken by name so the result is reproducible
+            name = max((n for n in sections if sections[n]),
+                       key=lambda n: (estimate_tokens(rendered[n]), n), default=None)
+            if name is None:
+                break
+            dropped = sections[name].pop()
+            omitted[name].insert(0, str(dropped.get("id", "?")))
+            rendered = _render()
+
+        self.report = {
+            "budget_tokens": self.budget,
+            "tokens_before": self._original_tokens,
+            "tokens_after": _tokens(rendered),
+            "summarized": summarized,
+            "omitted": {name: len(ids) for name, ids in omitted.items() if ids},
+        }
+        return rendered
@@ -1,25 +1,26 @@
 """Design Agent — ER and Sequence diagrams in Mermaid."""
 
-import json
-
+from agents.context import ContextBuilder
+from agents.fanout import fan_out
 from agents.state import PipelineState
-from services.llm_service import call_llm_json
-from services.db_service import save_artifact, log_decision
+from agents.streaming import ArtifactStreamer
+from services.llm_service import LLMJSONError, call_llm_json
+from services.db_service import log_decision
+from models.schemas import DiagramData
 
 SYSTEM_PROMPT = """You are a Software Design agent in a software development pipeline.
-Your job is to generate two diagrams from the project artifacts:
-1. An ER (Entity-Relationship) diagram
-2. A Sequence diagram
+Your job is to generate one diagram from the project artifacts, using Mermaid.js.
 
 RULES:
 - Use valid Mermaid.js syntax.
-- The ER diagram must model the domain entities derived from the requirements.
-- The Sequence diagram must illustrate the main user flow from the user stories.
-- Reference the requirement and story IDs that each diagram covers.
+- Reference the requirement and story IDs that the diagram covers.
 - ALL text content (descriptions, entity names, labels) MUST be written in Spanish.
 - Respond ONLY with valid JSON, no extra text."""
 
-USER_PROMPT_TEMPLATE = """Given the following software artifacts, generate an ER diagram and a Sequence diagram using Mermaid.js syntax.
+ER_PROMPT_TEMPLATE = """Given the following software artifacts (one JSON object per line), generate an ER (Entity-Relationship) diagram using Mermaid.js syntax. It must model the domain entities derived from the requirements.
+
+## Domain
+{domain_summary}
 
 ## Requirements
 {requirements}
@@ -27,86 +28,111 @@ USER_PROMPT_TEMPLATE = """Given the following software artifacts, generate an ER
 ## Inception / MVP
 {inception}
 
+Respond with this exact JSON structure:
+{{
+  "mermaid_code": "erDiagram\\n    ENTITY1 ||--o{{ ENTITY2 : has\\n    ...",
+  "referenced_reqs": ["REQ-001", "REQ-002"],
+  "referenced_stories": [],
+  "description": "Descripcion breve de lo que representa el diagrama ER"
+}}
+
+IMPORTANT: Use valid Mermaid.js syntax. Escape newlines as \\n in mermaid_code. Respond ONLY with JSON."""
+
+SEQUENCE_PROMPT_TEMPLATE = """Given the following software artifacts (one JSON object per line), generate a Sequence diagram using Mermaid.js syntax. It must illustrate the main user flow from the user stories.
+
+## Domain
+{domain_summary}
+
 ## User Stories
 {user_stories}
 
-## Test Cases
-{test_cases}
-
 Respond with this exact JSON structure:
 {{
-  "er_diagram": {{
-    "mermaid_code": "erDiagram\\n    ENTITY1 ||--o{{ ENTITY2 : has\\n    ...",
-    "referenced_reqs": ["REQ-001", "REQ-002"],
-    "referenced_stories": [],
-    "description": "Descripcion breve de lo que representa el diagrama ER"
-  }},
-  "sequence_diagram": {{
-    "mermaid_code": "sequenceDiagram\\n    actor Usuario\\n    Usuario->>Sistema: accion\\n    ...",
-    "referenced_reqs": [],
-    "referenced_stories": ["US-001", "US-002"],
-    "description": "Descripcion breve de lo que representa el diagrama de secuencia"
-  }}
+  "mermaid_code": "sequenceDiagram\\n    actor Usuario\\n    Usuario->>Sistema: accion\\n    ...",
+  "referenced_reqs": [],
+  "referenced_stories": ["US-001", "US-002"],
+  "description": "Descripcion breve de lo que representa el diagrama de secuencia"
 }}
 
-IMPORTANT: Use valid Mermaid.js syntax. Escape newlines as \\n in the mermaid_code strings. Respond ONLY with JSON."""
+IMPORTANT: Use valid Mermaid.js syntax. Escape newlines as \\n in mermaid_code. Respond ONLY with JSON."""
+
+# (result key, artifact ID, artifact type) of each diagram
+DIAGRAMS = (
+    ("er_diagram", "DIAG-ER", "diagram_er"),
+    ("sequence_diagram", "DIAG-SEQ", "diagram_sequence"),
+)
 
 
 async def run_design_agent(state: PipelineState) -> dict:
-    """Receive all artifacts and generate ER + sequence diagrams as Mermaid code."""
+    """Receive requirements, inceptions and user stories and generate ER + sequence diagrams as Mermaid code.
+
+    Test cases are not an input, so the stage runs in parallel with qa. The two diagrams are independent concurrent calls, each saved as soon as
+    it is ready and retried on its own if it fails.
+    """
     run_id = state["run_id"]
     requirements = state.get("requirements") or {}
     inception = state.get("inception") or {}
     user_stories = state.get("user_stories") or {}
-    test_cases = state.get("test_cases") or {}
+    domain_summary = requirements.get("domain_summary", "")
+
+    er_context = ContextBuilder("design_agent")
+    er_context.add("requirements", requirements)
+    er_context.add("inceptions", inception, items_key="inceptions")
+    er_sections = er_context.render()
+
+    seq_context = ContextBuilder("design_agent")
+    seq_context.add("user_stories", user_stories)
+    seq_sections = seq_context.render()
 
     await log_decision(run_id, "design_agent", "started", {
         "input_reqs": len(requirements.get("artifacts", [])),
         "input_stories": len(user_stories.get("artifacts", [])),
+        "context": {"er_diagram": er_context.report, "sequence_diagram": seq_context.report},
     })
 
-    prompt = USER_PROMPT_TEMPLATE.format(
-        requirements=json.dumps(requirements, indent=2, ensure_ascii=False),
-        inception=json.dumps(inception, indent=2, ensure_ascii=False),
-        user_stories=json.dumps(user_stories, indent=2, ensure_ascii=False),
-        test_cases=json.dumps(test_cases, indent=2, ensure_ascii=False),
-    )
-
+    prompts = {
+        "er_diagram": ER_PROMPT_TEMPLATE.format(
+            domain_summary=domain_summary,
+            requirements=er_sections["requirements"],
+            inception=er_sections["inceptions"],
+        ),
+        "sequence_diagram": SEQUENCE_PROMPT_TEMPLATE.format(
+            domain_summary=domain_summary,
+            user_stories=seq_sections["user_stories"],
+        ),
+    }
     feedback = state.get("hitl_feedback")
     if feedback:
-        prompt += f"\n\n## HITL Feedback (address this in your output)\n{feedback}"
-
-    result = await call_llm_json(prompt, SYSTEM_PROMPT)
-
-    # Save ER diagram
-    er = result.get("er_diagram", {})
-    if er:
-        parent_ids = er.get("referenced_reqs", []) + er.get("referenced_stories", [])
-        await save_artifact(
-            run_id=run_id,
-            artifact_id="DIAG-ER",
-            agent="design_agent",
-            artifact_type="diagram_er",
-            content=er,
-            parent_ids=parent_ids,
-        )
-
-    # Save Sequence diagram
-    seq = result.get("sequence_diagram", {})
-    if seq:
-        parent_ids = seq.get("referenced_reqs", []) + seq.get("referenced_stories", [])
-        await save_artifact(
-            run_id=run_id,
-            artifact_id="DIAG-SEQ",
-            agent="design_agent",
-            artifact_type="diagram_sequence",
-            content=seq,
-            parent_ids=parent_ids,
-        )
-
-    await log_decision(run_id, "design_agent", "completed", {
-        "has_er": bool(er),
-        "has_sequence": bool(seq),
+        prompts = {key: prompt + f"\n\n## HITL Feedback (address this in your output)\n{feedback}"
+                   for key, prompt in prompts.items()}
+
+    # Each diagram is saved and published as soon as its own call finishes
+    streamer = ArtifactStreamer(run_id, "design_agent", "diagrams", lambda artifact: artifact)
+
+    attempts: dict[str, int] = {}
+
+    async def generate(index: int, spec: tuple[str, str, str]) -> dict:
+        key, artifact_id, artifact_type = spec
+        attempts[key] = attempts.get(key, 0) + 1
+        # A retry must not be answered with the cached response that failed the check below
+        diagram = await call_llm_json(prompts[key], SYSTEM_PROMPT, use_cache=attempts[key] == 1, schema=DiagramData)
+        if not diagram.get("mermaid_code", "").strip():
+            raise LLMJSONError(f"{key} has no mermaid_code")
+        artifact = {
+            "id": artifact_id,
+            "type": artifact_type,
+            "content": diagram,
+            "parent_ids": diagram.get("referenced_reqs", []) + diagram.get("referenced_stories", []),
+        }
+        await streamer.on_item("diagrams", artifact)
+        return artifact
+
+    artifacts = await fan_out(run_id, "design_agent", DIAGRAMS, generate)
+    result = {key: artifact["content"] for (key, _, _), artifact in zip(DIAGRAMS, artifacts)}
+
+    await streamer.finish({"diagrams": artifacts}, {
+        "has_er": bool(result["er_diagram"]),
+        "has_sequence": bool(result["sequence_diagram"]),
     })
 
     return {"diagrams": result}
@@ -0,0 +1,71 @@
+"""Map-reduce over concurrent LLM calls for agents with large inputs.
+
+An agent splits its input into batches, ``fan_out`` runs one call per batch
+with at most ``FANOUT_MAX_PARALLEL`` in flight, retrying a failed batch on
+its own up to ``FANOUT_RETRIES`` times, and the agent merges the results in
+batch order with ``renumber``. The stage then takes about as long as its
+slowest batch instead of one call for everything.
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Sequence, TypeVar
+
+from services.db_service import log_decision
+
+FANOUT_MAX_PARALLEL = int(os.getenv("FANOUT_MAX_PARALLEL", "4"))
+FANOUT_RETRIES = int(os.getenv("FANOUT_RETRIES", "1"))
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def batched(items: Sequence[T], size: int) -> list[list[T]]:
+    """``items`` in consecutive batches of ``size`` (one batch if ``size`` < 1)."""
+    if size < 1:
+        return [list(items)]
+    return [list(items[i:i + size]) for i in range(0, len(items), size)]
+
+
+async def fan_out(
+    run_id: str,
+    agent: str,
+    batches: Sequence[T],
+    run_batch: Callable[[int, T], Awaitable[R]],
+    max_parallel: int = FANOUT_MAX_PARALLEL,
+    retries: int = FANOUT_RETRIES,
+) -> list[R]:
+    """Await ``run_batch(index, batch)`` for every batch concurrently; results are in batch order.
+
+    Each retry is logged as ``batch_retry``. If a batch still fails, the
+    others are cancelled and its error is raised.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_parallel))
+
+    async def _run(index: int, batch: T) -> R:
+        async with semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    return await run_batch(index, batch)
+                except Exception as e:
+                    if attempt == retries:
+                        raise
+                    await log_decision(run_id, agent, "batch_retry", {
+                        "batch": index, "attempt": attempt + 1, "error": str(e)[:300],
+                    })
+
+    tasks = [asyncio.create_task(_run(index, batch)) for index, batch in enumerate(batches)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def renumber(items: list[dict], prefix: str) -> None:
+    """Give ``items`` consecutive ``<prefix>-001``, ``<prefix>-002``... IDs in order.
+
+    Each batch numbers its items from 001, so IDs only become unique here.
+    """
+    for n, item in enumerate(items, 1):
+        item["id"] = f"{prefix}-{n:03d}"
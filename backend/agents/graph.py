@@ -1,8 +1,30 @@
-"""LangGraph pipeline — wires all agents + HITL gates."""
-
-import asyncio
-
+"""LangGraph pipeline — wires all agents + HITL gates.
+
+With a checkpointer open (``open_checkpointer()``, called from the FastAPI
+lifespan) every step is persisted in the SQLite file and HITL gates are
+LangGraph interrupts: a run waiting for review holds no coroutine, and
+``advance_run()`` continues it from its checkpoint once the gate is resolved.
+The API does not drive runs itself: it queues them in
+``services.run_scheduler``, whose slots call ``advance_run()``. Without a
+checkpointer (plain scripts) the pipeline waits in-process.
+
+Stages declare the state fields they read (``STAGE_INPUTS``). After the
+analyst gate, every remaining stage whose inputs are all approved runs as a
+parallel branch (qa and design), and the branches join before the final
+gate. With ``SPECULATIVE_STAGES`` the stages after a gate start while it is
+pending (see ``services.speculation``).
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import START, END, StateGraph
+from langgraph.types import Command, interrupt
+
+import database
 
 from agents.state import PipelineState
 from agents.ba_agent import run_ba_agent
@@ -13,85 +35,207 @@ from agents.design_agent import run_design_agent
 from services.db_service import (
     create_hitl_gate,
     get_hitl_gate_by_id,
+    get_run,
+    list_resumable_runs,
     update_run_stage,
     log_decision,
 )
-
-HITL_POLL_INTERVAL = 2  # seconds
+from services.hitl_waiters import waiters
+from services.llm_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, llm_priority
+from services.llm_models import llm_agent
+from services.run_scheduler import scheduler
+from services.speculation import speculator
+from services.stage_metrics import stage_metrics
+
+logger = logging.getLogger(__name__)
+
+# State fields each agent stage reads, and the field it writes
+STAGE_INPUTS: dict[str, tuple[str, ...]] = {
+    "ba": ("brief",),
+    "product": ("requirements",),
+    "analyst": ("requirements", "inception"),
+    "qa": ("requirements", "user_stories"),
+    "design": ("requirements", "inception", "user_stories"),
+}
+STAGE_OUTPUTS: dict[str, str] = {
+    "ba": "requirements",
+    "product": "inception",
+    "analyst": "user_stories",
+    "qa": "test_cases",
+    "design": "diagrams",
+}
+# Stages reviewed at their own gate, in order
+GATED_STAGES = ("ba", "product", "analyst")
+
+
+def _parallel_branches() -> list[str]:
+    """Stages after the gated ones, all runnable once their outputs are approved."""
+    available = {"brief"} | {STAGE_OUTPUTS[stage] for stage in GATED_STAGES}
+    branches = [stage for stage in STAGE_INPUTS if stage not in GATED_STAGES]
+    missing = {stage: set(STAGE_INPUTS[stage]) - available for stage in branches}
+    if any(missing.values()):
+        raise ValueError(f"stages depend on non-gated outputs: {missing}")
+    return branches
+
+
+FINAL_BRANCHES = [f"{stage}_node" for stage in _parallel_branches()]
+# Stages that start once each gate is approved, and may run speculatively while it is pending
+NEXT_STAGES: dict[str, list[str]] = {
+    **{stage: [after] for stage, after in zip(GATED_STAGES, GATED_STAGES[1:])},
+    GATED_STAGES[-1]: _parallel_branches(),
+}
 
 
 # ---------------------------------------------------------------------------
-# Helper: poll a HITL gate until resolved
+# Helper: wait for a HITL gate to be resolved
 # ---------------------------------------------------------------------------
-async def _poll_hitl(gate_id: int) -> dict:
-    """Block until a HITL gate is resolved, then return it."""
-    while True:
-        gate = await get_hitl_gate_by_id(gate_id)
-        if gate and gate["status"] != "pending":
-            return gate
-        await asyncio.sleep(HITL_POLL_INTERVAL)
+async def _wait_hitl(gate_id: int) -> dict:
+    """Block until a HITL gate is resolved, then return it.
+
+    Woken by resolve_hitl(); the registry re-reads the gate on a slow
+    fallback interval in case a notification is missed.
+    """
+    return await waiters.wait(gate_id, lambda: get_hitl_gate_by_id(gate_id))
 
 
 # ---------------------------------------------------------------------------
-# Generic HITL node
+# Generic HITL nodes
 # ---------------------------------------------------------------------------
-async def _hitl_node(state: PipelineState, stage: str) -> dict:
-    """Create a HITL gate, wait for resolution, return result."""
+# A gate is two nodes: the "open" node creates the DB row and records its id
+# in the state; the wait node pauses on it. LangGraph re-executes an
+# interrupted node from the top on resume, so the split keeps gate creation
+# from running twice.
+async def _open_hitl_node(state: PipelineState, stage: str) -> dict:
+    """Create a HITL gate and mark the run as waiting for review."""
     run_id = state["run_id"]
     gate_id = await create_hitl_gate(run_id, stage)
     await update_run_stage(run_id, "waiting_hitl", f"hitl_{stage}")
     await log_decision(run_id, "pipeline", "hitl_gate_created", {"stage": stage})
+    for next_stage in NEXT_STAGES.get(stage, ()):
+        await _speculate(state, next_stage)
+    return {"hitl_gate_id": gate_id}
 
-    resolution = await _poll_hitl(gate_id)
+
+async def _hitl_node(state: PipelineState, stage: str) -> dict:
+    """Wait for the open gate to be resolved, return result."""
+    run_id = state["run_id"]
+    gate_id = state["hitl_gate_id"]
+
+    resolution = await get_hitl_gate_by_id(gate_id)
+    if resolution["status"] == "pending":
+        if _checkpointer is not None:
+            # Park the run: state is checkpointed and the coroutine ends here.
+            # resume_pipeline() re-enters this node after the gate is resolved.
+            interrupt({"gate_id": gate_id, "stage": stage})
+            resolution = await get_hitl_gate_by_id(gate_id)
+        if resolution["status"] == "pending":
+            resolution = await _wait_hitl(gate_id)
 
     await log_decision(run_id, "pipeline", "hitl_resolved", {
         "stage": stage,
         "status": resolution["status"],
         "feedback": resolution.get("feedback"),
     })
+    if resolution["status"] != "approved":
+        for next_stage in NEXT_STAGES.get(stage, ()):
+            await speculator.discard(run_id, next_stage, resolution["status"])
 
     return {
         "hitl_status": resolution["status"],
         "hitl_feedback": resolution.get("feedback"),
+        "hitl_gate_id": None,
     }
 
 
 # ---------------------------------------------------------------------------
 # Agent nodes
 # ---------------------------------------------------------------------------
+def _llm_lane(state: PipelineState) -> int:
+    """Re-runs requested at a HITL gate have a reviewer waiting: serve them first."""
+    return PRIORITY_INTERACTIVE if state.get("hitl_status") == "changes" else PRIORITY_BATCH
+
+
+@contextmanager
+def _llm_scope(state: PipelineState, agent: str) -> Iterator[None]:
+    """Lane, model selection and usage attribution for an agent's LLM calls."""
+    with llm_priority(_llm_lane(state)), llm_agent(agent, state["run_id"]):
+        yield
+
+
+# Agent of each stage, looked up at call time so the module-level functions can be patched
+_AGENTS = {
+    "ba": lambda state: run_ba_agent(state),
+    "product": lambda state: run_product_agent(state),
+    "analyst": lambda state: run_analyst_agent(state),
+    "qa": lambda state: run_qa_agent(state),
+    "design": lambda state: run_design_agent(state),
+}
+
+
+async def _run_agent(state: PipelineState, stage: str) -> dict:
+    """Output of ``stage``'s agent, committed from a speculative run started at the previous gate if there is one."""
+    result = await speculator.claim(state["run_id"], stage)
+    if result is None:
+        with _llm_scope(state, f"{stage}_agent"):
+            result = await _AGENTS[stage](state)
+    return result
+
+
+async def _speculate(state: PipelineState, stage: str) -> None:
+    """Start ``stage``'s agent in the background on the artifacts awaiting review."""
+    async def work() -> dict:
+        # Lowest lane: real work and reviewers' re-runs go first
+        with llm_priority(PRIORITY_BATCH), llm_agent(f"{stage}_agent", state["run_id"]):
+            return await _AGENTS[stage](state)
+
+    await speculator.start(state["run_id"], stage, work)
+
+
+def _timing(stage: str, started: float) -> dict:
+    """``stage_timings`` update for a stage that began at ``started`` (epoch seconds) and ends now."""
+    seconds = time.time() - started
+    stage_metrics.record_duration(stage, seconds)
+    return {stage: {"started": started, "seconds": round(seconds, 3)}}
+
+
 async def ba_node(state: PipelineState) -> dict:
+    started = time.time()
     await update_run_stage(state["run_id"], "running", "ba")
-    result = await run_ba_agent(state)
+    result = await _run_agent(state, "ba")
     return {"requirements": result["requirements"], "current_stage": "ba",
-            "hitl_status": None, "hitl_feedback": None}
+            "hitl_status": None, "hitl_feedback": None, "stage_timings": _timing("ba", started)}
 
 
 async def product_node(state: PipelineState) -> dict:
+    started = time.time()
     await update_run_stage(state["run_id"], "running", "product")
-    result = await run_product_agent(state)
+    result = await _run_agent(state, "product")
     return {"inception": result["inception"], "current_stage": "product",
-            "hitl_status": None, "hitl_feedback": None}
+            "hitl_status": None, "hitl_feedback": None, "stage_timings": _timing("product", started)}
 
 
 async def analyst_node(state: PipelineState) -> dict:
+    started = time.time()
     await update_run_stage(state["run_id"], "running", "analyst")
-    result = await run_analyst_agent(state)
+    result = await _run_agent(state, "analyst")
     return {"user_stories": result["user_stories"], "current_stage": "analyst",
-            "hitl_status": None, "hitl_feedback": None}
+            "hitl_status": None, "hitl_feedback": None, "stage_timings": _timing("analyst", started)}
 
 
 async def qa_node(state: PipelineState) -> dict:
+    started = time.time()
     await update_run_stage(state["run_id"], "running", "qa")
-    result = await run_qa_agent(state)
+    result = await _run_agent(state, "qa")
     return {"test_cases": result["test_cases"], "current_stage": "qa",
-            "hitl_status": None, "hitl_feedback": None}
+            "hitl_status": None, "hitl_feedback": None, "stage_timings": _timing("qa", started)}
 
 
 async def design_node(state: PipelineState) -> dict:
+    started = time.time()
     await update_run_stage(state["run_id"], "running", "design")
-    result = await run_design_agent(state)
+    result = await _run_agent(state, "design")
     return {"diagrams": result["diagrams"], "current_stage": "design",
-            "hitl_status": None, "hitl_feedback": None}
+            "hitl_status": None, "hitl_feedback": None, "stage_timings": _timing("design", started)}
 
 
 async def done_node(state: PipelineState) -> dict:
@@ -112,6 +256,34 @@ async def rejected_node(state: PipelineState) -> dict:
 # ---------------------------------------------------------------------------
 # HITL gate nodes
 # ---------------------------------------------------------------------------
+async def open_hitl_ba(state: PipelineState) -> dict:
+    return await _open_hitl_node(state, "ba")
+
+
+async def open_hitl_product(state: PipelineState) -> dict:
+    return await _open_hitl_node(state, "product")
+
+
+async def open_hitl_analyst(state: PipelineState) -> dict:
+    return await _open_hitl_node(state, "analyst")
+
+
+async def open_hitl_final(state: PipelineState) -> dict:
+    """Join of the parallel branches: record the time they saved, then open the final gate."""
+    timings = [(state.get("stage_timings") or {}).get(node.removesuffix("_node")) for node in FINAL_BRANCHES]
+    if all(timings):
+        wall = max(t["started"] + t["seconds"] for t in timings) - min(t["started"] for t in timings)
+        sequential = sum(t["seconds"] for t in timings)
+        stage_metrics.record_parallel_saving(max(0.0, sequential - wall))
+        await log_decision(state["run_id"], "pipeline", "parallel_stages", {
+            "stages": {node.removesuffix("_node"): t["seconds"] for node, t in zip(FINAL_BRANCHES, timings)},
+            "wall_s": round(wall, 3),
+            "sequential_s": round(sequential, 3),
+            "saved_s": round(max(0.0, sequential - wall), 3),
+        })
+    return await _open_hitl_node(state, "final")
+
+
 async def hitl_ba(state: PipelineState) -> dict:
     return await _hitl_node(state, "ba")
 
@@ -131,12 +303,14 @@ async def hitl_final(state: PipelineState) -> dict:
 # ---------------------------------------------------------------------------
 # Routing after each HITL gate
 # ---------------------------------------------------------------------------
-def _route(state: PipelineState, next_node: str, retry_node: str) -> str:
+def _route(state: PipelineState, next_node: str | list[str], retry_node: str | list[str]) -> str | list[str]:
     status = state.get("hitl_status")
     if status == "approved":
         return next_node
     if status == "rejected":
         return "rejected_node"  # stop the pipeline
+    if status == "cancelled":
+        return END  # cancel_run() already marked the run
     return retry_node  # "changes" -> re-run agent with feedback
 
 
@@ -148,72 +322,173 @@ def route_after_hitl_product(state: PipelineState) -> str:
     return _route(state, "analyst_node", "product_node")
 
 
-def route_after_hitl_analyst(state: PipelineState) -> str:
-    return _route(state, "qa_node", "analyst_node")
+def route_after_hitl_analyst(state: PipelineState) -> str | list[str]:
+    return _route(state, FINAL_BRANCHES, "analyst_node")
 
 
-def route_after_hitl_final(state: PipelineState) -> str:
-    return _route(state, "done_node", "qa_node")
+def route_after_hitl_final(state: PipelineState) -> str | list[str]:
+    return _route(state, "done_node", FINAL_BRANCHES)  # changes re-run every branch
 
 
 # ---------------------------------------------------------------------------
 # Build & compile the graph
 # ---------------------------------------------------------------------------
-def build_pipeline():
+def build_pipeline(checkpointer=None):
     graph = StateGraph(PipelineState)
 
     # Nodes
     graph.add_node("ba_node", ba_node)
+    graph.add_node("open_hitl_ba", open_hitl_ba)
     graph.add_node("hitl_ba", hitl_ba)
     graph.add_node("product_node", product_node)
+    graph.add_node("open_hitl_product", open_hitl_product)
     graph.add_node("hitl_product", hitl_product)
     graph.add_node("analyst_node", analyst_node)
+    graph.add_node("open_hitl_analyst", open_hitl_analyst)
     graph.add_node("hitl_analyst", hitl_analyst)
     graph.add_node("qa_node", qa_node)
     graph.add_node("design_node", design_node)
+    graph.add_node("open_hitl_final", open_hitl_final)
     graph.add_node("hitl_final", hitl_final)
     graph.add_node("done_node", done_node)
     graph.add_node("rejected_node", rejected_node)
 
-    # Edges: BA -> HITL -> Product -> HITL -> Analyst -> HITL -> QA -> Design -> HITL -> Done
+    # Edges: BA -> HITL -> Product -> HITL -> Analyst -> HITL -> (QA | Design) -> HITL -> Done
     graph.add_edge(START, "ba_node")
-    graph.add_edge("ba_node", "hitl_ba")
+    graph.add_edge("ba_node", "open_hitl_ba")
+    graph.add_edge("open_hitl_ba", "hitl_ba")
     graph.add_conditional_edges("hitl_ba", route_after_hitl_ba, {
         "product_node": "product_node",
         "ba_node": "ba_node",
         "rejected_node": "rejected_node",
+        END: END,
     })
-    graph.add_edge("product_node", "hitl_product")
+    graph.add_edge("product_node", "open_hitl_product")
+    graph.add_edge("open_hitl_product", "hitl_product")
     graph.add_conditional_edges("hitl_product", route_after_hitl_product, {
         "analyst_node": "analyst_node",
         "product_node": "product_node",
         "rejected_node": "rejected_node",
+        END: END,
     })
-    graph.add_edge("analyst_node", "hitl_analyst")
-    graph.add_conditional_edges("hitl_analyst", route_after_hitl_analyst, {
-        "qa_node": "qa_node",
-        "analyst_node": "analyst_node",
-        "rejected_node": "rejected_node",
-    })
-    graph.add_edge("qa_node", "design_node")
-    graph.add_edge("design_node", "hitl_final")
-    graph.add_conditional_edges("hitl_final", route_after_hitl_final, {
-        "done_node": "done_node",
-        "qa_node": "qa_node",
-        "rejected_node": "rejected_node",
-    })
+    graph.add_edge("analyst_node", "open_hitl_analyst")
+    graph.add_edge("open_hitl_analyst", "hitl_analyst")
+    graph.add_conditional_edges("hitl_analyst", route_after_hitl_analyst,
+                                [*FINAL_BRANCHES, "analyst_node", "rejected_node", END])
+    # The final gate opens once every branch has finished
+    graph.add_edge(FINAL_BRANCHES, "open_hitl_final")
+    graph.add_edge("open_hitl_final", "hitl_final")
+    graph.add_conditional_edges("hitl_final", route_after_hitl_final,
+                                [*FINAL_BRANCHES, "done_node", "rejected_node", END])
     graph.add_edge("done_node", END)
     graph.add_edge("rejected_node", END)
 
-    return graph.compile()
+    return graph.compile(checkpointer=checkpointer)
 
 
-# Compile once at import time
+# Compiled at import time without persistence; open_checkpointer() recompiles it
 _pipeline = build_pipeline()
+_checkpointer: AsyncSqliteSaver | None = None
+_checkpoint_db = None
+# Runs whose graph is executing in this process (guards against double resumes)
+_active_runs: set[str] = set()
+
+
+def _config(run_id: str) -> dict:
+    return {"configurable": {"thread_id": run_id}}
+
+
+async def open_checkpointer() -> None:
+    """Persist pipeline checkpoints in the app's SQLite file (lifespan startup)."""
+    global _pipeline, _checkpointer, _checkpoint_db
+    await close_checkpointer()
+    _checkpoint_db = await database.get_db()
+    _checkpoint_db.row_factory = None
+    _checkpointer = AsyncSqliteSaver(_checkpoint_db)
+    await _checkpointer.setup()
+    _pipeline = build_pipeline(_checkpointer)
+
+
+async def close_checkpointer() -> None:
+    global _pipeline, _checkpointer, _checkpoint_db
+    if _checkpoint_db is not None:
+        # LangGraph may still be flushing a checkpoint write from a background
+        # task; closing mid-write would leave a zombie connection holding the
+        # SQLite write lock, so wait for the saver's lock first
+        async with _checkpointer.lock:
+            await _checkpoint_db.close()
+    _checkpointer = None
+    _checkpoint_db = None
+    _pipeline = build_pipeline()
+
+
+async def _drive(run_id: str, graph_input) -> None:
+    """Run the graph for ``run_id`` until it finishes or parks at a HITL gate."""
+    if run_id in _active_runs:
+        return
+    _active_runs.add(run_id)
+    try:
+        await _pipeline.ainvoke(graph_input, _config(run_id))
+    except Exception as e:
+        await update_run_stage(run_id, "error", "error")
+        await log_decision(run_id, "pipeline", "pipeline_error", {"error": str(e)})
+    finally:
+        _active_runs.discard(run_id)
+
+
+async def resume_pipeline(run_id: str) -> None:
+    """Continue a run parked at a HITL gate once the gate is resolved."""
+    if _checkpointer is None:
+        return  # no checkpoints: the in-process waiter was already notified
+    snapshot = await _pipeline.aget_state(_config(run_id))
+    if not snapshot.next:
+        return  # unknown run or nothing left to do
+    await _drive(run_id, Command(resume=True))
+
+
+async def advance_run(run_id: str) -> None:
+    """Take a run as far as it can go. Called by the run scheduler in one of its slots.
+
+    Runs that never started are launched, runs that were mid-stage continue
+    from their last checkpoint and runs whose gate was resolved move past it.
+    """
+    run = await get_run(run_id)
+    if run is None:
+        return
+    if _checkpointer is None:
+        if run["current_stage"] == "pending":
+            await run_pipeline(run_id, run["brief"])
+        return  # otherwise the in-process waiter drives the run
+    snapshot = await _pipeline.aget_state(_config(run_id))
+    if snapshot.next:
+        interrupted = any(task.interrupts for task in snapshot.tasks)
+        await _drive(run_id, Command(resume=True) if interrupted else None)
+    elif not snapshot.values:
+        await run_pipeline(run_id, run["brief"])
+
+
+async def resume_interrupted_runs() -> int:
+    """Queue the runs left unfinished by a previous process (lifespan startup).
+
+    Covers runs that were mid-stage, runs whose gate was resolved while the
+    server was down and runs that never started. Returns the number queued.
+    """
+    if _checkpointer is None:
+        return 0
+    scheduled = 0
+    for run in await list_resumable_runs():
+        snapshot = await _pipeline.aget_state(_config(run["id"]))
+        if snapshot.values and not snapshot.next:
+            continue  # finished
+        if await scheduler.enqueue(run["id"]):
+            scheduled += 1
+    if scheduled:
+        logger.info("Resuming %d unfinished pipeline runs", scheduled)
+    return scheduled
 
 
 async def run_pipeline(run_id: str, brief: str) -> None:
-    """Run the full pipeline. Launched as a background task by the API."""
+    """Run the full pipeline from the brief."""
     initial_state: PipelineState = {
         "run_id": run_id,
         "brief": brief,
@@ -225,12 +500,10 @@ async def run_pipeline(run_id: str, brief: str) -> None:
         "diagrams": None,
         "hitl_status": None,
         "hitl_feedback": None,
+        "hitl_gate_id": None,
+        "stage_timings": {},
         "error": None,
         "retry_count": 0,
     }
 
-    try:
-        await _pipeline.ainvoke(initial_state)
-    except Exception as e:
-        await update_run_stage(run_id, "error", "error")
-        await log_decision(run_id, "pipeline", "pipeline_error", {"error": str(e)})
+    await _drive(run_id, initial_state)
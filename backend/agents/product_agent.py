@@ -2,9 +2,12 @@
 
 import json
 
+from agents.context import ContextBuilder
 from agents.state import PipelineState
-from services.llm_service import call_llm_json
-from services.db_service import save_artifact, log_decision
+from agents.streaming import ArtifactStreamer
+from services.llm_service import call_llm_json_stream
+from services.db_service import log_decision
+from models.schemas import InceptionsOutput
 
 
 SYSTEM_PROMPT = """You are a Product Manager agent in a software development pipeline.
@@ -93,11 +96,14 @@ async def run_product_agent(state: PipelineState) -> dict:
     run_id = state["run_id"]
     requirements = state.get("requirements") or {}
 
+    context = ContextBuilder("product_agent").add("requirements", requirements)
+    sections = context.render()
+
     await log_decision(
         run_id,
         "product_agent",
         "started",
-        {"input_reqs": len(requirements.get("artifacts", []))}
+        {"input_reqs": len(requirements.get("artifacts", [])), "context": context.report}
     )
 
     # Pre-classify requirements by priority so the prompt is explicit
@@ -109,8 +115,8 @@ async def run_product_agent(state: PipelineState) -> dict:
     prompt = f"""
 Generate 3 Inception documents (INC-001, INC-002, INC-003) based on the following requirements.
 
-Requirements (JSON):
-{json.dumps(requirements, indent=2, ensure_ascii=False)}
+Requirements (one JSON object per line):
+{sections["requirements"]}
 
 MANDATORY ASSIGNMENT — do NOT deviate from this:
 - INC-001 (MVP / Piloto)   → included_reqs MUST be exactly: {json.dumps(high_ids)}
@@ -134,36 +140,23 @@ Instructions:
 {feedback}
 """
 
-    result = await call_llm_json(prompt, SYSTEM_PROMPT)
+    # Each inception document is saved and published as soon as the LLM finishes writing it
+    streamer = ArtifactStreamer(
+        run_id, "product_agent", "inceptions",
+        lambda inc: {"id": inc.get("id", "INC-???"), "type": "inception", "content": inc,
+                     "parent_ids": inc.get("requirement_ids") or []},
+    )
+    result = await call_llm_json_stream(prompt, SYSTEM_PROMPT, streamer.on_item, schema=InceptionsOutput)
 
-    # Save each inception document as a separate artifact
     inceptions = result.get("inceptions", [])
-    total_included = 0
-    total_risks = 0
-
-    for inc in inceptions:
-        req_ids = inc.get("requirement_ids") or []
-        await save_artifact(
-            run_id=run_id,
-            artifact_id=inc.get("id", "INC-???"),
-            agent="product_agent",
-            artifact_type="inception",
-            content=inc,
-            parent_ids=req_ids,
-        )
-        total_included += len(inc.get("mvp_scope", {}).get("included_reqs", []))
-        total_risks += len(inc.get("risks", []))
-
-    await log_decision(
-        run_id,
-        "product_agent",
-        "completed",
-        {
-            "inceptions_generated": len(inceptions),
-            "inception_ids": [inc.get("id") for inc in inceptions],
-            "total_reqs_covered": total_included,
-            "total_risks_identified": total_risks,
-        }
-    )
+    total_included = sum(len(inc.get("mvp_scope", {}).get("included_reqs", [])) for inc in inceptions)
+    total_risks = sum(len(inc.get("risks", [])) for inc in inceptions)
+
+    await streamer.finish(result, {
+        "inceptions_generated": len(inceptions),
+        "inception_ids": [inc.get("id") for inc in inceptions],
+        "total_reqs_covered": total_included,
+        "total_risks_identified": total_risks,
+    })
 
     return {"inception": result}
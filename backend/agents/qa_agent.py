@@ -1,10 +1,17 @@
 """QA Agent — Test cases from user stories."""
 
-import json
+import os
 
+from agents.context import ContextBuilder
+from agents.fanout import batched, fan_out, renumber
 from agents.state import PipelineState
-from services.llm_service import call_llm_json
-from services.db_service import save_artifact, log_decision
+from agents.streaming import ArtifactStreamer
+from services.llm_service import call_llm_json, call_llm_json_stream
+from services.db_service import log_decision
+from models.schemas import TestCasesOutput
+
+# Stories per concurrent test-case batch (0 = all stories in one call)
+QA_STORIES_PER_BATCH = int(os.getenv("QA_STORIES_PER_BATCH", "5"))
 
 SYSTEM_PROMPT = """You are a QA Engineer agent in a software development pipeline.
 Your job is to generate test cases from user stories.
@@ -18,12 +25,12 @@ RULES:
 - ALL text content (titles, preconditions, steps, expected results) MUST be written in Spanish.
 - Respond ONLY with valid JSON, no extra text."""
 
-USER_PROMPT_TEMPLATE = """Given the following user stories, generate comprehensive test cases.
+USER_PROMPT_TEMPLATE = """Given the following user stories (one JSON object per line), generate comprehensive test cases.
 
 ## User Stories
 {user_stories}
 
-## Requirements (for traceability)
+## Requirements (IDs and titles, for traceability)
 {requirements}
 
 Respond with this exact JSON structure:
@@ -46,40 +53,91 @@ Generate at least 2 test cases per user story (1 positive, 1 negative). Respond
 
 
 async def run_qa_agent(state: PipelineState) -> dict:
-    """Receive user stories + requirements and generate test cases."""
+    """Receive user stories + requirements and generate test cases.
+
+    Projects with more than ``QA_STORIES_PER_BATCH`` stories are split into
+    story batches generated concurrently (see ``agents.fanout``).
+    """
     run_id = state["run_id"]
     user_stories = state.get("user_stories") or {}
     requirements = state.get("requirements") or {}
+    stories = [s for s in user_stories.get("artifacts", []) if isinstance(s, dict)]
+    batches = batched(stories, QA_STORIES_PER_BATCH)
+
+    if len(batches) > 1:
+        return await _run_batches(state, batches, requirements)
+
+    context = ContextBuilder("qa_agent")
+    context.add("user_stories", user_stories)
+    context.add("requirements", requirements)
+    sections = context.render()
 
     await log_decision(run_id, "qa_agent", "started", {
-        "input_stories": len(user_stories.get("artifacts", [])),
+        "input_stories": len(stories),
+        "context": context.report,
     })
 
+    prompt = _prompt(sections, state.get("hitl_feedback"))
+
+    # Each test case is saved and published as soon as the LLM finishes writing it
+    streamer = ArtifactStreamer(run_id, "qa_agent", "artifacts", _to_artifact)
+    result = await call_llm_json_stream(prompt, SYSTEM_PROMPT, streamer.on_item, schema=TestCasesOutput)
+    await streamer.finish(result, {"test_cases_generated": len(result.get("artifacts", []))})
+
+    return {"test_cases": result}
+
+
+def _prompt(sections: dict[str, str], feedback: str | None) -> str:
     prompt = USER_PROMPT_TEMPLATE.format(
-        user_stories=json.dumps(user_stories, indent=2, ensure_ascii=False),
-        requirements=json.dumps(requirements, indent=2, ensure_ascii=False),
+        user_stories=sections["user_stories"],
+        requirements=sections["requirements"],
     )
-
-    feedback = state.get("hitl_feedback")
     if feedback:
         prompt += f"\n\n## HITL Feedback (address this in your output)\n{feedback}"
+    return prompt
+
+
+def _to_artifact(tc: dict) -> dict:
+    return {"id": tc["id"], "type": "test_case", "content": tc,
+            "parent_ids": tc.get("user_story_ids", []) + tc.get("requirement_ids", [])}
+
+
+def _trace(tc: dict, batch: list[dict], requirement_ids: set[str]) -> dict:
+    """Point ``tc`` at stories of its own batch and at those stories' requirements."""
+    by_id = {story["id"]: story for story in batch}
+    story_ids = [sid for sid in tc.get("user_story_ids", []) if sid in by_id]
+    if not story_ids and len(batch) == 1:
+        story_ids = [batch[0]["id"]]
+    req_ids = list(dict.fromkeys(rid for sid in story_ids for rid in by_id[sid].get("requirement_ids", [])))
+    if not req_ids:
+        req_ids = [rid for rid in tc.get("requirement_ids", []) if rid in requirement_ids]
+    return {**tc, "user_story_ids": story_ids, "requirement_ids": req_ids}
 
-    result = await call_llm_json(prompt, SYSTEM_PROMPT)
-
-    # Save each test case as an artifact
-    for tc in result.get("artifacts", []):
-        parent_ids = tc.get("user_story_ids", []) + tc.get("requirement_ids", [])
-        await save_artifact(
-            run_id=run_id,
-            artifact_id=tc["id"],
-            agent="qa_agent",
-            artifact_type="test_case",
-            content=tc,
-            parent_ids=parent_ids,
-        )
-
-    await log_decision(run_id, "qa_agent", "completed", {
-        "test_cases_generated": len(result.get("artifacts", [])),
-    })
 
+async def _run_batches(state: PipelineState, batches: list[list[dict]], requirements: dict) -> dict:
+    run_id = state["run_id"]
+    all_requirements = [r for r in requirements.get("artifacts", []) if isinstance(r, dict)]
+    requirement_ids = {r.get("id") for r in all_requirements}
+
+    await log_decision(run_id, "qa_agent", "started", {
+        "input_stories": sum(len(batch) for batch in batches),
+        "batches": len(batches),
+    })
+    streamer = ArtifactStreamer(run_id, "qa_agent", "artifacts", _to_artifact)
+
+    async def run_batch(index: int, batch: list[dict]) -> list[dict]:
+        # Only the requirements this batch's stories trace to
+        referenced = {rid for story in batch for rid in story.get("requirement_ids", [])}
+        context = ContextBuilder("qa_agent")
+        context.add("user_stories", batch)
+        context.add("requirements", [r for r in all_requirements if r.get("id") in referenced])
+        result = await call_llm_json(_prompt(context.render(), state.get("hitl_feedback")),
+                                     SYSTEM_PROMPT, schema=TestCasesOutput)
+        return [_trace(tc, batch, requirement_ids) for tc in result.get("artifacts", [])]
+
+    test_cases = [tc for batch_cases in await fan_out(run_id, "qa_agent", batches, run_batch) for tc in batch_cases]
+    renumber(test_cases, "TC")
+
+    result = {"artifacts": test_cases}
+    await streamer.finish(result, {"test_cases_generated": len(test_cases), "batches": len(batches)})
     return {"test_cases": result}
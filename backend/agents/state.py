@@ -1,18 +1,30 @@
 from __future__ import annotations
 
-from typing import Optional, TypedDict
+from typing import Annotated, Optional, TypedDict
+
+
+def latest(current, update):
+    """Reducer for fields that parallel branches may write in the same step: the last update wins."""
+    return update
+
+
+def merge(current: Optional[dict], update: Optional[dict]) -> dict:
+    """Reducer for per-stage dicts: each branch adds its own keys."""
+    return {**(current or {}), **(update or {})}
 
 
 class PipelineState(TypedDict):
     run_id: str
     brief: str
-    current_stage: str
+    current_stage: Annotated[str, latest]
     requirements: Optional[dict]
     inception: Optional[dict]
     user_stories: Optional[dict]
-    test_cases: Optional[dict]
-    diagrams: Optional[dict]
-    hitl_status: Optional[str]   # pending | approved | rejected | changes
-    hitl_feedback: Optional[str]
+    test_cases: Optional[dict]   # written by the qa branch
+    diagrams: Optional[dict]     # written by the design branch, in parallel with qa
+    hitl_status: Annotated[Optional[str], latest]   # pending | approved | rejected | changes
+    hitl_feedback: Annotated[Optional[str], latest]
+    hitl_gate_id: Optional[int]  # gate opened by the open_hitl_* node, awaited by hitl_*
+    stage_timings: Annotated[dict, merge]  # stage -> {"started", "seconds"} of its last run
     error: Optional[str]
     retry_count: int
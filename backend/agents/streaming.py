@@ -0,0 +1,53 @@
+"""Persist artifacts one by one while an agent's LLM response is streaming."""
+
+import time
+from typing import Any, Callable
+
+from services.db_service import save_artifact, save_artifacts_bulk
+from services.stage_metrics import stage_metrics
+
+
+class ArtifactStreamer:
+    """``on_item`` callback for ``call_llm_json_stream`` that saves each artifact as it arrives.
+
+    ``to_artifact`` maps one streamed item to the ``{id, type, content,
+    parent_ids}`` dict accepted by ``save_artifacts_bulk``. ``finish`` saves
+    whatever was not streamed (e.g. after a JSON re-ask) together with the
+    ``completed`` log entry, which records the time to the first artifact.
+    """
+
+    def __init__(self, run_id: str, agent: str, item_key: str, to_artifact: Callable[[Any], dict]):
+        self.run_id = run_id
+        self.agent = agent
+        self.item_key = item_key
+        self.to_artifact = to_artifact
+        self.saved: dict[str, dict] = {}
+        self.started = time.monotonic()
+        self.time_to_first_artifact: float | None = None
+
+    async def on_item(self, key: str, item: Any) -> None:
+        if key != self.item_key or not isinstance(item, dict):
+            return
+        artifact = self.to_artifact(item)
+        if self.saved.get(artifact["id"]) == artifact:
+            return
+        await save_artifact(self.run_id, artifact["id"], self.agent, artifact["type"],
+                            artifact["content"], artifact["parent_ids"])
+        self.saved[artifact["id"]] = artifact
+        if self.time_to_first_artifact is None:
+            self.time_to_first_artifact = time.monotonic() - self.started
+            stage_metrics.record_first_artifact(self.agent, self.time_to_first_artifact)
+
+    async def finish(self, result: dict, completed_details: dict) -> None:
+        remaining = [
+            artifact for artifact in (self.to_artifact(item) for item in result.get(self.item_key, []))
+            if self.saved.get(artifact["id"]) != artifact
+        ]
+        details = dict(completed_details)
+        details["streamed_artifacts"] = len(self.saved)
+        if self.time_to_first_artifact is None and remaining:
+            self.time_to_first_artifact = time.monotonic() - self.started
+            stage_metrics.record_first_artifact(self.agent, self.time_to_first_artifact)
+        if self.time_to_first_artifact is not None:
+            details["time_to_first_artifact_s"] = round(self.time_to_first_artifact, 3)
+        await save_artifacts_bulk(self.run_id, self.agent, remaining, completed_details=details)
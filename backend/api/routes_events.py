@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Awaitable, Callable
+
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from services import db_service
+from services.run_events import bus
+
+router = APIRouter()
+
+# Seconds without events before a heartbeat comment is sent (also re-checks the
+# table for events written by another process)
+RUN_EVENTS_HEARTBEAT = float(os.getenv("RUN_EVENTS_HEARTBEAT", "15"))
+
+
+def _format(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+async def event_stream(
+    run_id: str,
+    last_event_id: int,
+    is_disconnected: Callable[[], Awaitable[bool]],
+    heartbeat: float = RUN_EVENTS_HEARTBEAT,
+) -> AsyncIterator[str]:
+    """SSE frames for a run: replay after ``last_event_id``, then live events."""
+    # Subscribe before replaying so nothing committed in between is missed;
+    # duplicates are skipped by comparing event ids.
+    subscriber = bus.subscribe(run_id)
+    last_id = last_event_id
+
+    async def replay() -> AsyncIterator[str]:
+        nonlocal last_id
+        while True:
+            events = await db_service.list_run_events(run_id, after_id=last_id)
+            for event in events:
+                last_id = event["id"]
+                yield _format(event)
+            if len(events) < 500:
+                return
+
+    try:
+        async for frame in replay():
+            yield frame
+        while not await is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                async for frame in replay():
+                    yield frame
+                yield ": heartbeat\n\n"
+                continue
+
+            if subscriber.overflowed:
+                # The buffer filled up and events were dropped: fall back to the table
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.overflowed = False
+                async for frame in replay():
+                    yield frame
+                continue
+
+            if event["id"] > last_id:
+                last_id = event["id"]
+                yield _format(event)
+    finally:
+        bus.unsubscribe(subscriber)
+
+
+@router.get("/runs/{run_id}/events")
+async def stream_run_events(
+    run_id: str,
+    request: Request,
+    last_event_id: str | None = Header(None),
+):
+    if not await db_service.get_run_status(run_id):
+        raise HTTPException(status_code=404, detail="Run not found")
+    try:
+        after = int(last_event_id) if last_event_id else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Last-Event-ID must be an integer")
+    return StreamingResponse(
+        event_stream(run_id, after, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -2,6 +2,7 @@ from fastapi import APIRouter, HTTPException
 
 from models.schemas import HitlDecisionRequest, HitlGateResponse
 from services import db_service
+from services.run_scheduler import scheduler
 
 router = APIRouter()
 
@@ -16,6 +17,7 @@ async def approve_hitl(run_id: str):
     result = await db_service.resolve_hitl(run_id, "approved", None)
     if not result:
         raise HTTPException(status_code=404, detail="No pending HITL gate")
+    await scheduler.enqueue(run_id)
     return result
 
 
@@ -24,6 +26,7 @@ async def reject_hitl(run_id: str):
     result = await db_service.resolve_hitl(run_id, "rejected", None)
     if not result:
         raise HTTPException(status_code=404, detail="No pending HITL gate")
+    await scheduler.enqueue(run_id)
     return result
 
 
@@ -32,4 +35,5 @@ async def request_changes_hitl(run_id: str, req: HitlDecisionRequest):
     result = await db_service.resolve_hitl(run_id, "changes", req.feedback)
     if not result:
         raise HTTPException(status_code=404, detail="No pending HITL gate")
+    await scheduler.enqueue(run_id)
     return result
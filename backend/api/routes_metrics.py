@@ -0,0 +1,49 @@
+from fastapi import APIRouter
+
+import database
+from services import db_service
+from services.hitl_waiters import waiters
+from services.json_repair import json_outcomes
+from services.llm_cache import llm_cache
+from services.llm_models import agent_usage
+from services.llm_providers import providers
+from services.run_events import bus
+from services.run_scheduler import scheduler
+from services.speculation import speculator
+from services.stage_metrics import stage_metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics():
+    writer = database.get_writer()
+    return {
+        "db_pool": database.get_pool().stats(),
+        "db_writer": writer.stats() if writer else None,
+        "hitl_waiters": waiters.stats(),
+        "run_events": bus.stats(),
+        "llm_cache": await llm_cache.stats(),
+        "llm_providers": providers.stats(),
+        "llm_agents": agent_usage.stats(),
+        "llm_json": json_outcomes.stats(),
+        "stages": stage_metrics.stats(),
+        "speculation": speculator.stats(),
+        "run_scheduler": await scheduler.stats(),
+    }
+
+
+@router.get("/llm/cache")
+async def get_llm_cache_stats():
+    return await llm_cache.stats()
+
+
+@router.delete("/llm/cache")
+async def clear_llm_cache():
+    return {"deleted": await llm_cache.clear()}
+
+
+@router.get("/usage")
+async def get_usage():
+    """LLM tokens, latency and cost across all runs."""
+    return await db_service.get_llm_usage()
@@ -1,22 +1,28 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 
 from models.schemas import CreateRunRequest, RunResponse
 from services import db_service
-from agents.graph import run_pipeline
+from services.run_scheduler import scheduler
+from services.speculation import speculator
 
 router = APIRouter()
 
 
 @router.post("/runs", response_model=RunResponse)
-async def create_run(req: CreateRunRequest, background_tasks: BackgroundTasks):
-    run = await db_service.create_run(req.brief)
-    background_tasks.add_task(run_pipeline, run["id"], req.brief)
-    return run
+async def create_run(req: CreateRunRequest):
+    run = await db_service.create_run(req.brief, req.priority)
+    await scheduler.enqueue(run["id"])
+    return await db_service.get_run(run["id"])
 
 
 @router.get("/runs", response_model=list[RunResponse])
-async def list_runs():
-    return await db_service.list_runs()
+async def list_runs(
+    limit: int = Query(db_service.RUN_LIST_DEFAULT_LIMIT, ge=1, le=db_service.RUN_LIST_MAX_LIMIT),
+    after: str | None = Query(None, description="Last run id of the previous page"),
+    status: str | None = None,
+    stage: str | None = None,
+):
+    return await db_service.list_runs(limit=limit, after=after, status=status, stage=stage)
 
 
 @router.get("/runs/{run_id}", response_model=RunResponse)
@@ -27,9 +33,33 @@ async def get_run(run_id: str):
     return run
 
 
+@router.post("/runs/{run_id}/cancel", response_model=RunResponse)
+async def cancel_run(run_id: str):
+    result = await db_service.cancel_run(run_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    if not result["cancelled"]:
+        raise HTTPException(status_code=409, detail=f"Run already {result['status']}")
+    # Cancelling the task aborts its in-flight LLM requests and frees its limiter slots
+    await scheduler.cancel(run_id)
+    await speculator.discard_run(run_id, "cancelled")
+    return await db_service.get_run(run_id)
+
+
 @router.get("/runs/{run_id}/status")
 async def get_run_status(run_id: str):
     status = await db_service.get_run_status(run_id)
     if not status:
         raise HTTPException(status_code=404, detail="Run not found")
     return status
+
+
+@router.get("/runs/{run_id}/usage")
+async def get_run_usage(run_id: str):
+    if not await db_service.get_run_status(run_id):
+        raise HTTPException(status_code=404, detail="Run not found")
+    return {
+        "run_id": run_id,
+        **await db_service.get_llm_usage(run_id),
+        "speculation": await db_service.get_speculation_stats(run_id),
+    }
@@ -0,0 +1,72 @@
+"""Write-throughput benchmark for the SQLite store.
+
+Simulates N pipeline runs writing concurrently (artifacts, decision log
+entries and stage updates, like the agents do) and reports writes/s for
+the ``wal`` and ``legacy`` storage modes.
+
+Usage (from ``backend/``)::
+
+    python -m benchmarks.bench_db_writes
+    python -m benchmarks.bench_db_writes --runs 1 10 50 --artifacts 40
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import database
+from services import db_service
+
+
+async def _simulate_run(run_id: str, artifacts: int) -> int:
+    """One run's write pattern; returns the number of writes issued."""
+    writes = 0
+    await db_service.update_run_stage(run_id, "running", "ba")
+    await db_service.log_decision(run_id, "ba_agent", "started", {"brief_length": 1200})
+    writes += 2
+    for i in range(1, artifacts + 1):
+        await db_service.save_artifact(
+            run_id=run_id,
+            artifact_id=f"REQ-{i:03d}",
+            agent="ba_agent",
+            artifact_type="requirement",
+            content={"id": f"REQ-{i:03d}", "title": "Requisito", "description": "x" * 200},
+            parent_ids=[],
+        )
+        writes += 1
+    await db_service.log_decision(run_id, "ba_agent", "completed", {"requirements_generated": artifacts})
+    await db_service.update_run_stage(run_id, "waiting_hitl", "hitl_ba")
+    return writes + 2
+
+
+async def _bench(mode: str, concurrency: int, artifacts: int) -> tuple[int, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.DB_STORAGE_MODE = mode
+        await database.init_db()
+        async with database.pool_scope():
+            runs = [await db_service.create_run("benchmark brief") for _ in range(concurrency)]
+            started = time.perf_counter()
+            counts = await asyncio.gather(*[_simulate_run(r["id"], artifacts) for r in runs])
+            elapsed = time.perf_counter() - started
+    return sum(counts), elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--artifacts", type=int, default=20, help="artifacts saved per run")
+    parser.add_argument("--modes", nargs="+", default=["legacy", "wal"])
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'runs':>5} {'writes':>8} {'seconds':>9} {'writes/s':>10}")
+    for mode in args.modes:
+        for concurrency in args.runs:
+            writes, elapsed = await _bench(mode, concurrency, args.artifacts)
+            print(f"{mode:<8} {concurrency:>5} {writes:>8} {elapsed:>9.3f} {writes / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""Prompt context size per agent, before and after ``ContextBuilder``.
+
+Builds the upstream state of a project with N requirements (one user story
+and two test cases per requirement, as the agents are asked to produce) and
+reports, for every agent, the estimated tokens of the embedded artifacts as
+indented JSON of whole documents and as projected, compact, budgeted context.
+
+Usage (from ``backend/``)::
+
+    python -m benchmarks.bench_prompt_context
+    python -m benchmarks.bench_prompt_context --reqs 5 20 60 --budget 6000
+"""
+
+import argparse
+
+from agents.context import ContextBuilder
+
+PRIORITIES = ("high", "medium", "low")
+
+
+def project_state(reqs: int) -> dict:
+    """Upstream state shaped like the agents' outputs for a project of ``reqs`` requirements."""
+    requirements = {
+        "artifacts": [
+            {"id": f"REQ-{i:03d}", "title": f"Requisito {i}",
+             "description": f"El sistema debe permitir la operacion {i} " + "con validaciones y auditoria " * 4,
+             "type": "functional", "priority": PRIORITIES[i % 3], "actors": ["Usuario", "Administrador"]}
+            for i in range(1, reqs + 1)
+        ],
+        "domain_summary": "Plataforma de gestion de pedidos",
+        "assumptions": ["Los usuarios tienen acceso a internet", "El pago lo procesa un tercero"],
+    }
+    ids_by_priority = {p: [r["id"] for r in requirements["artifacts"] if r["priority"] == p] for p in PRIORITIES}
+    inception = {"inceptions": [
+        {"id": f"INC-{n:03d}", "title": f"Fase {n}", "phase": phase, "requirement_ids": ids_by_priority[priority],
+         "mvp_scope": {"included_reqs": ids_by_priority[priority], "excluded_reqs": [],
+                       "justification": "Alcance acordado por prioridad " * 3},
+         "risks": [{"id": f"RISK-{n:03d}", "description": "Dependencia de un proveedor externo " * 2,
+                    "impact": "high", "mitigation": "Reintentos y monitoreo"}],
+         "success_criteria": ["Los usuarios completan el flujo principal", "Tiempo de respuesta menor a 2s"]}
+        for n, (phase, priority) in enumerate(zip(("MVP / Piloto", "Versión 1.0", "Versión Futura"), PRIORITIES), 1)
+    ]}
+    user_stories = {"artifacts": [
+        {"id": f"US-{i:03d}", "title": f"Historia {i}", "requirement_ids": [f"REQ-{i:03d}"],
+         "story": f"Como usuario, quiero realizar la operacion {i}, para cumplir mi objetivo.",
+         "acceptance_criteria": [
+             f"Escenario 1 (positivo): DADO datos validos, CUANDO ejecuto la operacion {i}, ENTONCES se registra",
+             f"Escenario 2 (negativo): DADO datos invalidos, CUANDO ejecuto la operacion {i}, ENTONCES veo un error",
+         ],
+         "priority": PRIORITIES[i % 3], "estimation": "M"}
+        for i in range(1, reqs + 1)
+    ]}
+    test_cases = {"artifacts": [
+        {"id": f"TC-{2 * i - 1 + k:03d}", "title": f"Caso {kind} de la historia {i}",
+         "user_story_ids": [f"US-{i:03d}"], "requirement_ids": [f"REQ-{i:03d}"],
+         "preconditions": ["El usuario ha iniciado sesion"],
+         "steps": ["DADO que ...", f"CUANDO ejecuto la operacion {i}", "ENTONCES ..."],
+         "expected_result": "Resultado esperado claro", "type": kind}
+        for i in range(1, reqs + 1) for k, kind in enumerate(("positive", "negative"))
+    ]}
+    return {"requirements": requirements, "inception": inception,
+            "user_stories": user_stories, "test_cases": test_cases}
+
+
+def agent_contexts(state: dict, budget: int | None) -> dict[str, ContextBuilder]:
+    """The same sections each agent adds to its prompt."""
+    contexts = {
+        "product_agent": ContextBuilder("product_agent", budget).add("requirements", state["requirements"]),
+        "analyst_agent": ContextBuilder("analyst_agent", budget)
+        .add("requirements", state["requirements"])
+        .add("inceptions", state["inception"], items_key="inceptions"),
+        "qa_agent": ContextBuilder("qa_agent", budget)
+        .add("user_stories", state["user_stories"])
+        .add("requirements", state["requirements"]),
+        # design_agent makes one call per diagram
+        "design_agent/er": ContextBuilder("design_agent", budget)
+        .add("requirements", state["requirements"])
+        .add("inceptions", state["inception"], items_key="inceptions"),
+        "design_agent/seq": ContextBuilder("design_agent", budget).add("user_stories", state["user_stories"]),
+    }
+    for context in contexts.values():
+        context.render()
+    return contexts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reqs", type=int, nargs="+", default=[5, 20, 60], help="requirements per project")
+    parser.add_argument("--budget", type=int, default=None, help="token budget (default: per-agent config)")
+    args = parser.parse_args()
+
+    print(f"{'reqs':>5} {'agent':<16} {'before':>8} {'after':>8} {'saved':>7} {'budget':>7}  omitted")
+    for reqs in args.reqs:
+        for agent, context in agent_contexts(project_state(reqs), args.budget).items():
+            report = context.report
+            saved = 1 - report["tokens_after"] / report["tokens_before"] if report["tokens_before"] else 0.0
+            print(f"{reqs:>5} {agent:<16} {report['tokens_before']:>8} {report['tokens_after']:>8} "
+                  f"{saved:>7.0%} {report['budget_tokens']:>7}  {report['omitted'] or '-'}")
+
+
+if __name__ == "__main__":
+    main()
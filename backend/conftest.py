@@ -2,7 +2,6 @@
 
 import os
 import asyncio
-from unittest.mock import AsyncMock, patch
 
 import pytest
 import pytest_asyncio
@@ -17,7 +16,7 @@ database.DB_PATH = "data/test_sdlc.db"
 
 from main import app  # noqa: E402
 from httpx import AsyncClient, ASGITransport  # noqa: E402
-from database import init_db, get_db  # noqa: E402
+from database import init_db, get_db, open_pool, close_pool, start_writer, stop_writer  # noqa: E402
 from services import db_service  # noqa: E402
 
 
@@ -36,32 +35,31 @@ def event_loop():
 async def fresh_db():
     """Create tables before each test and drop them after."""
     await init_db()
+    await open_pool()
+    await start_writer()
     yield
+    await stop_writer()
+    await close_pool()
     # Clean up
     db = await get_db()
     try:
         await db.executescript(
-            "DELETE FROM hitl_gates; DELETE FROM decision_log; DELETE FROM artifacts; DELETE FROM runs;"
+            "DELETE FROM run_queue; DELETE FROM staged_writes; DELETE FROM llm_cache; DELETE FROM llm_usage; DELETE FROM llm_calls; DELETE FROM run_events; DELETE FROM hitl_gates; DELETE FROM decision_log; DELETE FROM artifacts; DELETE FROM runs;"
         )
         await db.commit()
     finally:
         await db.close()
 
 
-# ---------- mock pipeline (don't call the LLM during tests) ----------
-
-@pytest.fixture(autouse=True)
-def mock_pipeline():
-    """Prevent POST /api/runs from triggering the real pipeline (which calls the LLM)."""
-    with patch("api.routes_runs.run_pipeline", new_callable=AsyncMock):
-        yield
-
-
 # ---------- async HTTP client ----------
 
 @pytest_asyncio.fixture
 async def client():
-    """AsyncClient that talks to the FastAPI app without starting a server."""
+    """AsyncClient that talks to the FastAPI app without starting a server.
+
+    The lifespan does not run, so the run scheduler is not started: POST
+    /api/runs only queues the run and never calls the LLM.
+    """
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as c:
         yield c
@@ -1,16 +1,397 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+
 import aiosqlite
 
+from migrations import migrate
+
 DB_PATH = "data/sdlc_pipeline.db"
 
+# "wal": WAL journal + tuned pragmas + single writer task with group commit.
+# "legacy": SQLite defaults, each write commits on its own pooled connection.
+DB_STORAGE_MODE = os.getenv("DB_STORAGE_MODE", "wal")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+# Idle connections older than this are pinged with SELECT 1 before being handed out
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(16 * 1024)))
+# Upper bound on queued writes folded into a single transaction
+DB_WRITER_MAX_BATCH = int(os.getenv("DB_WRITER_MAX_BATCH", "256"))
+
+WriteFn = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+async def _apply_pragmas(db: aiosqlite.Connection) -> None:
+    await db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    if DB_STORAGE_MODE == "wal":
+        await db.execute("PRAGMA synchronous = NORMAL")
+        await db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        await db.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+
 
 async def get_db() -> aiosqlite.Connection:
     db = await aiosqlite.connect(DB_PATH)
     db.row_factory = aiosqlite.Row
+    await _apply_pragmas(db)
     return db
 
 
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+class ConnectionPool:
+    """Fixed-size pool of long-lived aiosqlite connections.
+
+    Connections are opened lazily up to ``size`` and reused across queries,
+    so each query no longer pays for a new connection and worker thread.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE,
+                 healthcheck_interval: float = DB_POOL_HEALTHCHECK_INTERVAL):
+        if size < 1:
+            raise ValueError("pool size must be >= 1")
+        self.path = path
+        self.size = size
+        self.healthcheck_interval = healthcheck_interval
+        self._idle: asyncio.LifoQueue[tuple[aiosqlite.Connection, float]] = asyncio.LifoQueue()
+        self._opened = 0
+        self._closed = False
+        # Counters exposed through stats()
+        self._acquisitions = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._healthcheck_failures = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path)
+        db.row_factory = aiosqlite.Row
+        await _apply_pragmas(db)
+        return db
+
+    async def _is_healthy(self, db: aiosqlite.Connection) -> bool:
+        try:
+            await db.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def _discard(self, db: aiosqlite.Connection) -> None:
+        try:
+            await db.close()
+        except Exception:
+            pass
+
+    async def _checkout(self) -> aiosqlite.Connection:
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+
+        try:
+            db, last_used = self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return await self._connect()
+                except BaseException:
+                    self._opened -= 1
+                    raise
+            self._waits += 1
+            started = time.monotonic()
+            db, last_used = await self._idle.get()
+            waited = time.monotonic() - started
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+
+        if time.monotonic() - last_used >= self.healthcheck_interval and not await self._is_healthy(db):
+            self._healthcheck_failures += 1
+            await self._discard(db)
+            try:
+                return await self._connect()
+            except BaseException:
+                self._opened -= 1
+                raise
+        return db
+
+    async def _release(self, db: aiosqlite.Connection) -> None:
+        if self._closed:
+            self._opened -= 1
+            await self._discard(db)
+            return
+        try:
+            if db.in_transaction:
+                await db.rollback()
+        except BaseException:
+            # Includes cancellation mid-rollback: never hand out a half-reset connection
+            self._opened -= 1
+            await self._discard(db)
+            raise
+        self._idle.put_nowait((db, time.monotonic()))
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a connection; uncommitted work is rolled back on release."""
+        db = await self._checkout()
+        self._acquisitions += 1
+        try:
+            yield db
+        finally:
+            await self._release(db)
+
+    async def close(self) -> None:
+        self._closed = True
+        while not self._idle.empty():
+            db, _ = self._idle.get_nowait()
+            self._opened -= 1
+            await self._discard(db)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "open": self._opened,
+            "idle": self._idle.qsize(),
+            "in_use": self._opened - self._idle.qsize(),
+            "acquisitions": self._acquisitions,
+            "waits": self._waits,
+            "wait_time_total_s": round(self._wait_time_total, 6),
+            "wait_time_max_s": round(self._wait_time_max, 6),
+            "healthcheck_failures": self._healthcheck_failures,
+        }
+
+
+_pool: ConnectionPool | None = None
+
+
+async def open_pool(size: int | None = None) -> ConnectionPool:
+    """Create the process-wide pool. Called from the FastAPI lifespan."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+    _pool = ConnectionPool(DB_PATH, size if size is not None else DB_POOL_SIZE)
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> ConnectionPool:
+    """Return the active pool. Scripts outside the FastAPI lifespan use ``pool_scope()``."""
+    if _pool is None:
+        raise RuntimeError("database pool is not open; call open_pool() or use pool_scope()")
+    return _pool
+
+
+def connection():
+    """Async context manager yielding a pooled connection."""
+    return get_pool().acquire()
+
+
+# ---------------------------------------------------------------------------
+# Single writer
+# ---------------------------------------------------------------------------
+class DatabaseWriter:
+    """One task owning the write connection; queued writes are group-committed.
+
+    Each queued write runs inside its own SAVEPOINT, so a failing write only
+    rolls back itself while the rest of the batch still commits together.
+    """
+
+    def __init__(self, path: str, max_batch: int = DB_WRITER_MAX_BATCH):
+        self.path = path
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue[tuple[WriteFn, asyncio.Future] | None] = asyncio.Queue()
+        self._db: aiosqlite.Connection | None = None
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+        self._batches = 0
+        self._writes = 0
+        self._failed_writes = 0
+        self._largest_batch = 0
+
+    async def start(self) -> None:
+        # Transactions are managed explicitly, so the connection runs in autocommit mode
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        try:
+            self._db.row_factory = aiosqlite.Row
+            await _apply_pragmas(self._db)
+        except BaseException:
+            await self._db.close()
+            self._db = None
+            raise
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Drain queued writes, then close the connection."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        except Exception:
+            pass  # already surfaced to every queued caller by _run
+        finally:
+            self._task = None
+            await self._db.close()
+            self._db = None
+
+    async def submit(self, fn: WriteFn) -> Any:
+        if self._task is None or self._stopping or self._task.done():
+            raise RuntimeError("database writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, future))
+        return await future
+
+    async def _run(self) -> None:
+        batch: list[tuple[WriteFn, asyncio.Future]] = []
+        try:
+            stopping = False
+            while not stopping:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                await self._commit_batch(batch)
+                batch = []
+        except BaseException as e:
+            # The writer is gone: fail the in-flight batch and everything still queued
+            self._stopping = True
+            error = e if isinstance(e, Exception) else RuntimeError("database writer stopped")
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is not None:
+                    batch.append(item)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+
+    async def _commit_batch(self, batch: list[tuple[WriteFn, asyncio.Future]]) -> None:
+        db = self._db
+        outcomes: list[tuple[asyncio.Future, Any, BaseException | None]] = []
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                if future.cancelled():
+                    continue
+                await db.execute("SAVEPOINT write_op")
+                try:
+                    result = await fn(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write_op")
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, None, e))
+                else:
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, result, None))
+            await db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            outcomes = [(future, None, e) for _, future in batch]
+
+        self._batches += 1
+        self._largest_batch = max(self._largest_batch, len(batch))
+        for future, result, error in outcomes:
+            self._writes += 1
+            if future.done():
+                continue
+            if error is not None:
+                self._failed_writes += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self._batches,
+            "writes": self._writes,
+            "failed_writes": self._failed_writes,
+            "largest_batch": self._largest_batch,
+            "avg_batch": round(self._writes / self._batches, 2) if self._batches else 0.0,
+        }
+
+
+_writer: DatabaseWriter | None = None
+
+
+async def start_writer() -> DatabaseWriter | None:
+    """Start the single writer task when running in WAL storage mode."""
+    global _writer
+    await stop_writer()
+    if DB_STORAGE_MODE != "wal":
+        return None
+    _writer = DatabaseWriter(DB_PATH)
+    await _writer.start()
+    return _writer
+
+
+async def stop_writer() -> None:
+    global _writer
+    if _writer is not None:
+        await _writer.stop()
+        _writer = None
+
+
+def get_writer() -> DatabaseWriter | None:
+    return _writer
+
+
+@asynccontextmanager
+async def pool_scope() -> AsyncIterator[ConnectionPool]:
+    """Open the pool and writer for scripts that run outside the FastAPI lifespan.
+
+    Both are closed on exit, so their aiosqlite threads do not keep the
+    interpreter alive.
+    """
+    pool = await open_pool()
+    try:
+        await start_writer()
+        yield pool
+    finally:
+        await stop_writer()
+        await close_pool()
+
+
+async def write(fn: WriteFn) -> Any:
+    """Run ``fn(db)`` as a committed write and return its result.
+
+    ``fn`` must not commit itself. With the writer running the call joins the
+    next group commit; otherwise it commits on a pooled connection.
+    """
+    if _writer is not None:
+        return await _writer.submit(fn)
+    async with connection() as db:
+        result = await fn(db)
+        await db.commit()
+        return result
+
+
 async def init_db():
     async with aiosqlite.connect(DB_PATH) as db:
+        # journal_mode is persistent in the file, so it only needs setting here
+        await db.execute(f"PRAGMA journal_mode = {'WAL' if DB_STORAGE_MODE == 'wal' else 'DELETE'}")
         await db.executescript("""
             CREATE TABLE IF NOT EXISTS runs (
                 id TEXT PRIMARY KEY,
@@ -55,3 +436,4 @@ async def init_db():
             );
         """)
         await db.commit()
+        await migrate(db)
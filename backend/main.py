@@ -3,14 +3,29 @@ from datetime import datetime
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from database import init_db
-from api import routes_runs, routes_artifacts, routes_hitl, routes_logs
+from database import init_db, open_pool, close_pool, start_writer, stop_writer
+from agents.graph import advance_run, open_checkpointer, close_checkpointer, resume_interrupted_runs
+from services.run_scheduler import RUN_EXECUTION, scheduler
+from services.speculation import speculator
+from api import routes_runs, routes_artifacts, routes_hitl, routes_logs, routes_metrics, routes_events
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    await open_pool()
+    await start_writer()
+    await open_checkpointer()
+    if RUN_EXECUTION == "inprocess":
+        await scheduler.start(advance_run)
+        await resume_interrupted_runs()
+    # Otherwise runs are only enqueued here and executed by python -m workers
     yield
+    await scheduler.stop()  # drains the runs in their slots
+    await speculator.shutdown()
+    await close_checkpointer()
+    await stop_writer()
+    await close_pool()
 
 
 app = FastAPI(title="Multi-Agent SDLC Pipeline", version="0.1.0", lifespan=lifespan)
@@ -23,7 +38,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-for module in [routes_runs, routes_artifacts, routes_hitl, routes_logs]:
+for module in [routes_runs, routes_artifacts, routes_hitl, routes_logs, routes_metrics, routes_events]:
     app.include_router(module.router, prefix="/api")
 
 
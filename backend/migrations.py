@@ -0,0 +1,160 @@
+"""Versioned schema migrations, applied in order by ``database.init_db()``.
+
+Each step runs in its own transaction together with its ``schema_version``
+row, so a crash never leaves a half-applied version. Steps must also be
+idempotent (``IF NOT EXISTS``) because databases created before the
+``schema_version`` table existed may already contain some objects.
+"""
+
+import aiosqlite
+
+# (version, description, SQL script) — append new steps, never edit applied ones
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "index artifacts by run", """
+        CREATE INDEX IF NOT EXISTS idx_artifacts_run_created ON artifacts (run_id, created_at);
+        CREATE INDEX IF NOT EXISTS idx_artifacts_run_type ON artifacts (run_id, type);
+    """),
+    (2, "index decision log by run", """
+        CREATE INDEX IF NOT EXISTS idx_decision_log_run_timestamp ON decision_log (run_id, timestamp);
+    """),
+    (3, "index hitl gates by run and status", """
+        CREATE INDEX IF NOT EXISTS idx_hitl_gates_run_status_created ON hitl_gates (run_id, status, created_at);
+    """),
+    (4, "index runs by creation time", """
+        CREATE INDEX IF NOT EXISTS idx_runs_created ON runs (created_at);
+    """),
+    (5, "index runs for filtered keyset pagination", """
+        CREATE INDEX IF NOT EXISTS idx_runs_status_id ON runs (status, id);
+        CREATE INDEX IF NOT EXISTS idx_runs_stage_id ON runs (current_stage, id);
+    """),
+    (6, "run events for server-sent events", """
+        CREATE TABLE IF NOT EXISTS run_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}',
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (run_id) REFERENCES runs(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_run_events_run_id ON run_events (run_id, id);
+    """),
+    (7, "persistent llm response cache", """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used_at);
+    """),
+    (8, "llm call accounting with pre-aggregated usage", """
+        CREATE TABLE IF NOT EXISTS llm_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT,
+            agent TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            usage_estimated INTEGER NOT NULL DEFAULT 0,
+            latency_s REAL NOT NULL,
+            cost_usd REAL NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (run_id) REFERENCES runs(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_llm_calls_run_id ON llm_calls (run_id, id);
+        -- One row per (scope, agent, model); scope is a run id or '*' for all runs
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            scope TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            model TEXT NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            latency_s REAL NOT NULL DEFAULT 0,
+            latency_max_s REAL NOT NULL DEFAULT 0,
+            cost_usd REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, agent, model)
+        );
+    """),
+    (9, "staging area for speculative stage output", """
+        -- Artifacts and decision logs written by a stage run speculatively while
+        -- the previous gate is pending, replayed in order when it is approved
+        CREATE TABLE IF NOT EXISTS staged_writes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (run_id) REFERENCES runs(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_staged_writes_run_stage ON staged_writes (run_id, stage, id);
+    """),
+    (10, "persistent run queue with priorities", """
+        ALTER TABLE runs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;
+        -- Runs waiting for (or holding) a scheduler slot, at most one entry per
+        -- run. requeue marks a run enqueued again while it was running.
+        CREATE TABLE IF NOT EXISTS run_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL UNIQUE,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            requeue INTEGER NOT NULL DEFAULT 0,
+            enqueued_at TEXT NOT NULL DEFAULT (datetime('now')),
+            started_at TEXT,
+            FOREIGN KEY (run_id) REFERENCES runs(id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_run_queue_order ON run_queue (status, priority DESC, id);
+    """),
+    (11, "leases on run queue entries for worker processes", """
+        -- worker_id holds a claimed entry until lease_expires_at (unix time),
+        -- renewed by its heartbeats; attempts counts claims of the entry
+        ALTER TABLE run_queue ADD COLUMN worker_id TEXT;
+        ALTER TABLE run_queue ADD COLUMN lease_expires_at REAL;
+        ALTER TABLE run_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS idx_run_queue_leases ON run_queue (status, lease_expires_at);
+    """),
+]
+
+
+async def current_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return (await cursor.fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> list[int]:
+    """Apply pending migrations in order and return the versions applied."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    await db.commit()
+
+    applied = []
+    version = await current_version(db)
+    for step, description, script in MIGRATIONS:
+        if step <= version:
+            continue
+        # executescript() commits first, so wrap the step explicitly to keep it atomic
+        quoted = description.replace("'", "''")
+        try:
+            await db.executescript(
+                f"BEGIN; {script}\n"
+                f"INSERT INTO schema_version (version, description) VALUES ({step}, '{quoted}');\n"
+                f"COMMIT;"
+            )
+        except Exception:
+            if db.in_transaction:
+                await db.rollback()
+            raise
+        applied.append(step)
+    return applied
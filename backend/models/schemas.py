@@ -9,6 +9,7 @@ from pydantic import BaseModel
 
 class CreateRunRequest(BaseModel):
     brief: str
+    priority: int = 0  # higher runs are started first when the scheduler is busy
 
 
 class HitlDecisionRequest(BaseModel):
@@ -109,6 +110,9 @@ class RunResponse(BaseModel):
     current_stage: str
     created_at: str
     updated_at: str
+    brief_truncated: bool = False  # True in run listings when brief was cut short
+    priority: int = 0
+    queue_position: Optional[int] = None  # 1 = next to start; None when not queued
 
 
 class ArtifactResponse(BaseModel):
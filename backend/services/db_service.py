@@ -1,78 +1,382 @@
-"""Database operations for runs, artifacts, decision logs, and HITL gates."""
+"""Database operations for runs, artifacts, decision logs, HITL gates and LLM usage."""
 
 import json
-import uuid
-
-from database import get_db
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from database import connection, write
+from services.hitl_waiters import waiters
+from services.run_events import bus
+
+RUN_LIST_DEFAULT_LIMIT = 50
+RUN_LIST_MAX_LIMIT = 200
+# Run listings return only the first characters of each brief
+RUN_BRIEF_PREVIEW_CHARS = 200
+# Statuses a run never leaves
+RUN_FINAL_STATUSES = ("completed", "rejected", "error", "cancelled")
+
+# 1-based place of a queued run in the run queue (NULL when not queued)
+_QUEUE_POSITION = """NULLIF((
+    SELECT COUNT(*) FROM run_queue mine JOIN run_queue q ON q.status = 'queued'
+        AND (q.priority > mine.priority OR (q.priority = mine.priority AND q.id <= mine.id))
+    WHERE mine.run_id = runs.id AND mine.status = 'queued'
+), 0)"""
+
+_ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"  # Crockford base32
+_last_ulid_ms = 0
+_last_ulid_random = 0
+
+# Stage whose artifact and decision-log writes are diverted to ``staged_writes``
+_staging: ContextVar[str | None] = ContextVar("staging", default=None)
+
+
+def _new_run_id() -> str:
+    """ULID: 48-bit millisecond timestamp + 80 random bits, 26 sortable chars.
+
+    IDs generated in the same millisecond increment the random part, so they
+    stay strictly increasing within the process.
+    """
+    global _last_ulid_ms, _last_ulid_random
+    ms = time.time_ns() // 1_000_000
+    if ms <= _last_ulid_ms:
+        ms = _last_ulid_ms
+        random_part = _last_ulid_random + 1
+        if random_part >= 1 << 80:
+            ms, random_part = ms + 1, int.from_bytes(os.urandom(10), "big")
+    else:
+        random_part = int.from_bytes(os.urandom(10), "big")
+    _last_ulid_ms, _last_ulid_random = ms, random_part
+
+    value = (ms << 80) | random_part
+    chars = []
+    for _ in range(26):
+        chars.append(_ULID_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+async def _record_event(db, run_id: str, event_type: str, data: dict) -> dict:
+    """Append a run event inside the caller's write; publish it after commit."""
+    cursor = await db.execute(
+        "INSERT INTO run_events (run_id, type, data) VALUES (?, ?, ?)",
+        (run_id, event_type, json.dumps(data)),
+    )
+    return {"id": cursor.lastrowid, "run_id": run_id, "type": event_type, "data": data}
+
+
+def _artifact_event_data(run_id: str, artifact_id: str, agent: str, artifact_type: str,
+                         content: dict, parent_ids: list[str]) -> dict:
+    return {"id": artifact_id, "run_id": run_id, "agent": agent, "type": artifact_type,
+            "content": content, "parent_ids": parent_ids}
 
 
 # --- Runs ---
 
-async def create_run(brief: str) -> dict:
-    run_id = str(uuid.uuid4())[:8]
-    db = await get_db()
-    try:
+async def create_run(brief: str, priority: int = 0) -> dict:
+    run_id = _new_run_id()
+
+    async def _insert(db):
         await db.execute(
-            "INSERT INTO runs (id, brief, status, current_stage) VALUES (?, ?, 'created', 'pending')",
-            (run_id, brief),
+            "INSERT INTO runs (id, brief, status, current_stage, priority) VALUES (?, ?, 'created', 'pending', ?)",
+            (run_id, brief, priority),
         )
-        await db.commit()
         cursor = await db.execute("SELECT * FROM runs WHERE id = ?", (run_id,))
         row = await cursor.fetchone()
         return dict(row)
-    finally:
-        await db.close()
-
 
-async def list_runs() -> list[dict]:
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT * FROM runs ORDER BY created_at DESC")
+    return await write(_insert)
+
+
+async def list_runs(
+    limit: int = RUN_LIST_DEFAULT_LIMIT, after: str | None = None,
+    status: str | None = None, stage: str | None = None,
+) -> list[dict]:
+    """Newest-first page of run summaries (brief truncated).
+
+    Keyset pagination: pass the last ``id`` of a page as ``after`` to get the
+    next one. Run IDs are ULIDs, so walking the primary key is time order.
+    """
+    clauses, params = [], []
+    if after:
+        clauses.append("id < ?")
+        params.append(after)
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if stage:
+        clauses.append("current_stage = ?")
+        params.append(stage)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    async with connection() as db:
+        cursor = await db.execute(
+            f"""SELECT id, substr(brief, 1, ?) AS brief, length(brief) > ? AS brief_truncated,
+                       status, current_stage, priority, created_at, updated_at,
+                       {_QUEUE_POSITION} AS queue_position
+                FROM runs {where} ORDER BY id DESC LIMIT ?""",
+            (RUN_BRIEF_PREVIEW_CHARS, RUN_BRIEF_PREVIEW_CHARS, *params, min(limit, RUN_LIST_MAX_LIMIT)),
+        )
         rows = await cursor.fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        await db.close()
+        return [{**dict(r), "brief_truncated": bool(r["brief_truncated"])} for r in rows]
 
 
 async def get_run(run_id: str) -> dict | None:
-    db = await get_db()
-    try:
-        cursor = await db.execute("SELECT * FROM runs WHERE id = ?", (run_id,))
+    async with connection() as db:
+        cursor = await db.execute(f"SELECT *, {_QUEUE_POSITION} AS queue_position FROM runs WHERE id = ?", (run_id,))
         row = await cursor.fetchone()
         return dict(row) if row else None
-    finally:
-        await db.close()
 
 
 async def get_run_status(run_id: str) -> dict | None:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT id, status, current_stage FROM runs WHERE id = ?", (run_id,)
         )
         row = await cursor.fetchone()
         return dict(row) if row else None
-    finally:
-        await db.close()
+
+
+async def list_resumable_runs() -> list[dict]:
+    """Runs a restarted process should pick up.
+
+    Not yet started or mid-stage runs, plus runs parked at a HITL gate that
+    was resolved while nothing was running them. Runs with a queue entry are
+    left to the scheduler, which reclaims them once their lease expires.
+    """
+    async with connection() as db:
+        cursor = await db.execute(
+            """SELECT id, brief, status FROM runs r WHERE status IN ('created', 'queued', 'running')
+                   AND NOT EXISTS (SELECT 1 FROM run_queue q WHERE q.run_id = r.id)
+               UNION ALL
+               SELECT r.id, r.brief, r.status FROM runs r
+               WHERE r.status = 'waiting_hitl' AND NOT EXISTS (
+                   SELECT 1 FROM hitl_gates g WHERE g.run_id = r.id AND g.status = 'pending'
+               ) AND NOT EXISTS (SELECT 1 FROM run_queue q WHERE q.run_id = r.id)
+               ORDER BY id""",
+        )
+        rows = await cursor.fetchall()
+        return [dict(r) for r in rows]
 
 
 async def update_run_stage(run_id: str, status: str, stage: str) -> None:
-    db = await get_db()
-    try:
-        await db.execute(
-            "UPDATE runs SET status = ?, current_stage = ?, updated_at = datetime('now') WHERE id = ?",
+    """Record the run's progress; a cancelled run keeps its status."""
+    async def _update(db):
+        cursor = await db.execute(
+            "UPDATE runs SET status = ?, current_stage = ?, updated_at = datetime('now') WHERE id = ? AND status != 'cancelled'",
             (status, stage, run_id),
         )
-        await db.commit()
-    finally:
-        await db.close()
+        if not cursor.rowcount:
+            return []
+        return [await _record_event(db, run_id, "stage", {"status": status, "current_stage": stage})]
+
+    bus.publish(await write(_update))
+
+
+# --- Run queue ---
+#
+# Entries are claimed by scheduler slots in this or other processes (see
+# ``services.run_scheduler``). A claim is a lease held by ``worker_id`` until
+# ``lease_expires_at`` (unix time) and renewed by heartbeats; an expired lease
+# means the worker died or hung, and the entry goes back to the queue.
+
+async def enqueue_run(run_id: str) -> bool:
+    """Queue ``run_id`` for a scheduler slot at the run's priority; False if it does not exist or was cancelled.
+
+    A run already queued keeps its place. A run that is running is marked to
+    be queued again when it finishes, so a gate resolved before its slot was
+    released is not lost.
+    """
+    async def _enqueue(db):
+        cursor = await db.execute(
+            """INSERT OR IGNORE INTO run_queue (run_id, priority)
+               SELECT id, priority FROM runs WHERE id = ? AND status != 'cancelled'""",
+            (run_id,),
+        )
+        if not cursor.rowcount:
+            await db.execute("UPDATE run_queue SET requeue = 1 WHERE run_id = ? AND status = 'running'", (run_id,))
+            cursor = await db.execute("SELECT 1 FROM run_queue WHERE run_id = ?", (run_id,))
+            return await cursor.fetchone() is not None, []
+        cursor = await db.execute(
+            "UPDATE runs SET status = 'queued', updated_at = datetime('now') WHERE id = ? RETURNING current_stage",
+            (run_id,),
+        )
+        stage = (await cursor.fetchone())["current_stage"]
+        return True, [await _record_event(db, run_id, "stage", {"status": "queued", "current_stage": stage})]
+
+    queued, events = await write(_enqueue)
+    bus.publish(events)
+    return queued
+
+
+async def claim_queued_runs(limit: int, worker_id: str, lease: float, max_attempts: int) -> dict:
+    """Lease up to ``limit`` queued runs to ``worker_id`` for ``lease`` seconds.
+
+    Expired leases are reclaimed first: the entry is queued again in its old
+    place, unless it was already claimed ``max_attempts`` times, in which case
+    the run is abandoned with status ``error``. Runs are claimed highest
+    priority first and FIFO within a priority. Returns ``{"claimed",
+    "reclaimed", "abandoned"}``; each claimed entry has ``run_id``,
+    ``priority``, ``attempts`` and ``waited_s`` (time since it was queued).
+    """
+    now = time.time()
+
+    async def _claim(db):
+        events = []
+        cursor = await db.execute(
+            """DELETE FROM run_queue WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?
+               RETURNING run_id, worker_id, attempts""",
+            (now, max_attempts),
+        )
+        abandoned = [dict(r) for r in await cursor.fetchall()]
+        for entry in abandoned:
+            await db.execute(
+                "UPDATE runs SET status = 'error', current_stage = 'error', updated_at = datetime('now') WHERE id = ?",
+                (entry["run_id"],),
+            )
+            events.append(await _record_event(db, entry["run_id"], "stage", {"status": "error", "current_stage": "error"}))
+            events.append(await _insert_decision(db, entry["run_id"], "pipeline", "run_abandoned", {
+                "worker_id": entry["worker_id"], "attempts": entry["attempts"],
+            }))
+        cursor = await db.execute(
+            """UPDATE run_queue SET status = 'queued', worker_id = NULL, lease_expires_at = NULL, started_at = NULL
+               WHERE status = 'running' AND lease_expires_at < ?""",
+            (now,),
+        )
+        reclaimed = cursor.rowcount
+        cursor = await db.execute(
+            """UPDATE run_queue SET status = 'running', worker_id = ?, lease_expires_at = ?,
+                   attempts = attempts + 1, started_at = datetime('now')
+               WHERE id IN (
+                   SELECT id FROM run_queue WHERE status = 'queued' ORDER BY priority DESC, id LIMIT ?
+               )
+               RETURNING id, run_id, priority, attempts,
+                         (julianday('now') - julianday(enqueued_at)) * 86400 AS waited_s""",
+            (worker_id, now + lease, limit),
+        )
+        claimed = sorted((dict(r) for r in await cursor.fetchall()), key=lambda r: (-r["priority"], r["id"]))
+        return {"claimed": claimed, "reclaimed": reclaimed, "abandoned": len(abandoned)}, events
+
+    result, events = await write(_claim)
+    bus.publish(events)
+    return result
+
+
+async def renew_leases(worker_id: str, run_ids: list[str], lease: float) -> set[str]:
+    """Extend ``worker_id``'s leases on ``run_ids`` (heartbeat); returns the runs it still holds."""
+    if not run_ids:
+        return set()
+    placeholders = ", ".join("?" * len(run_ids))
+
+    async def _renew(db):
+        cursor = await db.execute(
+            f"""UPDATE run_queue SET lease_expires_at = ?
+                WHERE worker_id = ? AND status = 'running' AND run_id IN ({placeholders})
+                RETURNING run_id""",
+            (time.time() + lease, worker_id, *run_ids),
+        )
+        return {r["run_id"] for r in await cursor.fetchall()}
+
+    return await write(_renew)
+
+
+async def finish_queued_run(run_id: str, worker_id: str) -> bool:
+    """Release ``worker_id``'s entry for a run whose slot is done; True if it was queued again instead.
+
+    Does nothing if the lease was lost to another worker.
+    """
+    async def _finish(db):
+        cursor = await db.execute(
+            "DELETE FROM run_queue WHERE run_id = ? AND worker_id = ? AND status = 'running' AND requeue = 0",
+            (run_id, worker_id),
+        )
+        if cursor.rowcount:
+            return False
+        cursor = await db.execute(
+            """UPDATE run_queue SET status = 'queued', requeue = 0, worker_id = NULL, lease_expires_at = NULL,
+                   attempts = 0, started_at = NULL
+               WHERE run_id = ? AND worker_id = ? AND status = 'running'""",
+            (run_id, worker_id),
+        )
+        return cursor.rowcount > 0
+
+    return await write(_finish)
+
+
+async def release_queued_runs(worker_id: str) -> int:
+    """Queue again the runs ``worker_id`` still holds (shutdown), without counting the attempt."""
+    async def _release(db):
+        cursor = await db.execute(
+            """UPDATE run_queue SET status = 'queued', worker_id = NULL, lease_expires_at = NULL,
+                   attempts = MAX(attempts - 1, 0), started_at = NULL
+               WHERE worker_id = ? AND status = 'running'""",
+            (worker_id,),
+        )
+        return cursor.rowcount
+
+    return await write(_release)
+
+
+async def count_queued_runs() -> dict:
+    """Number of queue entries by status (``queued``, ``running``)."""
+    async with connection() as db:
+        cursor = await db.execute("SELECT status, COUNT(*) AS n FROM run_queue GROUP BY status")
+        counts = {r["status"]: r["n"] for r in await cursor.fetchall()}
+        return {"queued": counts.get("queued", 0), "running": counts.get("running", 0)}
+
+
+async def cancel_run(run_id: str) -> dict | None:
+    """Mark a run cancelled, resolve its pending HITL gates as cancelled and drop its queue entry.
+
+    Returns None if the run does not exist, ``{"cancelled": False, "status"}``
+    if it had already finished, else ``{"cancelled": True, "gate_ids",
+    "dequeued"}`` with ``dequeued`` the status of the removed queue entry.
+    Whatever is executing the run is stopped by the caller.
+    """
+    async def _cancel(db):
+        cursor = await db.execute("SELECT status, current_stage FROM runs WHERE id = ?", (run_id,))
+        run = await cursor.fetchone()
+        if run is None:
+            return None, []
+        if run["status"] in RUN_FINAL_STATUSES:
+            return {"cancelled": False, "status": run["status"]}, []
+        events = []
+        cursor = await db.execute(
+            """UPDATE hitl_gates SET status = 'cancelled', resolved_at = datetime('now')
+               WHERE run_id = ? AND status = 'pending' RETURNING *""",
+            (run_id,),
+        )
+        gates = [dict(r) for r in await cursor.fetchall()]
+        for gate in gates:
+            events.append(await _record_event(db, run_id, "hitl_gate", gate))
+        cursor = await db.execute("DELETE FROM run_queue WHERE run_id = ? RETURNING status", (run_id,))
+        entry = await cursor.fetchone()
+        dequeued = entry["status"] if entry else None
+        await db.execute(
+            "UPDATE runs SET status = 'cancelled', updated_at = datetime('now') WHERE id = ?", (run_id,)
+        )
+        events.append(await _record_event(db, run_id, "stage", {
+            "status": "cancelled", "current_stage": run["current_stage"],
+        }))
+        events.append(await _insert_decision(db, run_id, "pipeline", "run_cancelled", {
+            "previous_status": run["status"], "stage": run["current_stage"],
+            "gates": [gate["id"] for gate in gates], "dequeued": dequeued,
+        }))
+        return {"cancelled": True, "gate_ids": [gate["id"] for gate in gates], "dequeued": dequeued}, events
+
+    result, events = await write(_cancel)
+    bus.publish(events)
+    for gate_id in (result or {}).get("gate_ids", ()):
+        waiters.notify(gate_id)  # a run waiting in-process wakes up and ends
+    return result
 
 
 # --- Artifacts ---
 
 async def list_artifacts(run_id: str) -> list[dict]:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT * FROM artifacts WHERE run_id = ? ORDER BY created_at", (run_id,)
         )
@@ -81,13 +385,10 @@ async def list_artifacts(run_id: str) -> list[dict]:
             {**dict(r), "content": json.loads(r["content"]), "parent_ids": json.loads(r["parent_ids"])}
             for r in rows
         ]
-    finally:
-        await db.close()
 
 
 async def get_artifact(run_id: str, artifact_id: str) -> dict | None:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT * FROM artifacts WHERE run_id = ? AND id = ?",
             (run_id, artifact_id),
@@ -96,28 +397,67 @@ async def get_artifact(run_id: str, artifact_id: str) -> dict | None:
         if not row:
             return None
         return {**dict(row), "content": json.loads(row["content"]), "parent_ids": json.loads(row["parent_ids"])}
-    finally:
-        await db.close()
 
 
 async def save_artifact(
     run_id: str, artifact_id: str, agent: str, artifact_type: str,
     content: dict, parent_ids: list[str] | None = None,
 ) -> None:
-    db = await get_db()
-    try:
+    if _staging.get() is not None:
+        artifact = {"id": artifact_id, "type": artifact_type, "content": content, "parent_ids": parent_ids or []}
+        return await _stage(run_id, [("artifacts", {"agent": agent, "artifacts": [artifact]})])
+
+    async def _upsert(db):
         await db.execute(
             "INSERT OR REPLACE INTO artifacts (id, run_id, agent, type, content, parent_ids) VALUES (?, ?, ?, ?, ?, ?)",
             (artifact_id, run_id, agent, artifact_type, json.dumps(content), json.dumps(parent_ids or [])),
         )
-        await db.commit()
-    finally:
-        await db.close()
+        data = _artifact_event_data(run_id, artifact_id, agent, artifact_type, content, parent_ids or [])
+        return [await _record_event(db, run_id, "artifact", data)]
+
+    bus.publish(await write(_upsert))
+
+
+async def save_artifacts_bulk(
+    run_id: str, agent: str, artifacts: list[dict],
+    completed_details: dict | None = None,
+) -> None:
+    """Save many artifacts in one transaction.
+
+    Each item is ``{"id", "type", "content", "parent_ids"}``. When
+    ``completed_details`` is given, the agent's ``completed`` decision-log
+    entry is written in the same commit.
+    """
+    if _staging.get() is not None:
+        writes = [("artifacts", {"agent": agent, "artifacts": artifacts})] if artifacts else []
+        if completed_details is not None:
+            writes.append(("decision", {"agent": agent, "action": "completed", "details": completed_details}))
+        return await _stage(run_id, writes)
+
+    rows = [
+        (a["id"], run_id, agent, a["type"], json.dumps(a["content"]), json.dumps(a.get("parent_ids") or []))
+        for a in artifacts
+    ]
+
+    async def _upsert(db):
+        events = []
+        if rows:
+            await db.executemany(
+                "INSERT OR REPLACE INTO artifacts (id, run_id, agent, type, content, parent_ids) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            for a in artifacts:
+                data = _artifact_event_data(run_id, a["id"], agent, a["type"], a["content"], a.get("parent_ids") or [])
+                events.append(await _record_event(db, run_id, "artifact", data))
+        if completed_details is not None:
+            events.append(await _insert_decision(db, run_id, agent, "completed", completed_details))
+        return events
+
+    bus.publish(await write(_upsert))
 
 
 async def get_diagram(run_id: str, diagram_type: str) -> dict | None:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT content FROM artifacts WHERE run_id = ? AND type = ?",
             (run_id, f"diagram_{diagram_type}"),
@@ -126,15 +466,12 @@ async def get_diagram(run_id: str, diagram_type: str) -> dict | None:
         if not row:
             return None
         return json.loads(row["content"])
-    finally:
-        await db.close()
 
 
 # --- Decision Log ---
 
 async def list_decision_logs(run_id: str) -> list[dict]:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT * FROM decision_log WHERE run_id = ? ORDER BY timestamp", (run_id,)
         )
@@ -143,66 +480,163 @@ async def list_decision_logs(run_id: str) -> list[dict]:
             {**dict(r), "details": json.loads(r["details"])}
             for r in rows
         ]
-    finally:
-        await db.close()
+
+
+async def _insert_decision(db, run_id: str, agent: str, action: str, details: dict) -> dict:
+    """Insert a decision-log row and return its ``log`` run event."""
+    cursor = await db.execute(
+        "INSERT INTO decision_log (run_id, agent, action, details) VALUES (?, ?, ?, ?) RETURNING id, timestamp",
+        (run_id, agent, action, json.dumps(details)),
+    )
+    row = await cursor.fetchone()
+    entry = {"id": row["id"], "run_id": run_id, "agent": agent, "action": action,
+             "details": details, "timestamp": row["timestamp"]}
+    return await _record_event(db, run_id, "log", entry)
 
 
 async def log_decision(run_id: str, agent: str, action: str, details: dict | None = None) -> None:
-    db = await get_db()
+    if _staging.get() is not None:
+        return await _stage(run_id, [("decision", {"agent": agent, "action": action, "details": details or {}})])
+
+    async def _insert(db):
+        return [await _insert_decision(db, run_id, agent, action, details or {})]
+
+    bus.publish(await write(_insert))
+
+
+# --- Speculative staging ---
+
+@contextmanager
+def staged(stage: str) -> Iterator[None]:
+    """Divert artifact and decision-log writes made in the block to the staging area of ``stage``.
+
+    Nothing staged is visible in the run until ``commit_staged`` replays it.
+    """
+    token = _staging.set(stage)
     try:
-        await db.execute(
-            "INSERT INTO decision_log (run_id, agent, action, details) VALUES (?, ?, ?, ?)",
-            (run_id, agent, action, json.dumps(details or {})),
-        )
-        await db.commit()
+        yield
     finally:
-        await db.close()
+        _staging.reset(token)
+
+
+async def _stage(run_id: str, writes: list[tuple[str, dict]]) -> None:
+    stage = _staging.get()
+
+    async def _insert(db):
+        await db.executemany(
+            "INSERT INTO staged_writes (run_id, stage, kind, payload) VALUES (?, ?, ?, ?)",
+            [(run_id, stage, kind, json.dumps(payload)) for kind, payload in writes],
+        )
+
+    if writes:
+        await write(_insert)
+
+
+async def commit_staged(run_id: str, stage: str) -> int:
+    """Replay the writes staged for ``stage`` into the run in one transaction; return the artifacts saved."""
+    async def _commit(db):
+        cursor = await db.execute(
+            "SELECT kind, payload FROM staged_writes WHERE run_id = ? AND stage = ? ORDER BY id",
+            (run_id, stage),
+        )
+        events, saved = [], 0
+        for row in await cursor.fetchall():
+            payload = json.loads(row["payload"])
+            agent = payload["agent"]
+            if row["kind"] == "decision":
+                events.append(await _insert_decision(db, run_id, agent, payload["action"], payload["details"]))
+                continue
+            for a in payload["artifacts"]:
+                parent_ids = a.get("parent_ids") or []
+                await db.execute(
+                    "INSERT OR REPLACE INTO artifacts (id, run_id, agent, type, content, parent_ids) VALUES (?, ?, ?, ?, ?, ?)",
+                    (a["id"], run_id, agent, a["type"], json.dumps(a["content"]), json.dumps(parent_ids)),
+                )
+                data = _artifact_event_data(run_id, a["id"], agent, a["type"], a["content"], parent_ids)
+                events.append(await _record_event(db, run_id, "artifact", data))
+                saved += 1
+        await db.execute("DELETE FROM staged_writes WHERE run_id = ? AND stage = ?", (run_id, stage))
+        return saved, events
+
+    saved, events = await write(_commit)
+    bus.publish(events)
+    return saved
+
+
+async def discard_staged(run_id: str, stage: str) -> None:
+    async def _delete(db):
+        await db.execute("DELETE FROM staged_writes WHERE run_id = ? AND stage = ?", (run_id, stage))
+
+    await write(_delete)
+
+
+async def count_staged(run_id: str, stage: str) -> int:
+    async with connection() as db:
+        cursor = await db.execute(
+            "SELECT COUNT(*) FROM staged_writes WHERE run_id = ? AND stage = ?", (run_id, stage)
+        )
+        return (await cursor.fetchone())[0]
+
+
+async def get_speculation_stats(run_id: str) -> dict:
+    """Hit rate and wasted tokens of the speculative stages of a run, from its decision log."""
+    async with connection() as db:
+        cursor = await db.execute(
+            """SELECT action, COUNT(*) AS n, COALESCE(SUM(json_extract(details, '$.tokens')), 0) AS tokens
+               FROM decision_log
+               WHERE run_id = ? AND action IN ('speculation_committed', 'speculation_discarded')
+               GROUP BY action""",
+            (run_id,),
+        )
+        rows = {r["action"]: r for r in await cursor.fetchall()}
+    hits = rows["speculation_committed"]["n"] if "speculation_committed" in rows else 0
+    misses = rows["speculation_discarded"]["n"] if "speculation_discarded" in rows else 0
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        "wasted_tokens": rows["speculation_discarded"]["tokens"] if misses else 0,
+    }
 
 
 # --- HITL Gates ---
 
 async def get_pending_hitl(run_id: str) -> dict | None:
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute(
             "SELECT * FROM hitl_gates WHERE run_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
             (run_id,),
         )
         row = await cursor.fetchone()
         return dict(row) if row else None
-    finally:
-        await db.close()
 
 
 async def create_hitl_gate(run_id: str, stage: str) -> int:
     """Create a HITL gate and return its ID."""
-    db = await get_db()
-    try:
+    async def _insert(db):
         cursor = await db.execute(
-            "INSERT INTO hitl_gates (run_id, stage) VALUES (?, ?)",
+            "INSERT INTO hitl_gates (run_id, stage) VALUES (?, ?) RETURNING *",
             (run_id, stage),
         )
-        await db.commit()
-        return cursor.lastrowid
-    finally:
-        await db.close()
+        gate = dict(await cursor.fetchone())
+        return gate["id"], [await _record_event(db, run_id, "hitl_gate", gate)]
+
+    gate_id, events = await write(_insert)
+    bus.publish(events)
+    return gate_id
 
 
 async def get_hitl_gate_by_id(gate_id: int) -> dict | None:
     """Get a specific HITL gate by its ID."""
-    db = await get_db()
-    try:
+    async with connection() as db:
         cursor = await db.execute("SELECT * FROM hitl_gates WHERE id = ?", (gate_id,))
         row = await cursor.fetchone()
         return dict(row) if row else None
-    finally:
-        await db.close()
 
 
 async def resolve_hitl(run_id: str, status: str, feedback: str | None) -> dict | None:
     """Resolve the current pending HITL gate. Returns {status, gate_id} or None if no pending gate."""
-    db = await get_db()
-    try:
+    async def _resolve(db):
         cursor = await db.execute(
             "SELECT id FROM hitl_gates WHERE run_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
             (run_id,),
@@ -210,11 +644,107 @@ async def resolve_hitl(run_id: str, status: str, feedback: str | None) -> dict |
         gate = await cursor.fetchone()
         if not gate:
             return None
-        await db.execute(
-            "UPDATE hitl_gates SET status = ?, feedback = ?, resolved_at = datetime('now') WHERE id = ?",
+        cursor = await db.execute(
+            "UPDATE hitl_gates SET status = ?, feedback = ?, resolved_at = datetime('now') WHERE id = ? RETURNING *",
             (status, feedback, gate["id"]),
         )
-        await db.commit()
-        return {"status": status, "gate_id": gate["id"]}
-    finally:
-        await db.close()
+        resolved = dict(await cursor.fetchone())
+        return {"status": status, "gate_id": gate["id"]}, [await _record_event(db, run_id, "hitl_gate", resolved)]
+
+    outcome = await write(_resolve)
+    if not outcome:
+        return None
+    result, events = outcome
+    bus.publish(events)
+    waiters.notify(result["gate_id"])  # wake the pipeline waiting on this gate
+    return result
+
+
+# --- Run events ---
+
+async def list_run_events(run_id: str, after_id: int = 0, limit: int = 500) -> list[dict]:
+    """Events of a run with ``id > after_id``, oldest first (SSE replay)."""
+    async with connection() as db:
+        cursor = await db.execute(
+            "SELECT * FROM run_events WHERE run_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (run_id, after_id, limit),
+        )
+        rows = await cursor.fetchall()
+        return [{**dict(r), "data": json.loads(r["data"])} for r in rows]
+
+
+# --- LLM usage ---
+
+USAGE_ALL_RUNS = "*"  # llm_usage scope holding the totals across runs
+
+
+async def record_llm_call(run_id: str | None, agent: str, call: dict, attempt: int, cost_usd: float) -> None:
+    """Insert an ``llm_calls`` row and add it to the run's and the global ``llm_usage`` counters."""
+    async def _insert(db):
+        await db.execute(
+            """INSERT INTO llm_calls (run_id, agent, provider, model, attempt, prompt_tokens,
+                                      completion_tokens, usage_estimated, latency_s, cost_usd)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (run_id, agent, call["provider"], call["model"], attempt, call["prompt_tokens"],
+             call["completion_tokens"], int(call.get("usage_estimated", False)), call["latency_s"], cost_usd),
+        )
+        scopes = [USAGE_ALL_RUNS] + ([run_id] if run_id else [])
+        await db.executemany(
+            """INSERT INTO llm_usage (scope, agent, model, calls, retries, prompt_tokens, completion_tokens,
+                                      latency_s, latency_max_s, cost_usd)
+               VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (scope, agent, model) DO UPDATE SET
+                   calls = calls + 1,
+                   retries = retries + excluded.retries,
+                   prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                   completion_tokens = completion_tokens + excluded.completion_tokens,
+                   latency_s = latency_s + excluded.latency_s,
+                   latency_max_s = MAX(latency_max_s, excluded.latency_max_s),
+                   cost_usd = cost_usd + excluded.cost_usd""",
+            [(scope, agent, call["model"], int(attempt > 0), call["prompt_tokens"], call["completion_tokens"],
+              call["latency_s"], call["latency_s"], cost_usd) for scope in scopes],
+        )
+
+    await write(_insert)
+
+
+def _usage_totals(rows: list[dict]) -> dict:
+    calls = sum(r["calls"] for r in rows)
+    prompt_tokens = sum(r["prompt_tokens"] for r in rows)
+    completion_tokens = sum(r["completion_tokens"] for r in rows)
+    latency = sum(r["latency_s"] for r in rows)
+    return {
+        "calls": calls,
+        "retries": sum(r["retries"] for r in rows),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "latency_s": round(latency, 6),
+        "latency_avg_s": round(latency / calls, 6) if calls else 0.0,
+        "latency_max_s": round(max((r["latency_max_s"] for r in rows), default=0.0), 6),
+        "cost_usd": round(sum(r["cost_usd"] for r in rows), 6),
+    }
+
+
+async def get_llm_usage(scope: str = USAGE_ALL_RUNS) -> dict:
+    """Token, latency and cost rollup of a run (or all runs), overall and per agent and model."""
+    async with connection() as db:
+        cursor = await db.execute("SELECT * FROM llm_usage WHERE scope = ? ORDER BY agent, model", (scope,))
+        rows = [dict(r) for r in await cursor.fetchall()]
+    by_agent: dict[str, list] = {}
+    by_model: dict[str, list] = {}
+    for row in rows:
+        by_agent.setdefault(row["agent"], []).append(row)
+        by_model.setdefault(row["model"], []).append(row)
+    return {
+        **_usage_totals(rows),
+        "by_agent": {agent: _usage_totals(group) for agent, group in by_agent.items()},
+        "by_model": {model: _usage_totals(group) for model, group in by_model.items()},
+    }
+
+
+async def list_llm_calls(run_id: str) -> list[dict]:
+    async with connection() as db:
+        cursor = await db.execute("SELECT * FROM llm_calls WHERE run_id = ? ORDER BY id", (run_id,))
+        rows = await cursor.fetchall()
+        return [{**dict(r), "usage_estimated": bool(r["usage_estimated"])} for r in rows]
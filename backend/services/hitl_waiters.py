@@ -0,0 +1,80 @@
+"""In-process registry that wakes pipeline coroutines waiting on HITL gates.
+
+``db_service.resolve_hitl`` calls ``notify(gate_id)`` after committing, so the
+waiting ``_hitl_node`` resumes immediately instead of polling the database.
+A slow fallback poll still re-checks the gate in case a notification is
+missed (e.g. the gate was resolved by another process).
+"""
+
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+
+HITL_FALLBACK_POLL_INTERVAL = float(os.getenv("HITL_FALLBACK_POLL_INTERVAL", "30"))  # seconds
+
+
+class GateWaiterRegistry:
+    def __init__(self):
+        self._events: dict[int, asyncio.Event] = {}
+        self._notified_at: dict[int, float] = {}
+        self._wakeups = 0
+        self._fallback_polls = 0
+        self._wake_latency_total = 0.0
+        self._wake_latency_max = 0.0
+        self._wake_latency_last = 0.0
+
+    def notify(self, gate_id: int) -> None:
+        """Wake the coroutine waiting on ``gate_id``, if any."""
+        event = self._events.get(gate_id)
+        if event is None:
+            return
+        self._notified_at[gate_id] = time.monotonic()
+        event.set()
+
+    async def wait(
+        self,
+        gate_id: int,
+        fetch_gate: Callable[[], Awaitable[dict | None]],
+        fallback_interval: float = HITL_FALLBACK_POLL_INTERVAL,
+    ) -> dict:
+        """Block until ``fetch_gate()`` returns a resolved gate, then return it."""
+        event = asyncio.Event()
+        self._events[gate_id] = event
+        try:
+            while True:
+                event.clear()  # cleared before the check so a concurrent notify is not lost
+                gate = await fetch_gate()
+                if gate and gate["status"] != "pending":
+                    self._record_wake(gate_id)
+                    return gate
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=fallback_interval)
+                except asyncio.TimeoutError:
+                    self._fallback_polls += 1
+        finally:
+            self._events.pop(gate_id, None)
+            self._notified_at.pop(gate_id, None)
+
+    def _record_wake(self, gate_id: int) -> None:
+        notified_at = self._notified_at.get(gate_id)
+        if notified_at is None:
+            return  # resolved before we started waiting, or found by the fallback poll
+        latency = time.monotonic() - notified_at
+        self._wakeups += 1
+        self._wake_latency_total += latency
+        self._wake_latency_max = max(self._wake_latency_max, latency)
+        self._wake_latency_last = latency
+
+    def stats(self) -> dict:
+        return {
+            "waiters": len(self._events),
+            "wakeups": self._wakeups,
+            "fallback_polls": self._fallback_polls,
+            "wake_latency_avg_s": round(self._wake_latency_total / self._wakeups, 6) if self._wakeups else 0.0,
+            "wake_latency_max_s": round(self._wake_latency_max, 6),
+            "wake_latency_last_s": round(self._wake_latency_last, 6),
+        }
+
+
+waiters = GateWaiterRegistry()
@@ -0,0 +1,146 @@
+"""Local repair of almost-JSON LLM output, tried before re-asking the model.
+
+``repair_json`` rewrites the text in one pass and fixes, outside strings:
+prose before or after the root value, smart quotes used as string
+delimiters and trailing commas; inside strings: raw newlines and tabs
+(common in Mermaid code) and invalid backslash escapes. If the text ends
+before the root value is closed, it is cut back to the last complete
+element and the open brackets are closed, so every array item that was
+fully written is recovered (a partially written object inside an array is
+dropped rather than kept without its remaining fields).
+"""
+
+import json
+from collections import Counter
+from typing import Any
+
+_OPENING_QUOTES = "“„"           # “ „
+_CLOSING_QUOTES = "”“"           # ” (and “ used as a closer)
+_VALID_ESCAPES = set('"\\/bfnrtu')
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def repair_json(raw: str) -> tuple[Any, list[str]]:
+    """Parse ``raw`` after repairing it; return the value and the kinds of repair applied.
+
+    Raises ``json.JSONDecodeError`` when the text cannot be repaired.
+    """
+    text, repairs = _repair(raw)
+    return json.loads(text), repairs
+
+
+def _repair(raw: str) -> tuple[str, list[str]]:
+    repairs: set[str] = set()
+    start = min((i for i in (raw.find("{"), raw.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise json.JSONDecodeError("no JSON object or array found", raw, 0)
+    if raw[:start].strip():
+        repairs.add("prose")
+
+    out: list[str] = []
+    stack: list[str] = []
+    # (length of out, open containers) after each complete element: where truncated text is cut
+    safe_point: tuple[int, tuple[str, ...]] = (0, ())
+    in_string = False
+    string_closer = '"'
+    i = start
+    while i < len(raw):
+        ch = raw[i]
+        if in_string:
+            if ch == "\\":
+                nxt = raw[i + 1] if i + 1 < len(raw) else ""
+                if nxt in _VALID_ESCAPES:
+                    out.append(ch + nxt)
+                    i += 2
+                    continue
+                out.append("\\\\")
+                repairs.add("invalid_escape")
+            elif ch == '"' and string_closer != '"':
+                out.append('\\"')  # straight quote inside a smart-quoted string
+            elif ch == string_closer or (string_closer != '"' and ch in _CLOSING_QUOTES):
+                out.append('"')
+                in_string = False
+            elif ch in _CONTROL_ESCAPES:
+                out.append(_CONTROL_ESCAPES[ch])
+                repairs.add("control_chars")
+            else:
+                out.append(ch)
+        elif ch == '"' or ch in _OPENING_QUOTES:
+            if ch != '"':
+                repairs.add("smart_quotes")
+            string_closer = ch if ch == '"' else "”"
+            in_string = True
+            out.append('"')
+        elif ch in "{[":
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "}]":
+            if not stack:
+                break
+            _drop_trailing_comma(out, repairs)
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break  # root value closed: anything after it is prose
+            if _whole_items(stack):
+                safe_point = (len(out), tuple(stack))
+        elif ch == ",":
+            if _whole_items(stack):
+                safe_point = (len(out), tuple(stack))
+            out.append(ch)
+        else:
+            out.append(ch)
+        i += 1
+
+    if stack:
+        repairs.add("truncated")
+        length, open_containers = safe_point
+        del out[length:]
+        _drop_trailing_comma(out, repairs)
+        if out and out[-1] == ":":
+            raise json.JSONDecodeError("truncated inside an object member", raw, len(raw))
+        out.extend(_CLOSERS[c] for c in reversed(open_containers))
+    elif raw[i + 1:].strip():
+        repairs.add("prose")
+    return "".join(out), sorted(repairs)
+
+
+def _whole_items(stack: list[str]) -> bool:
+    """False while inside an object that is an array element, which truncation would leave incomplete."""
+    return not any(outer == "[" and inner == "{" for outer, inner in zip(stack, stack[1:]))
+
+
+def _drop_trailing_comma(out: list[str], repairs: set[str]) -> None:
+    j = len(out) - 1
+    while j >= 0 and out[j].isspace():
+        j -= 1
+    if j >= 0 and out[j] == ",":
+        del out[j]
+        repairs.add("trailing_comma")
+
+
+class JSONOutcomes:
+    """How LLM JSON responses were obtained, exposed via ``/api/metrics``."""
+
+    def __init__(self):
+        self._outcomes: Counter[str] = Counter()
+        self._repairs: Counter[str] = Counter()
+
+    def record(self, outcome: str, repairs: list[str] = (), count: int = 1) -> None:
+        """``outcome`` is ``parsed``, ``repaired``, ``reask_parsed``, ``reask_repaired`` or ``failed``,
+        or ``schema_fixed``/``schema_dropped`` counting parts that failed schema validation."""
+        self._outcomes[outcome] += count
+        self._repairs.update(repairs)
+
+    def stats(self) -> dict:
+        return {
+            "outcomes": dict(self._outcomes),
+            "repairs": dict(self._repairs),
+            # Responses repaired locally on the first try would otherwise have needed a re-ask
+            "reasks_saved": self._outcomes["repaired"],
+            "reasks": self._outcomes["reask_parsed"] + self._outcomes["reask_repaired"] + self._outcomes["failed"],
+        }
+
+
+json_outcomes = JSONOutcomes()
@@ -0,0 +1,80 @@
+"""Incremental extraction of array items from a JSON document being streamed.
+
+The LLM answers with one JSON object such as ``{"artifacts": [{...}, {...}]}``.
+``ArrayItemExtractor`` is fed the text as it arrives and returns every element
+of the watched top-level arrays as soon as that element's closing bracket has
+been received, so callers can act on it before the completion finishes.
+Text before the root object (e.g. a markdown code fence) is ignored.
+"""
+
+import json
+from typing import Any, Iterable
+
+
+class ArrayItemExtractor:
+    def __init__(self, keys: Iterable[str] = ("artifacts",)):
+        self.keys = set(keys)
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_string: str | None = None
+        self._key: str | None = None        # top-level key whose value is being read
+        self._collecting: str | None = None  # watched key whose array we are inside
+        self._item_start = -1
+        self._done = False
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        """Consume ``chunk`` and return the ``(key, item)`` pairs completed by it."""
+        self._text += chunk
+        text = self._text
+        items: list[tuple[str, Any]] = []
+
+        i = self._pos
+        while i < len(text) and not self._done:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        try:
+                            self._last_string = json.loads(text[self._string_start:i + 1])
+                        except ValueError:
+                            self._last_string = None
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch in "{[":
+                if self._depth > 0 or ch == "{":  # anything before the root object is skipped
+                    if self._depth == 1 and ch == "[" and self._key in self.keys:
+                        self._collecting = self._key
+                    elif self._depth == 2 and self._collecting is not None:
+                        self._item_start = i
+                    self._depth += 1
+            elif ch in "}]" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 2 and self._collecting is not None and self._item_start >= 0:
+                    try:
+                        items.append((self._collecting, json.loads(text[self._item_start:i + 1])))
+                    except ValueError:
+                        pass  # malformed item: left to the full-document parse
+                    self._item_start = -1
+                elif self._depth == 1:
+                    self._collecting = None
+                    self._key = None
+                elif self._depth == 0:
+                    self._done = True
+            elif ch == ":" and self._depth == 1:
+                self._key = self._last_string
+            elif ch == "," and self._depth == 1:
+                self._key = None
+            i += 1
+
+        self._pos = i
+        return items
@@ -0,0 +1,133 @@
+"""Persistent cache of parsed LLM JSON responses, stored in SQLite.
+
+Entries are keyed on a hash of everything that determines the completion
+(model, base URL, system instruction, prompt, temperature and the output
+schema the response was validated against). They expire after
+``LLM_CACHE_TTL`` seconds, and the least recently used ones are evicted once
+the table grows past ``LLM_CACHE_MAX_ENTRIES`` rows or ``LLM_CACHE_MAX_BYTES``.
+Only responses that parsed as JSON are stored, so a malformed completion is
+never replayed.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from database import connection, write
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def cache_key(model: str, base_url: str, system_instruction: str, prompt: str, temperature: float,
+              schema: str = "") -> str:
+    parts = [model, base_url, system_instruction, prompt, temperature] + ([schema] if schema else [])
+    payload = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    def __init__(self, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 max_bytes: int = LLM_CACHE_MAX_BYTES, enabled: bool = LLM_CACHE_ENABLED):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._hits = 0
+        self._misses = 0
+        self._bypasses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._bytes_served = 0
+        self._bytes_stored = 0
+
+    def record_bypass(self) -> None:
+        self._bypasses += 1
+
+    async def get(self, key: str) -> dict | list | None:
+        """Return the cached value for ``key``, or None on a miss or expired entry."""
+        now = time.time()
+        async with connection() as db:
+            cursor = await db.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl),
+            )
+            row = await cursor.fetchone()
+        if row is None:
+            self._misses += 1
+            return None
+
+        async def _touch(db):
+            await db.execute("UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?", (now, key))
+
+        await write(_touch)
+        self._hits += 1
+        self._bytes_served += len(row["response"].encode("utf-8"))
+        return json.loads(row["response"])
+
+    async def put(self, key: str, model: str, value: dict | list) -> None:
+        """Store a parsed response and evict expired and least recently used entries."""
+        response = json.dumps(value, ensure_ascii=False)
+        size = len(response.encode("utf-8"))
+        now = time.time()
+
+        async def _put(db):
+            await db.execute(
+                """INSERT OR REPLACE INTO llm_cache (key, model, response, size_bytes, created_at, last_used_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (key, model, response, size, now, now),
+            )
+            cursor = await db.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,))
+            evicted = cursor.rowcount
+            cursor = await db.execute(
+                """DELETE FROM llm_cache WHERE key IN (
+                       SELECT key FROM (
+                           SELECT key,
+                                  ROW_NUMBER() OVER lru AS position,
+                                  SUM(size_bytes) OVER lru AS running_bytes
+                           FROM llm_cache
+                           WINDOW lru AS (ORDER BY last_used_at DESC, key)
+                       ) WHERE position > ? OR running_bytes > ?
+                   )""",
+                (self.max_entries, self.max_bytes),
+            )
+            return evicted + cursor.rowcount
+
+        self._evictions += await write(_put)
+        self._stores += 1
+        self._bytes_stored += size
+
+    async def clear(self) -> int:
+        async def _clear(db):
+            cursor = await db.execute("DELETE FROM llm_cache")
+            return cursor.rowcount
+
+        return await write(_clear)
+
+    async def stats(self) -> dict:
+        async with connection() as db:
+            cursor = await db.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM llm_cache")
+            entries, total_bytes = await cursor.fetchone()
+        lookups = self._hits + self._misses
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "bytes": total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl,
+            "hits": self._hits,
+            "misses": self._misses,
+            "bypasses": self._bypasses,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            "stores": self._stores,
+            "evictions": self._evictions,
+            "bytes_served": self._bytes_served,
+            "bytes_stored": self._bytes_stored,
+        }
+
+
+llm_cache = LLMResponseCache()
@@ -0,0 +1,199 @@
+"""Admission control for LLM calls: in-flight cap, rate limits and priority lanes.
+
+Each provider in ``llm_providers`` owns one limiter, and every call to it
+first acquires a slot there. A slot is granted when fewer than ``limit`` calls
+are in flight and both token buckets (requests/min and tokens/min) can cover
+the call. Waiters are served strictly by lane, then FIFO, so a re-run a reviewer is waiting on (``PRIORITY_INTERACTIVE``)
+goes ahead of fresh batch runs.
+
+``limit`` adapts AIMD-style: it grows by ~1 per window of successful calls up
+to ``LLM_MAX_IN_FLIGHT`` and halves on every 429, and a ``retry-after`` header
+pauses all admissions until it has elapsed.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_RPM = float(os.getenv("LLM_RPM", "60"))  # 0 disables the requests/min bucket
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))  # 0 disables the tokens/min bucket
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+_LANES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+_priority: ContextVar[int] = ContextVar("llm_priority", default=PRIORITY_BATCH)
+
+
+@contextmanager
+def llm_priority(priority: int) -> Iterator[None]:
+    """Run the LLM calls made inside the block in the given lane."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Continuous-refill bucket holding up to one minute's worth of ``rate_per_min``."""
+
+    def __init__(self, rate_per_min: float):
+        self.rate = rate_per_min / 60.0
+        self.capacity = rate_per_min
+        self.tokens = rate_per_min
+        self._updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """Seconds until ``amount`` tokens are available (0 if they already are)."""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)  # an oversized call waits for a full bucket, not forever
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        if self.enabled:
+            self._refill()
+            self.tokens -= amount  # may go negative when actual usage exceeds the estimate
+
+
+class LLMLimiter:
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, rpm: float = LLM_RPM, tpm: float = LLM_TPM):
+        self.max_in_flight = max_in_flight
+        self.limit = float(max_in_flight)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        # Counters exposed through stats()
+        self._admitted = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._wait_time_by_lane = {lane: 0.0 for lane in _LANES}
+        self._admitted_by_lane = {lane: 0 for lane in _LANES}
+        self._rate_limited = 0
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0, priority: int | None = None) -> AsyncIterator[None]:
+        """Hold one admission for the duration of a provider call."""
+        await self.acquire(estimated_tokens, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, estimated_tokens: int = 0, priority: int | None = None) -> None:
+        if priority is None:
+            priority = _priority.get()
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), estimated_tokens, future))
+        self._dispatch()
+        if not future.done():
+            self._waits += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # admitted just as we were cancelled: give the slot back
+            else:
+                self._waiters = [w for w in self._waiters if w[3] is not future]
+                heapq.heapify(self._waiters)
+                self._dispatch()
+            raise
+        waited = time.monotonic() - started
+        self._wait_time_total += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+        self._wait_time_by_lane[priority] = self._wait_time_by_lane.get(priority, 0.0) + waited
+        self._admitted_by_lane[priority] = self._admitted_by_lane.get(priority, 0) + 1
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit waiters from the head of the queue while capacity allows."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _, _, estimated_tokens, future = self._waiters[0]
+            if future.done():  # cancelled while queued
+                heapq.heappop(self._waiters)
+                continue
+            if self._in_flight >= int(self.limit):
+                return  # release() dispatches again
+            delay = max(
+                self._paused_until - time.monotonic(),
+                self.requests.delay_for(1),
+                self.tokens.delay_for(estimated_tokens),
+            )
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+            self._in_flight += 1
+            self._admitted += 1
+            future.set_result(None)
+
+    def record_tokens(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Charge the tokens/min bucket for the difference between estimate and actual usage."""
+        self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def on_success(self) -> None:
+        # Additive increase: roughly +1 per ``limit`` successful calls
+        self.limit = min(float(self.max_in_flight), self.limit + 1.0 / max(self.limit, 1.0))
+
+    def on_rate_limited(self, retry_after: float | None = None) -> None:
+        # Multiplicative decrease, plus a global pause if the provider told us how long to wait
+        self._rate_limited += 1
+        self.limit = max(1.0, self.limit / 2)
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def stats(self) -> dict:
+        queued = {name: 0 for name in _LANES.values()}
+        for priority, _, _, future in self._waiters:
+            if not future.done():
+                queued[_LANES.get(priority, str(priority))] += 1
+        return {
+            "in_flight": self._in_flight,
+            "limit": round(self.limit, 2),
+            "max_in_flight": self.max_in_flight,
+            "queued": queued,
+            "queue_depth": sum(queued.values()),
+            "admitted": self._admitted,
+            "waits": self._waits,
+            "wait_time_total_s": round(self._wait_time_total, 6),
+            "wait_time_max_s": round(self._wait_time_max, 6),
+            "wait_time_avg_s_by_lane": {
+                name: round(self._wait_time_by_lane[lane] / self._admitted_by_lane[lane], 6)
+                if self._admitted_by_lane[lane] else 0.0
+                for lane, name in _LANES.items()
+            },
+            "rate_limited": self._rate_limited,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
+
@@ -0,0 +1,173 @@
+"""Per-agent model and temperature selection, and per-agent usage counters.
+
+Graph nodes run each agent inside ``llm_agent("<name>_agent")``; every LLM call
+made in that block uses the agent's selection. Selections come from
+``LLM_AGENT_MODELS_FILE`` (YAML) and are overridden by env vars named after
+the agent: ``DESIGN_AGENT_MODEL``, ``DESIGN_AGENT_TEMPERATURE``,
+``DESIGN_AGENT_PROVIDER`` and the ``DESIGN_AGENT_RETRY_*`` variants. YAML
+format::
+
+    default:
+      temperature: 0.3
+    agents:
+      product_agent:
+        model: llama-3.1-8b-instant
+        temperature: 0.2
+      design_agent:
+        model: llama-3.3-70b-versatile
+        provider: groq          # only route to this provider of the pool
+        context_tokens: 16000   # budget for upstream artifacts in the prompt
+        retry:                  # used by the JSON re-ask
+          temperature: 0.0
+    prices:                     # USD per million prompt / completion tokens
+      llama-3.3-70b-versatile: [0.59, 0.79]
+
+Unset fields fall back to the ``default`` section, then to the routed
+provider's own model and ``LLM_TEMPERATURE``. Set ``provider`` whenever the
+pool mixes vendors, since a model name is only meaningful to one of them.
+``LLM_PRICES`` (JSON, same shape as ``prices``) adds to or overrides the
+YAML prices; models without a price are accounted at zero cost.
+"""
+
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+import yaml
+
+from services.stage_metrics import Timing
+
+LLM_AGENT_MODELS_FILE = os.getenv("LLM_AGENT_MODELS_FILE", "")
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
+LLM_PRICES = os.getenv("LLM_PRICES", "")
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "12000"))
+
+_FIELDS = ("model", "temperature", "provider")
+
+_agent: ContextVar[str | None] = ContextVar("llm_agent", default=None)
+_run_id: ContextVar[str | None] = ContextVar("llm_run_id", default=None)
+
+
+@contextmanager
+def llm_agent(agent: str, run_id: str | None = None) -> Iterator[None]:
+    """Attribute the LLM calls made inside the block to ``agent`` (and ``run_id``)."""
+    agent_token = _agent.set(agent)
+    run_token = _run_id.set(run_id)
+    try:
+        yield
+    finally:
+        _run_id.reset(run_token)
+        _agent.reset(agent_token)
+
+
+def current_agent() -> str | None:
+    return _agent.get()
+
+
+def current_run_id() -> str | None:
+    return _run_id.get()
+
+
+def _section(entry: dict | None) -> dict:
+    return {field: entry[field] for field in _FIELDS if entry and entry.get(field) is not None}
+
+
+def _env_section(prefix: str) -> dict:
+    section = {}
+    for field in _FIELDS:
+        value = os.getenv(f"{prefix}{field.upper()}")
+        if value:
+            section[field] = value
+    return section
+
+
+class ModelSelector:
+    def __init__(self, config: dict | None = None):
+        config = config or {}
+        self.default = _section(config.get("default"))
+        self.default_context_tokens = int((config.get("default") or {}).get("context_tokens", LLM_CONTEXT_TOKENS))
+        self.agents = {name: entry or {} for name, entry in (config.get("agents") or {}).items()}
+        self.prices = {model: (float(prompt), float(completion))
+                       for model, (prompt, completion) in (config.get("prices") or {}).items()}
+
+    def select(self, agent: str | None, attempt: int = 0) -> dict:
+        """Model, temperature and provider for ``agent``'s call number ``attempt`` (0-based).
+
+        ``model`` and ``provider`` are None when the routed provider's defaults apply.
+        """
+        selection = {"model": None, "temperature": LLM_TEMPERATURE, "provider": None}
+        selection.update(self.default)
+        if agent:
+            entry = self.agents.get(agent, {})
+            prefix = f"{agent.upper()}_"
+            selection.update(_section(entry))
+            selection.update(_env_section(prefix))
+            if attempt > 0:
+                selection.update(_section(entry.get("retry")))
+                selection.update(_env_section(prefix + "RETRY_"))
+        selection["temperature"] = float(selection["temperature"])
+        return selection
+
+    def context_tokens(self, agent: str) -> int:
+        """Token budget for the upstream artifacts embedded in ``agent``'s prompt."""
+        value = (os.getenv(f"{agent.upper()}_CONTEXT_TOKENS")
+                 or self.agents.get(agent, {}).get("context_tokens")
+                 or self.default_context_tokens)
+        return int(value)
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """USD cost of a call, from the per-million-token prices of ``model``."""
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def load_selector() -> ModelSelector:
+    config = {}
+    if LLM_AGENT_MODELS_FILE:
+        with open(LLM_AGENT_MODELS_FILE, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    if LLM_PRICES:
+        config["prices"] = {**(config.get("prices") or {}), **json.loads(LLM_PRICES)}
+    return ModelSelector(config)
+
+
+class AgentUsage:
+    """Calls, latency and tokens per agent and model, exposed via ``/api/metrics``."""
+
+    def __init__(self):
+        self._latency: dict[tuple[str, str], Timing] = defaultdict(Timing)
+        self._prompt_tokens: dict[tuple[str, str], int] = defaultdict(int)
+        self._completion_tokens: dict[tuple[str, str], int] = defaultdict(int)
+        self._retries: dict[str, int] = defaultdict(int)
+
+    def record(self, agent: str | None, call: dict, attempt: int = 0) -> None:
+        key = (agent or "unattributed", call["model"])
+        self._latency[key].record(call["latency_s"])
+        self._prompt_tokens[key] += call["prompt_tokens"]
+        self._completion_tokens[key] += call["completion_tokens"]
+        if attempt > 0:
+            self._retries[key[0]] += 1
+
+    def stats(self) -> dict:
+        agents: dict[str, dict] = {}
+        for (agent, model), timing in sorted(self._latency.items()):
+            entry = agents.setdefault(agent, {"calls": 0, "retries": self._retries.get(agent, 0),
+                                              "prompt_tokens": 0, "completion_tokens": 0, "models": {}})
+            prompt, completion = self._prompt_tokens[(agent, model)], self._completion_tokens[(agent, model)]
+            entry["calls"] += timing.count
+            entry["prompt_tokens"] += prompt
+            entry["completion_tokens"] += completion
+            entry["models"][model] = {
+                "latency": timing.stats(),
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "avg_completion_tokens": round(completion / timing.count, 1),
+            }
+        return agents
+
+
+selector = load_selector()
+agent_usage = AgentUsage()
@@ -0,0 +1,446 @@
+"""Pool of OpenAI-compatible providers with latency-aware routing and failover.
+
+Providers come from ``LLM_PROVIDERS_FILE`` (YAML) or from env vars:
+``LLM_PROVIDERS=groq,deepseek`` with ``LLM_<NAME>_BASE_URL``,
+``LLM_<NAME>_MODEL`` and ``LLM_<NAME>_API_KEY``. With neither set, the pool
+holds the single provider described by ``LLM_BASE_URL``/``LLM_MODEL``/
+``LLM_API_KEY``, as before. YAML format::
+
+    providers:
+      - name: groq
+        base_url: https://api.groq.com/openai/v1
+        model: llama-3.3-70b-versatile
+        api_key_env: GROQ_API_KEY      # or api_key: ...
+        max_in_flight: 8               # optional limiter overrides
+        rpm: 30
+        tpm: 0
+        json_mode: true                # send response_format for JSON calls
+
+Each provider keeps EWMAs of its latency and error rate plus a window of
+recent latencies. Calls go to the healthy provider with the lowest
+error-weighted latency. ``LLM_BREAKER_THRESHOLD`` consecutive failures open
+its circuit breaker for ``LLM_BREAKER_COOLDOWN`` seconds, after which one
+trial call is let through. With ``LLM_HEDGE`` enabled, a call still running
+after the provider's p90 latency is duplicated on the next best provider and
+the slower of the two is cancelled.
+
+JSON calls ask for ``response_format={"type": "json_object"}`` on providers
+with ``json_mode`` enabled (``LLM_JSON_MODE``, or ``LLM_<NAME>_JSON_MODE``
+per provider). A provider that rejects the parameter has it switched off and
+the call is retried without it.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterator
+
+import yaml
+from dotenv import load_dotenv
+from openai import (
+    APIConnectionError, APITimeoutError, AsyncOpenAI, BadRequestError, InternalServerError, RateLimitError,
+)
+
+from services.llm_limiter import LLM_MAX_IN_FLIGHT, LLM_RPM, LLM_TPM, LLMLimiter
+
+load_dotenv()
+
+LLM_PROVIDERS_FILE = os.getenv("LLM_PROVIDERS_FILE", "")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+# Completion size assumed when reserving tokens/min before the call
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "1024"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # seconds
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") in ("1", "true", "True")
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "1") in ("1", "true", "True")
+LLM_HEDGE_MIN_SAMPLES = 20  # latencies needed before the p90 is trusted
+LLM_EWMA_ALPHA = 0.2
+LLM_MAX_BACKOFF = 30.0  # seconds
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def estimate_tokens(*texts: str) -> int:
+    return sum(len(text) for text in texts) // 4
+
+
+def _usage(usage, prompt_tokens: int, completion_tokens: int) -> tuple[int, int]:
+    """Reported (prompt, completion) tokens, or the given estimates when the provider sent none."""
+    if usage is None or getattr(usage, "prompt_tokens", None) is None:
+        return prompt_tokens, completion_tokens
+    return usage.prompt_tokens, usage.completion_tokens or 0
+
+
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class Provider:
+    def __init__(self, name: str, base_url: str, model: str, api_key: str = "",
+                 max_in_flight: int = LLM_MAX_IN_FLIGHT, rpm: float = LLM_RPM, tpm: float = LLM_TPM,
+                 json_mode: bool = LLM_JSON_MODE):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        # Retries and backoff are handled by the pool and limiter, not the SDK
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.limiter = LLMLimiter(max_in_flight, rpm, tpm)
+        self.json_mode = json_mode
+        self.json_mode_fallbacks = 0
+        self.latency_ewma: float | None = None
+        self.error_ewma = 0.0
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._trial_in_flight = False
+
+    # -- health ---------------------------------------------------------------
+    def available(self, now: float) -> bool:
+        """Closed breaker, or an open one whose cooldown allows a single trial call."""
+        if self.consecutive_failures < LLM_BREAKER_THRESHOLD:
+            return True
+        return now >= self.open_until and not self._trial_in_flight
+
+    def breaker_state(self) -> str:
+        if self.consecutive_failures < LLM_BREAKER_THRESHOLD:
+            return "closed"
+        return "half_open" if time.monotonic() >= self.open_until else "open"
+
+    def score(self) -> float:
+        """Lower is better; untried providers score 0 so they get sampled."""
+        if self.latency_ewma is None:
+            return 0.0
+        return self.latency_ewma * (1.0 + 4.0 * self.error_ewma)
+
+    def p90(self) -> float | None:
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+    def record_success(self, latency: float) -> None:
+        self.calls += 1
+        self.latencies.append(latency)
+        self.latency_ewma = latency if self.latency_ewma is None else (
+            LLM_EWMA_ALPHA * latency + (1 - LLM_EWMA_ALPHA) * self.latency_ewma)
+        self.error_ewma *= 1 - LLM_EWMA_ALPHA
+        self.consecutive_failures = 0
+        self._trial_in_flight = False
+        self.limiter.on_success()
+
+    def record_failure(self, error: Exception) -> None:
+        self.calls += 1
+        self.failures += 1
+        self.error_ewma = LLM_EWMA_ALPHA + (1 - LLM_EWMA_ALPHA) * self.error_ewma
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.consecutive_failures >= LLM_BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+        if isinstance(error, RateLimitError):
+            self.limiter.on_rate_limited(_retry_after(error))
+
+    # -- calls ----------------------------------------------------------------
+    def _begin(self) -> None:
+        if self.consecutive_failures >= LLM_BREAKER_THRESHOLD:
+            self._trial_in_flight = True
+
+    def _call(self, model: str | None, prompt_tokens: int, completion_tokens: int,
+              latency: float, estimated: bool) -> dict:
+        return {
+            "provider": self.name,
+            "model": model or self.model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_s": latency,
+            "usage_estimated": estimated,
+        }
+
+    async def create(self, messages: list[dict], temperature: float, model: str | None = None,
+                     json_mode: bool = False, stream: bool = False):
+        """``chat.completions.create``, in JSON mode if requested and supported by this provider."""
+        kwargs = {"model": model or self.model, "messages": messages, "temperature": temperature}
+        if stream:
+            kwargs["stream"] = True
+        if json_mode and self.json_mode:
+            try:
+                return await self.client.chat.completions.create(
+                    **kwargs, response_format={"type": "json_object"})
+            except BadRequestError as e:
+                if "response_format" not in str(e):
+                    raise
+                self.json_mode = False  # the endpoint or model does not support it
+                self.json_mode_fallbacks += 1
+        return await self.client.chat.completions.create(**kwargs)
+
+    async def complete(self, messages: list[dict], temperature: float, model: str | None = None,
+                       json_mode: bool = False) -> dict:
+        """Return a call record: the completion ``text`` plus provider, model, tokens and latency."""
+        prompt_estimate = estimate_tokens(*(m["content"] for m in messages))
+        estimated = prompt_estimate + LLM_EXPECTED_COMPLETION_TOKENS
+        async with self.limiter.slot(estimated):
+            self._begin()
+            started = time.monotonic()
+            try:
+                response = await self.create(messages, temperature, model, json_mode)
+            except asyncio.CancelledError:
+                self._trial_in_flight = False  # lost a hedge race: not a provider failure
+                raise
+            except RETRYABLE_ERRORS as e:
+                self.record_failure(e)
+                raise
+            except Exception:
+                self._trial_in_flight = False  # e.g. a 400: the request is at fault, not the provider
+                raise
+            latency = time.monotonic() - started
+            self.record_success(latency)
+            text = response.choices[0].message.content or ""
+            prompt_tokens, completion_tokens = _usage(response.usage, prompt_estimate, estimate_tokens(text))
+            self.limiter.record_tokens(estimated, prompt_tokens + completion_tokens)
+            return {"text": text, **self._call(model, prompt_tokens, completion_tokens, latency,
+                                               estimated=response.usage is None)}
+
+    def stats(self) -> dict:
+        p90 = self.p90()
+        return {
+            "name": self.name,
+            "model": self.model,
+            "base_url": self.base_url,
+            "calls": self.calls,
+            "failures": self.failures,
+            "latency_ewma_s": round(self.latency_ewma, 6) if self.latency_ewma is not None else None,
+            "error_ewma": round(self.error_ewma, 4),
+            "p90_s": round(p90, 6) if p90 is not None else None,
+            "breaker": self.breaker_state(),
+            "json_mode": self.json_mode,
+            "json_mode_fallbacks": self.json_mode_fallbacks,
+            "limiter": self.limiter.stats(),
+        }
+
+
+class ProviderPool:
+    def __init__(self, providers: list[Provider], hedge: bool = LLM_HEDGE):
+        if not providers:
+            raise ValueError("at least one LLM provider is required")
+        self.providers = providers
+        self.hedge = hedge
+        self._failovers = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+
+    @property
+    def primary(self) -> Provider:
+        return self.providers[0]
+
+    def cache_scope(self) -> str:
+        """Identifies the set of endpoints a cached response may have come from."""
+        return "|".join(sorted(p.base_url for p in self.providers))
+
+    def get(self, name: str) -> Provider:
+        for provider in self.providers:
+            if provider.name == name:
+                return provider
+        raise ValueError(f"unknown LLM provider {name!r}")
+
+    def _members(self, only: str | None) -> list[Provider]:
+        return [self.get(only)] if only else self.providers
+
+    def pick(self, exclude: tuple[Provider, ...] = (), only: str | None = None) -> Provider | None:
+        """Best available provider not in ``exclude``, or None if there is none.
+
+        ``only`` restricts the choice to the provider with that name.
+        """
+        now = time.monotonic()
+        candidates = [p for p in self._members(only) if p not in exclude and p.available(now)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: (p.score(), self.providers.index(p)))
+
+    def _pick_or_soonest(self, exclude: tuple[Provider, ...] = (), only: str | None = None) -> Provider:
+        provider = self.pick(exclude, only) or self.pick(only=only)
+        if provider is None:
+            # Every breaker is open: use the one that reopens first rather than failing outright
+            provider = min(self._members(only), key=lambda p: p.open_until)
+        return provider
+
+    async def complete(self, messages: list[dict], temperature: float, model: str | None = None,
+                       only: str | None = None, json_mode: bool = False) -> dict:
+        """Return a call record (see ``Provider.complete``), failing over on retryable errors."""
+        tried: tuple[Provider, ...] = ()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            provider = self._pick_or_soonest(tried, only)
+            try:
+                if self.hedge:
+                    return await self._hedged(provider, messages, temperature, model, only, json_mode)
+                return await provider.complete(messages, temperature, model, json_mode)
+            except RETRYABLE_ERRORS as e:
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                tried += (provider,)
+                delay = self._backoff(e, attempt)
+                if self.pick(tried, only) is not None:
+                    self._failovers += 1
+                    delay = 0.0  # another provider is healthy: switch now instead of waiting
+                else:
+                    tried = ()
+                await asyncio.sleep(delay)
+
+    async def stream(self, messages: list[dict], temperature: float, model: str | None = None,
+                     only: str | None = None, call: dict | None = None,
+                     json_mode: bool = False) -> AsyncIterator[str]:
+        """Yield completion text as it streams; only opening the stream fails over.
+
+        Once the stream ends, ``call`` is filled with the call record (see
+        ``Provider.complete``) minus the text.
+        """
+        prompt_tokens = estimate_tokens(*(m["content"] for m in messages))
+        estimated = prompt_tokens + LLM_EXPECTED_COMPLETION_TOKENS
+        tried: tuple[Provider, ...] = ()
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            provider = self._pick_or_soonest(tried, only)
+            async with provider.limiter.slot(estimated):
+                provider._begin()
+                started = time.monotonic()
+                try:
+                    stream = await provider.create(messages, temperature, model, json_mode, stream=True)
+                except RETRYABLE_ERRORS as e:
+                    provider.record_failure(e)
+                    if attempt == LLM_MAX_RETRIES:
+                        raise
+                    tried += (provider,)
+                    delay = self._backoff(e, attempt)
+                    if self.pick(tried, only) is not None:
+                        self._failovers += 1
+                        delay = 0.0
+                    else:
+                        tried = ()
+                else:
+                    received = 0
+                    usage = None
+                    try:
+                        async for chunk in stream:
+                            usage = getattr(chunk, "usage", None) or usage  # sent by some providers on the last chunk
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                received += len(chunk.choices[0].delta.content)
+                                yield chunk.choices[0].delta.content
+                    except RETRYABLE_ERRORS as e:
+                        provider.record_failure(e)  # items were already yielded: no failover
+                        raise
+                    finally:
+                        await stream.close()  # aborts the request if the caller was cancelled
+                    latency = time.monotonic() - started
+                    provider.record_success(latency)
+                    used_prompt, used_completion = _usage(usage, prompt_tokens, received // 4)
+                    provider.limiter.record_tokens(estimated, used_prompt + used_completion)
+                    if call is not None:
+                        call.update(provider._call(model, used_prompt, used_completion, latency,
+                                                   estimated=usage is None))
+                    return
+            await asyncio.sleep(delay)
+
+    async def _hedged(self, primary: Provider, messages: list[dict], temperature: float,
+                      model: str | None, only: str | None = None, json_mode: bool = False) -> dict:
+        first = asyncio.create_task(primary.complete(messages, temperature, model, json_mode))
+        threshold = primary.p90()
+        backup = self.pick(exclude=(primary,), only=only) if threshold is not None else None
+        if backup is None:
+            return await first
+
+        pending = {first}
+        error: BaseException | None = None
+        try:
+            # asyncio.wait() does not cancel its tasks when the caller is cancelled
+            # (e.g. the run was cancelled), so the finally block aborts them
+            done, _ = await asyncio.wait({first}, timeout=threshold)
+            if done:
+                return first.result()
+
+            self._hedges += 1
+            second = asyncio.create_task(backup.complete(messages, temperature, model, json_mode))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _backoff(error: Exception, attempt: int) -> float:
+        delay = min(LLM_MAX_BACKOFF, 2.0 ** attempt)
+        if isinstance(error, RateLimitError):
+            retry_after = _retry_after(error)
+            if retry_after is not None:
+                delay = retry_after
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "hedging": self.hedge,
+            "failovers": self._failovers,
+            "hedges": self._hedges,
+            "hedge_wins": self._hedge_wins,
+            "providers": [p.stats() for p in self.providers],
+        }
+
+
+def _provider_from_env(name: str) -> Provider:
+    prefix = f"LLM_{name.upper()}_"
+    return Provider(
+        name=name,
+        base_url=os.environ[prefix + "BASE_URL"],
+        model=os.environ[prefix + "MODEL"],
+        api_key=os.getenv(prefix + "API_KEY", ""),
+        max_in_flight=int(os.getenv(prefix + "MAX_IN_FLIGHT", str(LLM_MAX_IN_FLIGHT))),
+        rpm=float(os.getenv(prefix + "RPM", str(LLM_RPM))),
+        tpm=float(os.getenv(prefix + "TPM", str(LLM_TPM))),
+        json_mode=os.getenv(prefix + "JSON_MODE", "1" if LLM_JSON_MODE else "0") in ("1", "true", "True"),
+    )
+
+
+def _provider_from_yaml(entry: dict) -> Provider:
+    api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", ""), "")
+    return Provider(
+        name=entry["name"],
+        base_url=entry["base_url"],
+        model=entry["model"],
+        api_key=api_key,
+        max_in_flight=int(entry.get("max_in_flight", LLM_MAX_IN_FLIGHT)),
+        rpm=float(entry.get("rpm", LLM_RPM)),
+        tpm=float(entry.get("tpm", LLM_TPM)),
+        json_mode=bool(entry.get("json_mode", LLM_JSON_MODE)),
+    )
+
+
+def load_providers() -> list[Provider]:
+    if LLM_PROVIDERS_FILE:
+        with open(LLM_PROVIDERS_FILE, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+        return [_provider_from_yaml(entry) for entry in config.get("providers", [])]
+    names = [n.strip() for n in os.getenv("LLM_PROVIDERS", "").split(",") if n.strip()]
+    if names:
+        return [_provider_from_env(name) for name in names]
+    return [Provider(
+        name="default",
+        base_url=os.getenv("LLM_BASE_URL", "https://api.groq.com/openai/v1"),
+        model=os.getenv("LLM_MODEL", "llama-3.3-70b-versatile"),
+        api_key=os.getenv("LLM_API_KEY", ""),
+    )]
+
+
+providers = ProviderPool(load_providers())
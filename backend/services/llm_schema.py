@@ -0,0 +1,145 @@
+"""Validation of LLM JSON against the output models in ``models/schemas.py``.
+
+A document is checked field by field: every element of a ``list[Model]``
+field (``artifacts``, ``inceptions``) is validated on its own, so one bad
+item does not invalidate the rest, and other fields are validated as a
+whole. The invalid parts are listed so ``llm_service`` can ask the model to
+correct just those. ``TypeAdapter``s are built once per type and cached.
+"""
+
+import json
+from functools import lru_cache
+from typing import Any, get_args, get_origin
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+MAX_ERRORS_PER_ITEM = 5
+
+
+@lru_cache(maxsize=None)
+def adapter(tp: Any) -> TypeAdapter:
+    return TypeAdapter(tp)
+
+
+@lru_cache(maxsize=None)
+def item_types(schema: type[BaseModel]) -> dict[str, Any]:
+    """Element type of each ``list[...]`` field of ``schema``."""
+    types = {}
+    for name, field in schema.model_fields.items():
+        if get_origin(field.annotation) is list:
+            (item_type,) = get_args(field.annotation)
+            types[name] = item_type
+    return types
+
+
+def _errors(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'value'}: {e['msg']}"
+        for e in error.errors()[:MAX_ERRORS_PER_ITEM]
+    )
+
+
+def _validate(tp: Any, value: Any) -> tuple[Any, str | None]:
+    ta = adapter(tp)
+    try:
+        return ta.dump_python(ta.validate_python(value)), None
+    except ValidationError as e:
+        return None, _errors(e)
+
+
+def validate_item(schema: type[BaseModel], field: str, item: Any) -> Any | None:
+    """Validated element of list field ``field``, or None if it is invalid (or not a list field)."""
+    item_type = item_types(schema).get(field)
+    return None if item_type is None else _validate(item_type, item)[0]
+
+
+def validate_document(schema: type[BaseModel], doc: Any) -> tuple[dict, list[dict]]:
+    """Split ``doc`` into its valid parts and a list of invalid ones.
+
+    Invalid list elements are left as ``None`` placeholders in the returned
+    dict. Each invalid part is ``{"field", "index", "value", "error"}``, with
+    ``index`` None for a whole field.
+    """
+    lists = item_types(schema)
+    if isinstance(doc, list) and len(lists) == 1:
+        doc = {next(iter(lists)): doc}  # the model answered with the bare array
+    if not isinstance(doc, dict):
+        doc = {}
+
+    result: dict = {}
+    invalid: list[dict] = []
+    for name, field in schema.model_fields.items():
+        if name not in doc:
+            if field.is_required():
+                invalid.append({"field": name, "index": None, "value": None, "error": "field required"})
+            continue
+        value = doc[name]
+        if name in lists and isinstance(value, list):
+            result[name] = []
+            for index, item in enumerate(value):
+                valid, error = _validate(lists[name], item)
+                result[name].append(valid)
+                if error:
+                    invalid.append({"field": name, "index": index, "value": item, "error": error})
+        else:
+            valid, error = _validate(field.annotation, value)
+            if error:
+                invalid.append({"field": name, "index": None, "value": value, "error": error})
+            else:
+                result[name] = valid
+    return result, invalid
+
+
+def fix_request(invalid: list[dict]) -> str:
+    """Prompt suffix asking the model to correct only the invalid parts."""
+    lines = [
+        "\n\n## Corrections needed",
+        "Some parts of your previous answer do not match the required JSON structure. Respond ONLY "
+        'with a JSON object {"fixes": [{"field": ..., "index": ..., "value": ...}]} holding one entry '
+        "per part below, with the same field and index and the corrected, complete value.",
+    ]
+    for part in invalid:
+        lines.append(
+            f"- field={part['field']} index={json.dumps(part['index'])} errors: {part['error']}; "
+            f"current value: {json.dumps(part['value'], ensure_ascii=False)}"
+        )
+    return "\n".join(lines)
+
+
+def apply_fixes(schema: type[BaseModel], result: dict, invalid: list[dict], fixes: Any) -> list[dict]:
+    """Merge valid corrections into ``result``; return the parts that are still invalid."""
+    lists = item_types(schema)
+    by_part = {}
+    entries = fixes.get("fixes", []) if isinstance(fixes, dict) else []
+    for entry in entries:
+        if isinstance(entry, dict):
+            by_part[(entry.get("field"), entry.get("index"))] = entry.get("value")
+
+    remaining = []
+    for part in invalid:
+        field, index = part["field"], part["index"]
+        key = (field, index)
+        if key not in by_part:
+            remaining.append(part)
+            continue
+        tp = lists[field] if index is not None else schema.model_fields[field].annotation
+        valid, error = _validate(tp, by_part[key])
+        if error:
+            remaining.append({**part, "value": by_part[key], "error": error})
+        elif index is not None:
+            result[field][index] = valid
+        else:
+            result[field] = valid
+    return remaining
+
+
+def finalize(schema: type[BaseModel], result: dict) -> dict:
+    """Drop list elements that stayed invalid and apply the model's defaults.
+
+    Raises ``ValidationError`` if a required field is still missing or invalid.
+    """
+    for name in item_types(schema):
+        if isinstance(result.get(name), list):
+            result[name] = [item for item in result[name] if item is not None]
+    ta = adapter(schema)
+    return ta.dump_python(ta.validate_python(result))
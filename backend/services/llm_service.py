@@ -1,54 +1,256 @@
 """OpenAI-compatible LLM service. Works with Groq, DeepSeek, Gemini, OpenRouter, etc."""
 
 import json
-import os
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable
 
-from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from pydantic import BaseModel, ValidationError
 
-load_dotenv()
+from services import db_service
+from services.json_repair import json_outcomes, repair_json
+from services.json_stream import ArrayItemExtractor
+from services.llm_cache import cache_key, llm_cache
+from services.llm_models import agent_usage, current_agent, current_run_id, selector
+from services.llm_providers import providers
+from services.llm_schema import apply_fixes, finalize, fix_request, validate_document, validate_item
+from services.speculation import record_tokens
 
-_client = AsyncOpenAI(
-    api_key=os.getenv("LLM_API_KEY", ""),
-    base_url=os.getenv("LLM_BASE_URL", "https://api.groq.com/openai/v1"),
-)
-
-MODEL = os.getenv("LLM_MODEL", "llama-3.3-70b-versatile")
+logger = logging.getLogger(__name__)
 
 
-async def call_llm(prompt: str, system_instruction: str = "") -> str:
-    """Send a prompt to the LLM and return the raw text response."""
+def _messages(prompt: str, system_instruction: str) -> list[dict]:
     messages = []
     if system_instruction:
         messages.append({"role": "system", "content": system_instruction})
     messages.append({"role": "user", "content": prompt})
+    return messages
+
 
-    response = await _client.chat.completions.create(
-        model=MODEL,
-        messages=messages,
-        temperature=0.3,
+async def call_llm(prompt: str, system_instruction: str = "", attempt: int = 0, json_mode: bool = False) -> str:
+    """Send a prompt to the LLM and return the raw text response.
+
+    Model and temperature are those configured for the calling agent (see
+    ``llm_models``); ``attempt`` > 0 selects its retry settings. With
+    ``json_mode`` the provider is asked for a JSON object response where it
+    supports it. The call is routed to the fastest healthy provider in the
+    pool and fails over to another one on rate limits, timeouts and server
+    errors.
+    """
+    agent = current_agent()
+    selection = selector.select(agent, attempt)
+    call = await providers.complete(
+        _messages(prompt, system_instruction), selection["temperature"], selection["model"], selection["provider"],
+        json_mode=json_mode,
     )
-    return response.choices[0].message.content or ""
-
-
-async def call_llm_json(prompt: str, system_instruction: str = "") -> dict:
-    """Send a prompt and parse the response as JSON. Retries once on parse failure."""
-    for attempt in range(2):
-        raw = await call_llm(prompt, system_instruction)
-        # Strip markdown code fences if the LLM wraps the response
-        cleaned = raw.strip()
-        if cleaned.startswith("```"):
-            cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else cleaned[3:]
-            if cleaned.endswith("```"):
-                cleaned = cleaned[:-3]
-            cleaned = cleaned.strip()
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
-            if attempt == 0:
-                prompt = (
-                    f"Your previous response was not valid JSON. "
-                    f"Please fix it and respond ONLY with valid JSON, no extra text.\n\n"
-                    f"Previous response:\n{raw}"
-                )
-    return {}
+    await _account(agent, call, attempt)
+    return call["text"]
+
+
+async def _account(agent: str | None, call: dict, attempt: int = 0) -> None:
+    """Record a finished call in the per-agent counters and the ``llm_calls`` table."""
+    agent_usage.record(agent, call, attempt)
+    record_tokens(call)
+    cost = selector.cost(call["model"], call["prompt_tokens"], call["completion_tokens"])
+    try:
+        await db_service.record_llm_call(current_run_id(), agent or "unattributed", call, attempt, cost)
+    except Exception:
+        # The completion has already been paid for: losing its accounting row beats losing the result
+        logger.exception("Failed to record LLM call")
+
+
+def _parse_json(raw: str):
+    """Parse a completion as JSON, stripping markdown code fences if the LLM added them."""
+    cleaned = raw.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else cleaned[3:]
+        if cleaned.endswith("```"):
+            cleaned = cleaned[:-3]
+        cleaned = cleaned.strip()
+    return json.loads(cleaned)
+
+
+class LLMJSONError(ValueError):
+    """The LLM did not return usable JSON, even after local repair and one re-ask."""
+
+
+REASK_SUFFIX = (
+    "\n\n## Previous attempt\n"
+    "Your previous response could not be parsed as JSON ({error}). Answer again following all the "
+    "instructions above and respond ONLY with valid JSON, no extra text."
+)
+
+
+async def _log_json_outcome(action: str, details: dict) -> None:
+    """Record a repair or re-ask in the run's decision log (LLM calls made outside a run only count it)."""
+    run_id = current_run_id()
+    if run_id is not None:
+        await db_service.log_decision(run_id, current_agent() or "llm_service", action, details)
+
+
+async def _parse_or_repair(raw: str, attempt: int) -> tuple[Any, list[str] | None, str | None]:
+    """Return ``(value, repairs, None)``, or ``(None, None, error)`` if the text cannot be used."""
+    prefix = "reask_" if attempt else ""
+    try:
+        value = _parse_json(raw)
+        json_outcomes.record(prefix + "parsed")
+        return value, [], None
+    except json.JSONDecodeError as e:
+        error = str(e)
+    try:
+        value, repairs = repair_json(raw)
+    except json.JSONDecodeError:
+        return None, None, error
+    json_outcomes.record(prefix + "repaired", repairs)
+    logger.info("Repaired LLM JSON locally (attempt %d): %s", attempt, ", ".join(repairs))
+    await _log_json_outcome("json_repaired", {"attempt": attempt, "repairs": repairs})
+    return value, repairs, None
+
+
+async def _complete_json(prompt: str, system_instruction: str, first_raw: str | None = None) -> tuple[Any, bool]:
+    """Parse ``first_raw`` (or a fresh completion) as JSON, repairing it locally if needed.
+
+    Only when the text cannot be repaired is the model asked again, with the
+    original prompt plus the parse error. Returns the value and whether it may
+    be cached (output cut short and recovered by repair is not); raises
+    ``LLMJSONError`` if the re-ask is not usable either.
+    """
+    raw = first_raw if first_raw is not None else await call_llm(prompt, system_instruction, json_mode=True)
+    value, repairs, error = await _parse_or_repair(raw, attempt=0)
+    if error is None:
+        return value, "truncated" not in repairs
+
+    await _log_json_outcome("json_reask", {"error": error})
+    raw = await call_llm(prompt + REASK_SUFFIX.format(error=error), system_instruction, attempt=1, json_mode=True)
+    value, repairs, error = await _parse_or_repair(raw, attempt=1)
+    if error is None:
+        return value, "truncated" not in repairs
+
+    json_outcomes.record("failed")
+    await _log_json_outcome("json_failed", {"error": error})
+    raise LLMJSONError(f"LLM response is not valid JSON after repair and re-ask: {error}")
+
+
+async def _conform(prompt: str, system_instruction: str, value: Any, schema: type[BaseModel]) -> tuple[dict, bool]:
+    """Validate ``value`` against ``schema``, asking the model once to correct only the invalid parts.
+
+    List elements that are still invalid are dropped. Returns the validated
+    document and whether it is complete; raises ``LLMJSONError`` if a
+    required field could not be obtained.
+    """
+    result, invalid = validate_document(schema, value)
+    if invalid:
+        await _log_json_outcome("schema_invalid", {
+            "schema": schema.__name__,
+            "parts": [{"field": p["field"], "index": p["index"], "error": p["error"]} for p in invalid],
+        })
+        raw = await call_llm(prompt + fix_request(invalid), system_instruction, attempt=1, json_mode=True)
+        fixes, _, error = await _parse_or_repair(raw, attempt=1)
+        remaining = invalid if error is not None else apply_fixes(schema, result, invalid, fixes)
+        json_outcomes.record("schema_fixed", count=len(invalid) - len(remaining))
+        if remaining:
+            json_outcomes.record("schema_dropped", count=len(remaining))
+            await _log_json_outcome("schema_dropped", {
+                "schema": schema.__name__,
+                "parts": [{"field": p["field"], "index": p["index"], "error": p["error"]} for p in remaining],
+            })
+    else:
+        remaining = []
+    try:
+        return finalize(schema, result), not remaining
+    except ValidationError as e:
+        raise LLMJSONError(f"LLM response does not match {schema.__name__}: {e}") from e
+
+
+def _cache_model() -> str:
+    selection = selector.select(current_agent())
+    return selection["model"] or providers.get(selection["provider"] or providers.primary.name).model
+
+
+async def _cache_lookup(prompt: str, system_instruction: str, use_cache: bool,
+                        schema: type[BaseModel] | None = None) -> tuple[str | None, Any]:
+    if not (use_cache and llm_cache.enabled):
+        llm_cache.record_bypass()
+        return None, None
+    selection = selector.select(current_agent())
+    scope = providers.get(selection["provider"]).base_url if selection["provider"] else providers.cache_scope()
+    key = cache_key(_cache_model(), scope, system_instruction, prompt, selection["temperature"],
+                    schema.__name__ if schema else "")
+    return key, await llm_cache.get(key)
+
+
+async def call_llm_json(prompt: str, system_instruction: str = "", use_cache: bool = True,
+                        schema: type[BaseModel] | None = None) -> dict:
+    """Send a prompt and parse the response as JSON, repairing it or re-asking once if needed.
+
+    With ``schema`` (an output model from ``models/schemas.py``) the response
+    is validated against it and only the invalid parts are requested again.
+    Parsed responses are served from and stored in the persistent LLM cache;
+    pass ``use_cache=False`` to always ask the provider. Raises
+    ``LLMJSONError`` when no valid JSON could be obtained.
+    """
+    key, cached = await _cache_lookup(prompt, system_instruction, use_cache, schema)
+    if cached is not None:
+        return cached
+    result, cacheable = await _complete_json(prompt, system_instruction)
+    if schema is not None:
+        result, complete = await _conform(prompt, system_instruction, result, schema)
+        cacheable = cacheable and complete
+    if key is not None and cacheable:
+        await llm_cache.put(key, _cache_model(), result)
+    return result
+
+
+async def stream_llm(prompt: str, system_instruction: str = "", json_mode: bool = False) -> AsyncIterator[str]:
+    """Send a prompt and yield the response text as the provider streams it."""
+    agent = current_agent()
+    selection = selector.select(agent)
+    call: dict = {}
+    async for delta in providers.stream(_messages(prompt, system_instruction), selection["temperature"],
+                                        selection["model"], selection["provider"], call, json_mode=json_mode):
+        yield delta
+    await _account(agent, call)
+
+
+async def call_llm_json_stream(
+    prompt: str,
+    system_instruction: str = "",
+    on_item: Callable[[str, Any], Awaitable[None]] | None = None,
+    item_keys: Iterable[str] = ("artifacts", "inceptions"),
+    use_cache: bool = True,
+    schema: type[BaseModel] | None = None,
+) -> dict:
+    """Like ``call_llm_json`` but streams the completion.
+
+    ``on_item(key, item)`` is awaited for each element of the ``item_keys``
+    arrays as soon as it is complete, while the rest is still being generated;
+    with ``schema`` only elements that validate are passed, and the corrected
+    ones arrive in the returned document. On a cache hit the cached items are
+    replayed through ``on_item``. If the streamed document cannot be repaired
+    the non-streaming re-ask runs, and ``on_item`` callers must tolerate items
+    they have already seen.
+    """
+    key, cached = await _cache_lookup(prompt, system_instruction, use_cache, schema)
+    if cached is not None:
+        if on_item is not None:
+            for item_key in item_keys:
+                for item in cached.get(item_key, []) if isinstance(cached, dict) else []:
+                    await on_item(item_key, item)
+        return cached
+
+    extractor = ArrayItemExtractor(item_keys)
+    parts = []
+    async for delta in stream_llm(prompt, system_instruction, json_mode=True):
+        parts.append(delta)
+        for item_key, item in extractor.feed(delta):
+            if schema is not None:
+                item = validate_item(schema, item_key, item)
+            if on_item is not None and item is not None:
+                await on_item(item_key, item)
+
+    result, cacheable = await _complete_json(prompt, system_instruction, first_raw="".join(parts))
+    if schema is not None:
+        result, complete = await _conform(prompt, system_instruction, result, schema)
+        cacheable = cacheable and complete
+    if key is not None and cacheable:
+        await llm_cache.put(key, _cache_model(), result)
+    return result
@@ -0,0 +1,68 @@
+"""In-process fan-out of run events to Server-Sent Events subscribers.
+
+Events are first written to the ``run_events`` table by ``db_service`` in the
+same transaction as the change they describe; ``publish`` is called after the
+commit. Each subscriber has a bounded buffer: when a slow client lets it fill
+up, further events are dropped and the subscriber is flagged as overflowed,
+so the SSE endpoint re-reads what it missed from the table instead of
+growing memory.
+"""
+
+import asyncio
+import os
+from collections import defaultdict
+
+RUN_EVENTS_BUFFER = int(os.getenv("RUN_EVENTS_BUFFER", "100"))
+
+
+class Subscriber:
+    def __init__(self, run_id: str, maxsize: int = RUN_EVENTS_BUFFER):
+        self.run_id = run_id
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def push(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class RunEventBus:
+    def __init__(self):
+        self._subscribers: dict[str, set[Subscriber]] = defaultdict(set)
+        self._published = 0
+        self._overflows = 0
+
+    def subscribe(self, run_id: str, maxsize: int = RUN_EVENTS_BUFFER) -> Subscriber:
+        subscriber = Subscriber(run_id, maxsize)
+        self._subscribers[run_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        subscribers = self._subscribers.get(subscriber.run_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[subscriber.run_id]
+
+    def publish(self, events: list[dict]) -> None:
+        """Deliver committed events (``{id, run_id, type, data}``) to subscribers."""
+        for event in events:
+            self._published += 1
+            for subscriber in self._subscribers.get(event["run_id"], ()):
+                was_overflowed = subscriber.overflowed
+                subscriber.push(event)
+                if subscriber.overflowed and not was_overflowed:
+                    self._overflows += 1
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "published": self._published,
+            "overflows": self._overflows,
+        }
+
+
+bus = RunEventBus()
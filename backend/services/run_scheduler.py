@@ -0,0 +1,225 @@
+"""Bounded scheduler for pipeline runs, backed by the ``run_queue`` table.
+
+Runs enter the queue when they are created, when their HITL gate is resolved
+and when a restarted process picks them up. A scheduler fills its slots
+highest priority first and FIFO within a priority, and each slot awaits
+``runner(run_id)`` (the graph's ``advance_run``) until the run finishes or
+parks at a gate, so a burst of runs waits in the queue instead of all
+competing for the LLM at once.
+
+With ``RUN_EXECUTION=inprocess`` (default) the API starts one from its
+lifespan. With ``RUN_EXECUTION=workers`` the API only enqueues and reads,
+and the runs execute in ``python -m workers`` processes, on this or other
+machines sharing the database file. Every claim is a lease renewed by a
+heartbeat: a worker that dies or hangs stops renewing, and once the lease
+expires any scheduler claims the run again (continuing from its last
+checkpoint). A worker that finds it lost a lease cancels its copy of the run.
+``stop`` drains the slots, cancels what is still running after
+``RUN_DRAIN_TIMEOUT`` and hands those runs back to the queue.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable
+
+from services.db_service import (
+    claim_queued_runs,
+    count_queued_runs,
+    enqueue_run,
+    finish_queued_run,
+    release_queued_runs,
+    renew_leases,
+)
+
+# "inprocess": the API process runs the pipeline; "workers": python -m workers does
+RUN_EXECUTION = os.getenv("RUN_EXECUTION", "inprocess")
+RUN_WORKERS = int(os.getenv("RUN_WORKERS", "4"))
+RUN_DRAIN_TIMEOUT = float(os.getenv("RUN_DRAIN_TIMEOUT", "30"))  # seconds
+RUN_LEASE_SECONDS = float(os.getenv("RUN_LEASE_SECONDS", "60"))
+RUN_HEARTBEAT_INTERVAL = float(os.getenv("RUN_HEARTBEAT_INTERVAL", "15"))  # seconds
+# How often the queue is re-read for runs enqueued by another process
+RUN_POLL_INTERVAL = float(os.getenv("RUN_POLL_INTERVAL", "1"))  # seconds
+# Claims of a run whose lease keeps expiring before it is abandoned as failed
+RUN_MAX_ATTEMPTS = int(os.getenv("RUN_MAX_ATTEMPTS", "3"))
+
+logger = logging.getLogger(__name__)
+
+Runner = Callable[[str], Awaitable[None]]
+
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class RunScheduler:
+    def __init__(
+        self,
+        slots: int = RUN_WORKERS,
+        drain_timeout: float = RUN_DRAIN_TIMEOUT,
+        lease: float = RUN_LEASE_SECONDS,
+        heartbeat_interval: float = RUN_HEARTBEAT_INTERVAL,
+        poll_interval: float = RUN_POLL_INTERVAL,
+        max_attempts: int = RUN_MAX_ATTEMPTS,
+        worker_id: str | None = None,
+    ):
+        if slots < 1:
+            raise ValueError("scheduler needs at least one slot")
+        self.slots = slots
+        self.drain_timeout = drain_timeout
+        self.lease = lease
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or new_worker_id()
+        self._runner: Runner | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self._heartbeat: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._running: dict[str, asyncio.Task] = {}
+        # Counters exposed through stats()
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        self._requeued = 0
+        self._reclaimed = 0
+        self._abandoned = 0
+        self._leases_lost = 0
+        self._cancelled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def start(self, runner: Runner) -> None:
+        """Start filling the slots with ``runner`` and renewing the leases of the runs in them."""
+        await self.stop()
+        self._runner = runner
+        self._wake = asyncio.Event()
+        self._wake.set()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self._heartbeat = asyncio.create_task(self._beat())
+
+    async def enqueue(self, run_id: str) -> bool:
+        """Queue ``run_id`` (see ``db_service.enqueue_run``); False if the run does not exist."""
+        queued = await enqueue_run(run_id)
+        self._wake.set()
+        return queued
+
+    async def _dispatch(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            free = self.slots - len(self._running)
+            if free <= 0:
+                continue
+            try:
+                result = await claim_queued_runs(free, self.worker_id, self.lease, self.max_attempts)
+            except Exception:
+                logger.exception("Could not claim queued runs")
+                continue
+            self._reclaimed += result["reclaimed"]
+            self._abandoned += result["abandoned"]
+            for entry in result["claimed"]:
+                self._started += 1
+                waited = max(0.0, entry["waited_s"])
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._running[entry["run_id"]] = asyncio.create_task(self._execute(entry["run_id"]))
+
+    async def _beat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.renew()
+            except Exception:
+                logger.exception("Could not renew run leases")
+
+    async def renew(self) -> None:
+        """Extend the leases of the runs in the slots; cancel those another worker has taken over."""
+        running = list(self._running)
+        held = await renew_leases(self.worker_id, running, self.lease)
+        for run_id in running:
+            task = self._running.get(run_id)
+            if run_id not in held and task is not None:
+                self._leases_lost += 1
+                logger.warning("Lost the lease on run %s; cancelling it in this worker", run_id)
+                task.cancel()
+
+    async def cancel(self, run_id: str) -> bool:
+        """Cancel ``run_id`` if it is in one of this scheduler's slots; the slot is free on return.
+
+        Other workers notice at their next heartbeat, when the run's queue entry is gone.
+        """
+        task = self._running.get(run_id)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self._cancelled += 1
+        return True
+
+    async def _execute(self, run_id: str) -> None:
+        # On cancellation the entry is left to stop() or to the lease expiry
+        try:
+            try:
+                await self._runner(run_id)
+                self._completed += 1
+            except Exception:
+                self._failed += 1
+                logger.exception("Run %s failed in its scheduler slot", run_id)
+            if await finish_queued_run(run_id, self.worker_id):
+                self._requeued += 1
+        finally:
+            self._running.pop(run_id, None)
+            self._wake.set()
+
+    async def stop(self) -> None:
+        """Stop taking runs and wait up to ``drain_timeout`` for the running ones.
+
+        Runs still running then are cancelled and queued again for the next scheduler.
+        """
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._dispatcher = None
+        running = list(self._running.values())
+        if running:
+            _, pending = await asyncio.wait(running, timeout=self.drain_timeout)
+            if pending:
+                logger.warning("Cancelling %d runs still running after the drain timeout", len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._heartbeat.cancel()
+        await asyncio.gather(self._heartbeat, return_exceptions=True)
+        self._heartbeat = None
+        await release_queued_runs(self.worker_id)
+
+    async def stats(self) -> dict:
+        counts = await count_queued_runs()
+        return {
+            "execution": RUN_EXECUTION,
+            "worker_id": self.worker_id,
+            "slots": self.slots,
+            "running": len(self._running),
+            "queued": counts["queued"],
+            "running_all_workers": counts["running"],
+            "started": self._started,
+            "completed": self._completed,
+            "failed": self._failed,
+            "requeued": self._requeued,
+            "reclaimed": self._reclaimed,
+            "abandoned": self._abandoned,
+            "leases_lost": self._leases_lost,
+            "cancelled": self._cancelled,
+            "queue_wait_avg_s": round(self._wait_total / self._started, 3) if self._started else None,
+            "queue_wait_max_s": round(self._wait_max, 3),
+        }
+
+
+scheduler = RunScheduler()
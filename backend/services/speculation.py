@@ -0,0 +1,126 @@
+"""Speculative execution of the next stage while a HITL gate is pending.
+
+With ``SPECULATIVE_STAGES`` enabled, opening a gate starts the next agent in
+the background on the artifacts under review. Its artifacts and decision
+logs go to the staging area (``db_service.staged``) instead of the run. If
+the gate is approved, the next stage's node ``claim``s the result and the
+staged writes are committed at once (waiting for the agent if it is still
+running); on changes or rejection the speculation is cancelled and
+discarded. The tokens it used are then counted as wasted.
+"""
+
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+from services.db_service import commit_staged, discard_staged, log_decision, staged
+
+SPECULATIVE_STAGES = os.getenv("SPECULATIVE_STAGES", "0") in ("1", "true", "True")
+
+# Token counter of the speculation running in the current task, if any
+_tokens: ContextVar[list[int] | None] = ContextVar("speculation_tokens", default=None)
+
+
+def record_tokens(call: dict) -> None:
+    """Count an LLM call's tokens against the speculation it was made for (no-op otherwise)."""
+    counter = _tokens.get()
+    if counter is not None:
+        counter[0] += call["prompt_tokens"] + call["completion_tokens"]
+
+
+class _Speculation:
+    def __init__(self, task: asyncio.Task, tokens: list[int]):
+        self.task = task
+        self.tokens = tokens
+
+
+class Speculator:
+    def __init__(self, enabled: bool = SPECULATIVE_STAGES):
+        self.enabled = enabled
+        self._running: dict[tuple[str, str], _Speculation] = {}
+        self._hits = 0
+        self._misses = 0
+        self._failures = 0
+        self._wasted_tokens = 0
+
+    async def start(self, run_id: str, stage: str, work: Callable[[], Awaitable[dict]]) -> None:
+        """Run ``work()`` (the agent of ``stage``) in the background with its writes staged."""
+        if not self.enabled or (run_id, stage) in self._running:
+            return
+        await discard_staged(run_id, stage)  # left over by a previous process
+        tokens = [0]
+
+        async def _run() -> dict:
+            _tokens.set(tokens)
+            with staged(stage):
+                return await work()
+
+        self._running[(run_id, stage)] = _Speculation(asyncio.create_task(_run()), tokens)
+
+    async def claim(self, run_id: str, stage: str) -> dict | None:
+        """Result of the speculation for ``stage``, committed to the run, or None if there is none."""
+        if not self.enabled:
+            return None
+        speculation = self._running.pop((run_id, stage), None)
+        if speculation is None:
+            await discard_staged(run_id, stage)  # left over by a previous process
+            return None
+        claimed = time.monotonic()
+        try:
+            result = await speculation.task
+        except Exception as e:
+            self._failures += 1
+            await discard_staged(run_id, stage)
+            await log_decision(run_id, "pipeline", "speculation_failed", {"stage": stage, "error": str(e)[:300]})
+            return None
+        waited = time.monotonic() - claimed
+        artifacts = await commit_staged(run_id, stage)
+        self._hits += 1
+        await log_decision(run_id, "pipeline", "speculation_committed", {
+            "stage": stage, "artifacts": artifacts, "tokens": speculation.tokens[0],
+            "waited_s": round(waited, 3),  # 0 when it finished before the gate was approved
+        })
+        return result
+
+    async def discard(self, run_id: str, stage: str, reason: str) -> None:
+        """Cancel the speculation for ``stage`` (aborting its LLM calls) and drop what it staged."""
+        speculation = self._running.pop((run_id, stage), None)
+        if speculation is None:
+            return
+        speculation.task.cancel()
+        await asyncio.gather(speculation.task, return_exceptions=True)
+        await discard_staged(run_id, stage)
+        self._misses += 1
+        self._wasted_tokens += speculation.tokens[0]
+        await log_decision(run_id, "pipeline", "speculation_discarded", {
+            "stage": stage, "reason": reason, "tokens": speculation.tokens[0],
+        })
+
+    async def discard_run(self, run_id: str, reason: str) -> None:
+        """Discard every speculation of ``run_id`` (the run was cancelled)."""
+        for key in [key for key in self._running if key[0] == run_id]:
+            await self.discard(run_id, key[1], reason)
+
+    async def shutdown(self) -> None:
+        """Cancel every speculation (lifespan shutdown); their staged writes are dropped on the next claim."""
+        running, self._running = list(self._running.values()), {}
+        for speculation in running:
+            speculation.task.cancel()
+        await asyncio.gather(*(s.task for s in running), return_exceptions=True)
+
+    def stats(self) -> dict:
+        decided = self._hits + self._misses
+        return {
+            "enabled": self.enabled,
+            "running": len(self._running),
+            "hits": self._hits,
+            "misses": self._misses,
+            "failures": self._failures,
+            "hit_rate": round(self._hits / decided, 4) if decided else None,
+            "wasted_tokens": self._wasted_tokens,
+        }
+
+
+speculator = Speculator()
@@ -0,0 +1,54 @@
+"""In-process timing counters for pipeline stages, exposed via ``/api/metrics``."""
+
+from collections import defaultdict
+
+
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.last = seconds
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_s": round(self.total / self.count, 6) if self.count else 0.0,
+            "max_s": round(self.max, 6),
+            "last_s": round(self.last, 6),
+        }
+
+
+class StageMetrics:
+    def __init__(self):
+        self._first_artifact: dict[str, Timing] = defaultdict(Timing)
+        self._duration: dict[str, Timing] = defaultdict(Timing)
+        self._parallel_saved = Timing()
+
+    def record_first_artifact(self, stage: str, seconds: float) -> None:
+        """Seconds from the start of a stage's LLM call to its first saved artifact."""
+        self._first_artifact[stage].record(seconds)
+
+    def record_duration(self, stage: str, seconds: float) -> None:
+        """Wall-clock seconds of one run of an agent stage."""
+        self._duration[stage].record(seconds)
+
+    def record_parallel_saving(self, seconds: float) -> None:
+        """Seconds saved by running branches in parallel: their summed durations minus their wall time."""
+        self._parallel_saved.record(seconds)
+
+    def stats(self) -> dict:
+        return {
+            "time_to_first_artifact": {stage: t.stats() for stage, t in self._first_artifact.items()},
+            "duration": {stage: t.stats() for stage, t in self._duration.items()},
+            "parallel_saved": self._parallel_saved.stats(),
+        }
+
+
+stage_metrics = StageMetrics()
@@ -3,7 +3,7 @@
 import asyncio
 import json
 
-from database import init_db
+from database import init_db, pool_scope
 from services.db_service import create_run
 from agents.qa_agent import run_qa_agent
 from agents.design_agent import run_design_agent
@@ -40,6 +40,11 @@ FAKE_USER_STORIES = {
 async def main():
     await init_db()
 
+    async with pool_scope():
+        await _run_agents()
+
+
+async def _run_agents():
     # Create a test run
     run = await create_run("Test brief: E-commerce platform with registration, catalog, and cart")
     run_id = run["id"]
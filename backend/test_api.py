@@ -1,5 +1,8 @@
 """Tests for FastAPI endpoints — runs, artifacts, HITL, logs."""
 
+import asyncio
+from unittest.mock import patch
+
 import pytest
 from httpx import AsyncClient
 
@@ -25,10 +28,23 @@ async def test_create_run(client: AsyncClient):
     data = r.json()
     assert "id" in data
     assert data["brief"] == "Test brief for e-commerce"
-    assert data["status"] == "created"
+    assert data["status"] == "queued"
+    assert data["queue_position"] == 1
     assert data["current_stage"] == "pending"
 
 
+@pytest.mark.asyncio
+async def test_create_run_queues_by_priority(client: AsyncClient):
+    first = (await client.post("/api/runs", json={"brief": "Primero"})).json()
+    urgent = (await client.post("/api/runs", json={"brief": "Urgente", "priority": 10})).json()
+    assert (urgent["priority"], urgent["queue_position"]) == (10, 1)
+
+    r = await client.get(f"/api/runs/{first['id']}")
+    assert r.json()["queue_position"] == 2
+    listed = {run["id"]: run["queue_position"] for run in (await client.get("/api/runs")).json()}
+    assert listed == {first["id"]: 2, urgent["id"]: 1}
+
+
 @pytest.mark.asyncio
 async def test_create_run_empty_brief(client: AsyncClient):
     """Even empty brief should create a run (validation is business logic)."""
@@ -46,6 +62,23 @@ async def test_list_runs(client: AsyncClient):
     assert len(runs) >= 2
 
 
+@pytest.mark.asyncio
+async def test_list_runs_paginated(client: AsyncClient):
+    for i in range(3):
+        await client.post("/api/runs", json={"brief": f"Brief {i}"})
+
+    r = await client.get("/api/runs", params={"limit": 2})
+    assert r.status_code == 200
+    page = r.json()
+    assert len(page) == 2
+
+    r = await client.get("/api/runs", params={"limit": 2, "after": page[-1]["id"]})
+    assert len(r.json()) == 1
+
+    r = await client.get("/api/runs", params={"limit": 0})
+    assert r.status_code == 422
+
+
 @pytest.mark.asyncio
 async def test_get_run(client: AsyncClient):
     create = await client.post("/api/runs", json={"brief": "Test brief"})
@@ -71,10 +104,54 @@ async def test_get_run_status(client: AsyncClient):
     assert r.status_code == 200
     data = r.json()
     assert data["id"] == run_id
-    assert data["status"] == "created"
+    assert data["status"] == "queued"
     assert data["current_stage"] == "pending"
 
 
+@pytest.mark.asyncio
+async def test_metrics_exposes_pool_counters(client: AsyncClient):
+    await client.get("/api/runs")
+    r = await client.get("/api/metrics")
+    assert r.status_code == 200
+    pool = r.json()["db_pool"]
+    assert pool["acquisitions"] >= 1
+    assert "waits" in pool
+    assert r.json()["run_scheduler"]["slots"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_cancel_queued_run(client: AsyncClient):
+    run_id = (await client.post("/api/runs", json={"brief": "Brief por error"})).json()["id"]
+
+    r = await client.post(f"/api/runs/{run_id}/cancel")
+    assert r.status_code == 200
+    assert (r.json()["status"], r.json()["queue_position"]) == ("cancelled", None)
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 0}
+    assert await db_service.enqueue_run(run_id) is False  # never scheduled again
+
+    r = await client.post(f"/api/runs/{run_id}/cancel")
+    assert r.status_code == 409
+    assert (await client.post("/api/runs/missing/cancel")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_cancel_resolves_pending_gate(client: AsyncClient):
+    run_id = (await client.post("/api/runs", json={"brief": "Brief"})).json()["id"]
+    gate_id = await db_service.create_hitl_gate(run_id, "ba")
+    await db_service.update_run_stage(run_id, "waiting_hitl", "hitl_ba")
+
+    r = await client.post(f"/api/runs/{run_id}/cancel")
+    assert (r.json()["status"], r.json()["current_stage"]) == ("cancelled", "hitl_ba")
+    assert (await db_service.get_hitl_gate_by_id(gate_id))["status"] == "cancelled"
+    assert (await client.get(f"/api/runs/{run_id}/hitl/current")).json() is None
+
+    await db_service.update_run_stage(run_id, "running", "product")  # a late write from the pipeline
+    assert (await db_service.get_run(run_id))["status"] == "cancelled"
+    logs = (await client.get(f"/api/runs/{run_id}/logs")).json()
+    assert logs[-1]["action"] == "run_cancelled"
+    assert logs[-1]["details"]["gates"] == [gate_id]
+
+
 # ─── Artifacts ──────────────────────────────────────────────────────
 
 
@@ -264,3 +341,97 @@ async def test_decision_logs(client: AsyncClient):
     assert logs[0]["action"] == "started"
     assert logs[1]["action"] == "completed"
     assert "timestamp" in logs[0]
+
+
+# ─── Run events (SSE) ───────────────────────────────────────────────
+
+
+async def _never_disconnected():
+    return False
+
+
+@pytest.mark.asyncio
+async def test_events_replay_then_live():
+    from api.routes_events import event_stream
+
+    run = await db_service.create_run("Test")
+    await db_service.log_decision(run["id"], "ba_agent", "started", {"brief_length": 4})
+
+    stream = event_stream(run["id"], 0, _never_disconnected, heartbeat=5)
+    replayed = await anext(stream)
+    assert "event: log\n" in replayed
+    assert '"action": "started"' in replayed
+
+    await db_service.update_run_stage(run["id"], "running", "ba")
+    live = await asyncio.wait_for(anext(stream), timeout=2)
+    assert "event: stage\n" in live
+    assert '"current_stage": "ba"' in live
+
+    gate_id = await db_service.create_hitl_gate(run["id"], "ba")
+    gate_frame = await asyncio.wait_for(anext(stream), timeout=2)
+    assert "event: hitl_gate\n" in gate_frame
+    assert f'"id": {gate_id}' in gate_frame
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_events_resume_from_last_event_id():
+    from api.routes_events import event_stream
+
+    run = await db_service.create_run("Test")
+    await db_service.log_decision(run["id"], "ba_agent", "started")
+    await db_service.save_artifacts_bulk(
+        run["id"], "ba_agent",
+        [{"id": "REQ-001", "type": "requirement", "content": {"id": "REQ-001"}, "parent_ids": []}],
+        completed_details={"requirements_generated": 1},
+    )
+    events = await db_service.list_run_events(run["id"])
+    assert [e["type"] for e in events] == ["log", "artifact", "log"]
+
+    stream = event_stream(run["id"], events[0]["id"], _never_disconnected, heartbeat=5)
+    first = await anext(stream)
+    assert first.startswith(f"id: {events[1]['id']}\nevent: artifact\n")
+    assert (await anext(stream)).startswith(f"id: {events[2]['id']}\n")
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_events_heartbeat():
+    from api.routes_events import event_stream
+
+    run = await db_service.create_run("Test")
+    stream = event_stream(run["id"], 0, _never_disconnected, heartbeat=0.01)
+    assert await asyncio.wait_for(anext(stream), timeout=2) == ": heartbeat\n\n"
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_events_slow_subscriber_recovers_from_table():
+    from api.routes_events import event_stream
+    from services.run_events import bus, RunEventBus
+
+    run = await db_service.create_run("Test")
+    with patch.object(bus, "subscribe", lambda run_id: RunEventBus.subscribe(bus, run_id, maxsize=1)):
+        stream = event_stream(run["id"], 0, _never_disconnected, heartbeat=5)
+        await db_service.log_decision(run["id"], "ba_agent", "step_0")
+        assert "step_0" in await anext(stream)
+
+        # Three events against a buffer of one: two are dropped in memory
+        for i in range(1, 4):
+            await db_service.log_decision(run["id"], "ba_agent", f"step_{i}")
+        frames = [await asyncio.wait_for(anext(stream), timeout=2) for _ in range(3)]
+        assert [f"step_{i}" in f for i, f in zip(range(1, 4), frames)] == [True, True, True]
+        await stream.aclose()
+    assert bus.stats()["overflows"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_events_endpoint_validation(client: AsyncClient):
+    r = await client.get("/api/runs/nonexistent/events")
+    assert r.status_code == 404
+
+    create = await client.post("/api/runs", json={"brief": "Test"})
+    r = await client.get(
+        f"/api/runs/{create.json()['id']}/events", headers={"Last-Event-ID": "abc"},
+    )
+    assert r.status_code == 400
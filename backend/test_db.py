@@ -1,8 +1,10 @@
 """Tests for db_service — CRUD operations on runs, artifacts, logs, HITL gates."""
 
+import asyncio
 import json
 import pytest
 
+import database
 from services import db_service
 
 
@@ -30,6 +32,47 @@ async def test_list_runs():
     assert len(runs) >= 2
 
 
+@pytest.mark.asyncio
+async def test_run_ids_are_time_sortable():
+    ids = [(await db_service.create_run(f"Brief {i}"))["id"] for i in range(5)]
+    assert all(len(i) == 26 for i in ids)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 5
+
+
+@pytest.mark.asyncio
+async def test_list_runs_keyset_pagination():
+    created = [(await db_service.create_run(f"Brief {i}"))["id"] for i in range(5)]
+
+    first = await db_service.list_runs(limit=2)
+    second = await db_service.list_runs(limit=2, after=first[-1]["id"])
+    third = await db_service.list_runs(limit=2, after=second[-1]["id"])
+
+    walked = [r["id"] for page in (first, second, third) for r in page]
+    assert walked == list(reversed(created))
+    assert await db_service.list_runs(limit=2, after=created[0]) == []
+
+
+@pytest.mark.asyncio
+async def test_list_runs_filters_and_truncates_brief():
+    long_run = await db_service.create_run("x" * 1000)
+    other = await db_service.create_run("corto")
+    await db_service.update_run_stage(other["id"], "running", "ba")
+
+    running = await db_service.list_runs(status="running")
+    assert [r["id"] for r in running] == [other["id"]]
+    assert running[0]["brief"] == "corto"
+    assert running[0]["brief_truncated"] is False
+
+    created = await db_service.list_runs(stage="pending")
+    assert [r["id"] for r in created] == [long_run["id"]]
+    assert len(created[0]["brief"]) == db_service.RUN_BRIEF_PREVIEW_CHARS
+    assert created[0]["brief_truncated"] is True
+
+    # The full brief is still available on the run itself
+    assert len((await db_service.get_run(long_run["id"]))["brief"]) == 1000
+
+
 @pytest.mark.asyncio
 async def test_get_run_not_found():
     result = await db_service.get_run("does-not-exist")
@@ -55,6 +98,101 @@ async def test_get_run_status():
     assert status["current_stage"] == "pending"
 
 
+# ─── Run queue ──────────────────────────────────────────────────────
+
+
+async def _claim(limit: int, worker_id: str = "worker-a", lease: float = 60, max_attempts: int = 3) -> list[str]:
+    result = await db_service.claim_queued_runs(limit, worker_id, lease, max_attempts)
+    return [entry["run_id"] for entry in result["claimed"]]
+
+
+@pytest.mark.asyncio
+async def test_queue_orders_by_priority_then_fifo():
+    first = await db_service.create_run("First")
+    background = await db_service.create_run("Background", priority=-1)
+    urgent = await db_service.create_run("Urgent", priority=5)
+    second = await db_service.create_run("Second")
+    for run in (first, background, urgent, second):
+        assert await db_service.enqueue_run(run["id"])
+
+    queued = await db_service.get_run(urgent["id"])
+    assert queued["status"] == "queued"
+    assert queued["queue_position"] == 1
+    assert (await db_service.get_run(background["id"]))["queue_position"] == 4
+
+    assert await _claim(2) == [urgent["id"], first["id"]]
+    assert (await db_service.get_run(urgent["id"]))["queue_position"] is None
+    assert (await db_service.get_run(second["id"]))["queue_position"] == 1
+    assert await db_service.count_queued_runs() == {"queued": 2, "running": 2}
+
+
+@pytest.mark.asyncio
+async def test_enqueue_while_running_requeues_on_finish():
+    run = await db_service.create_run("Brief")
+    await db_service.enqueue_run(run["id"])
+    await db_service.enqueue_run(run["id"])  # already queued: keeps its single entry
+    assert await db_service.count_queued_runs() == {"queued": 1, "running": 0}
+
+    await _claim(1)
+    await db_service.enqueue_run(run["id"])  # e.g. its gate was resolved before the slot was released
+    assert await db_service.finish_queued_run(run["id"], "worker-a") is True
+    assert await db_service.count_queued_runs() == {"queued": 1, "running": 0}
+
+    await _claim(1)
+    assert await db_service.finish_queued_run(run["id"], "worker-b") is False  # not its lease
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 1}
+    assert await db_service.finish_queued_run(run["id"], "worker-a") is False
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 0}
+
+
+@pytest.mark.asyncio
+async def test_enqueue_unknown_run():
+    assert await db_service.enqueue_run("missing") is False
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 0}
+
+
+@pytest.mark.asyncio
+async def test_expired_lease_is_reclaimed_by_another_worker():
+    run = await db_service.create_run("Brief")
+    await db_service.enqueue_run(run["id"])
+    assert await _claim(1, "worker-a", lease=-1) == [run["id"]]  # worker-a stops heartbeating
+
+    assert await db_service.renew_leases("worker-b", [run["id"]], 60) == set()
+    result = await db_service.claim_queued_runs(1, "worker-b", 60, 3)
+    assert result["reclaimed"] == 1
+    assert [(e["run_id"], e["attempts"]) for e in result["claimed"]] == [(run["id"], 2)]
+    assert await db_service.renew_leases("worker-a", [run["id"]], 60) == set()  # worker-a lost it
+    assert await db_service.renew_leases("worker-b", [run["id"]], 60) == {run["id"]}
+
+
+@pytest.mark.asyncio
+async def test_run_abandoned_after_max_attempts():
+    run = await db_service.create_run("Brief")
+    await db_service.enqueue_run(run["id"])
+    await _claim(1, "worker-a", lease=-1, max_attempts=2)
+    await _claim(1, "worker-b", lease=-1, max_attempts=2)
+
+    result = await db_service.claim_queued_runs(1, "worker-c", 60, 2)
+    assert (result["claimed"], result["abandoned"]) == ([], 1)
+    stored = await db_service.get_run(run["id"])
+    assert (stored["status"], stored["current_stage"]) == ("error", "error")
+    logs = await db_service.list_decision_logs(run["id"])
+    assert logs[-1]["action"] == "run_abandoned"
+    assert logs[-1]["details"] == {"worker_id": "worker-b", "attempts": 2}
+
+
+@pytest.mark.asyncio
+async def test_release_hands_runs_back_without_counting_the_attempt():
+    run = await db_service.create_run("Brief")
+    await db_service.enqueue_run(run["id"])
+    await _claim(1)
+
+    assert await db_service.release_queued_runs("worker-a") == 1
+    assert (await db_service.get_run(run["id"]))["queue_position"] == 1
+    result = await db_service.claim_queued_runs(1, "worker-b", 60, 3)
+    assert result["claimed"][0]["attempts"] == 1
+
+
 # ─── Artifacts ──────────────────────────────────────────────────────
 
 
@@ -140,6 +278,45 @@ async def test_save_artifact_upsert():
     assert len(all_arts) == 1
 
 
+@pytest.mark.asyncio
+async def test_save_artifacts_bulk_with_completed_log():
+    run = await db_service.create_run("Brief")
+
+    await db_service.save_artifacts_bulk(
+        run["id"],
+        "qa_agent",
+        [
+            {"id": f"TC-{i:03d}", "type": "test_case", "content": {"id": f"TC-{i:03d}"},
+             "parent_ids": ["US-001"]}
+            for i in range(1, 41)
+        ],
+        completed_details={"test_cases_generated": 40},
+    )
+
+    artifacts = await db_service.list_artifacts(run["id"])
+    assert len(artifacts) == 40
+    assert artifacts[0]["parent_ids"] == ["US-001"]
+    logs = await db_service.list_decision_logs(run["id"])
+    assert [log["action"] for log in logs] == ["completed"]
+    assert logs[0]["details"]["test_cases_generated"] == 40
+
+
+@pytest.mark.asyncio
+async def test_save_artifacts_bulk_is_atomic():
+    run = await db_service.create_run("Brief")
+
+    with pytest.raises(TypeError):
+        await db_service.save_artifacts_bulk(
+            run["id"],
+            "ba_agent",
+            [{"id": "REQ-001", "type": "requirement", "content": {"id": "REQ-001"}}],
+            completed_details={"not_serializable": object()},
+        )
+
+    assert await db_service.list_artifacts(run["id"]) == []
+    assert await db_service.list_decision_logs(run["id"]) == []
+
+
 @pytest.mark.asyncio
 async def test_get_diagram():
     run = await db_service.create_run("Brief")
@@ -244,8 +421,309 @@ async def test_resolve_hitl_with_feedback():
     assert gate["resolved_at"] is not None
 
 
+@pytest.mark.asyncio
+async def test_resolve_hitl_wakes_waiter_immediately():
+    from services.hitl_waiters import waiters
+
+    run = await db_service.create_run("Brief")
+    gate_id = await db_service.create_hitl_gate(run["id"], "ba")
+
+    fetches = 0
+
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        return await db_service.get_hitl_gate_by_id(gate_id)
+
+    # A fallback interval far beyond the test timeout proves the wake-up is event driven
+    waiter = asyncio.create_task(waiters.wait(gate_id, fetch, fallback_interval=60))
+    await asyncio.sleep(0.01)
+    assert waiters.stats()["waiters"] == 1
+
+    wakeups_before = waiters.stats()["wakeups"]
+    await db_service.resolve_hitl(run["id"], "approved", None)
+    gate = await asyncio.wait_for(waiter, timeout=2)
+
+    assert gate["status"] == "approved"
+    assert fetches == 2
+    stats = waiters.stats()
+    assert stats["waiters"] == 0
+    assert stats["wakeups"] == wakeups_before + 1
+
+
+@pytest.mark.asyncio
+async def test_gate_waiter_fallback_poll():
+    from services.hitl_waiters import GateWaiterRegistry
+
+    registry = GateWaiterRegistry()
+    states = iter([{"status": "pending"}, {"status": "pending"}, {"status": "rejected"}])
+
+    async def fetch():
+        return next(states)
+
+    gate = await asyncio.wait_for(registry.wait(1, fetch, fallback_interval=0.01), timeout=2)
+    assert gate["status"] == "rejected"
+    assert registry.stats()["fallback_polls"] == 2
+
+
 @pytest.mark.asyncio
 async def test_resolve_hitl_no_pending():
     run = await db_service.create_run("Brief")
     result = await db_service.resolve_hitl(run["id"], "approved", None)
     assert result is None
+
+
+# ─── Connection pool ───────────────────────────────────────────────
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connections():
+    pool = database.ConnectionPool(database.DB_PATH, size=2)
+    try:
+        async with pool.acquire() as first:
+            pass
+        async with pool.acquire() as second:
+            pass
+        assert first is second
+        stats = pool.stats()
+        assert stats["open"] == 1
+        assert stats["acquisitions"] == 2
+        assert stats["waits"] == 0
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_counts_waits_when_exhausted():
+    pool = database.ConnectionPool(database.DB_PATH, size=1)
+    try:
+        release = asyncio.Event()
+
+        async def hold():
+            async with pool.acquire():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+
+        async def borrow():
+            async with pool.acquire() as db:
+                cursor = await db.execute("SELECT 1")
+                return (await cursor.fetchone())[0]
+
+        waiter = asyncio.create_task(borrow())
+        await asyncio.sleep(0.01)
+        release.set()
+        assert await waiter == 1
+        await holder
+
+        stats = pool.stats()
+        assert stats["open"] == 1
+        assert stats["waits"] == 1
+        assert stats["wait_time_total_s"] > 0
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_replaces_unhealthy_connection():
+    pool = database.ConnectionPool(database.DB_PATH, size=1, healthcheck_interval=0)
+    try:
+        async with pool.acquire() as db:
+            pass
+        await db.close()  # simulate a connection that died while idle
+
+        async with pool.acquire() as replacement:
+            cursor = await replacement.execute("SELECT 1")
+            assert (await cursor.fetchone())[0] == 1
+        assert replacement is not db
+        assert pool.stats()["healthcheck_failures"] == 1
+        assert pool.stats()["open"] == 1
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_rolls_back_uncommitted_work():
+    run = await db_service.create_run("Brief")
+    async with database.connection() as db:
+        await db.execute("UPDATE runs SET status = 'dirty' WHERE id = ?", (run["id"],))
+    assert (await db_service.get_run(run["id"]))["status"] == "created"
+
+
+# ─── Single writer ─────────────────────────────────────────────────
+
+
+@pytest.mark.asyncio
+async def test_writer_group_commits_concurrent_writes():
+    run = await db_service.create_run("Brief")
+    writer = database.get_writer()
+    batches_before = writer.stats()["batches"]
+
+    await asyncio.gather(*[
+        db_service.log_decision(run["id"], "ba_agent", f"step_{i}", {"i": i})
+        for i in range(20)
+    ])
+
+    logs = await db_service.list_decision_logs(run["id"])
+    assert len(logs) == 20
+    # 20 queued writes must have shared transactions
+    assert writer.stats()["batches"] - batches_before < 20
+
+
+@pytest.mark.asyncio
+async def test_writer_isolates_failing_write():
+    run = await db_service.create_run("Brief")
+
+    async def broken(db):
+        await db.execute("INSERT INTO runs (id, brief) VALUES (?, ?)", ("x-broken", "b"))
+        raise ValueError("boom")
+
+    results = await asyncio.gather(
+        database.write(broken),
+        db_service.log_decision(run["id"], "ba_agent", "started"),
+        return_exceptions=True,
+    )
+    assert isinstance(results[0], ValueError)
+    assert results[1] is None
+    assert await db_service.get_run("x-broken") is None
+    assert len(await db_service.list_decision_logs(run["id"])) == 1
+
+
+@pytest.mark.asyncio
+async def test_wal_mode_enabled():
+    async with database.connection() as db:
+        cursor = await db.execute("PRAGMA journal_mode")
+        assert (await cursor.fetchone())[0].lower() == "wal"
+
+
+@pytest.mark.asyncio
+async def test_writer_rejects_writes_after_stop():
+    writer = database.DatabaseWriter(database.DB_PATH)
+    await writer.start()
+    await writer.stop()
+
+    async def noop(db):
+        return None
+
+    with pytest.raises(RuntimeError):
+        await writer.submit(noop)
+
+
+@pytest.mark.asyncio
+async def test_writer_fails_queued_writes_when_task_dies():
+    writer = database.DatabaseWriter(database.DB_PATH)
+    await writer.start()
+
+    async def noop(db):
+        return None
+
+    # A broken connection makes BEGIN raise outside the per-write savepoint handling
+    await writer._db.close()
+    results = await asyncio.gather(writer.submit(noop), writer.submit(noop), return_exceptions=True)
+    assert all(isinstance(r, Exception) for r in results)
+    with pytest.raises(RuntimeError):
+        await writer.submit(noop)
+    writer._task = None
+    writer._db = None
+
+
+@pytest.mark.asyncio
+async def test_get_pool_requires_open_pool():
+    await database.close_pool()
+    with pytest.raises(RuntimeError):
+        database.get_pool()
+    async with database.pool_scope():
+        assert (await db_service.create_run("Brief"))["id"]
+    with pytest.raises(RuntimeError):
+        database.get_pool()
+    await database.open_pool()  # restore for the fixture teardown
+
+
+@pytest.mark.asyncio
+async def test_open_pool_rejects_zero_size():
+    with pytest.raises(ValueError):
+        await database.open_pool(size=0)
+    await database.open_pool()
+
+
+@pytest.mark.asyncio
+async def test_pool_discards_connection_cancelled_during_release():
+    pool = database.ConnectionPool(database.DB_PATH, size=1)
+    try:
+        started = asyncio.Event()
+
+        async def dirty_then_cancelled():
+            async with pool.acquire() as db:
+                await db.execute("UPDATE runs SET status = status")
+                started.set()
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(dirty_then_cancelled())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Whatever happened during release, the slot must be usable again
+        async with pool.acquire() as db:
+            cursor = await db.execute("SELECT 1")
+            assert (await cursor.fetchone())[0] == 1
+        assert pool.stats()["open"] == 1
+    finally:
+        await pool.close()
+
+
+# ─── Schema migrations ─────────────────────────────────────────────
+
+
+@pytest.mark.asyncio
+async def test_migrations_recorded_and_idempotent():
+    from migrations import MIGRATIONS, current_version, migrate
+
+    async with database.connection() as db:
+        assert await current_version(db) == MIGRATIONS[-1][0]
+        assert await migrate(db) == []  # nothing left to apply
+    await database.init_db()  # re-running the lifespan hook is safe
+    async with database.connection() as db:
+        cursor = await db.execute("SELECT COUNT(*) FROM schema_version")
+        assert (await cursor.fetchone())[0] == len(MIGRATIONS)
+
+
+# Hot queries issued by db_service, keyed by the function that runs them
+HOT_QUERIES = {
+    "list_runs": ("SELECT * FROM runs WHERE id < ? ORDER BY id DESC LIMIT 50", ("Z",)),
+    "list_runs_by_status": (
+        "SELECT * FROM runs WHERE id < ? AND status = ? ORDER BY id DESC LIMIT 50", ("Z", "running"),
+    ),
+    "list_runs_by_stage": (
+        "SELECT * FROM runs WHERE current_stage = ? ORDER BY id DESC LIMIT 50", ("hitl_ba",),
+    ),
+    "get_run": ("SELECT * FROM runs WHERE id = ?", ("r",)),
+    "list_artifacts": ("SELECT * FROM artifacts WHERE run_id = ? ORDER BY created_at", ("r",)),
+    "get_artifact": ("SELECT * FROM artifacts WHERE run_id = ? AND id = ?", ("r", "REQ-001")),
+    "get_diagram": ("SELECT content FROM artifacts WHERE run_id = ? AND type = ?", ("r", "diagram_er")),
+    "list_decision_logs": ("SELECT * FROM decision_log WHERE run_id = ? ORDER BY timestamp", ("r",)),
+    "get_pending_hitl": (
+        "SELECT * FROM hitl_gates WHERE run_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
+        ("r",),
+    ),
+    "get_hitl_gate_by_id": ("SELECT * FROM hitl_gates WHERE id = ?", (1,)),
+    "claim_queued_runs": (
+        "SELECT id FROM run_queue WHERE status = 'queued' ORDER BY priority DESC, id LIMIT ?", (4,),
+    ),
+    "claim_queued_runs_expired": (
+        "SELECT id FROM run_queue WHERE status = 'running' AND lease_expires_at < ?", (0.0,),
+    ),
+}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+async def test_hot_queries_use_indexes(name):
+    sql, params = HOT_QUERIES[name]
+    async with database.connection() as db:
+        cursor = await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        plan = [row["detail"] for row in await cursor.fetchall()]
+    for detail in plan:
+        assert not (detail.startswith("SCAN") and "USING" not in detail), (name, plan)
+        assert "TEMP B-TREE" not in detail, (name, plan)
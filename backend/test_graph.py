@@ -0,0 +1,432 @@
+"""Tests for the LangGraph pipeline — HITL gates, checkpoints and resume."""
+
+import asyncio
+from contextlib import ExitStack
+from unittest.mock import AsyncMock, patch
+
+import pytest
+import pytest_asyncio
+
+from agents import graph
+from services import db_service, llm_limiter, run_scheduler, speculation
+from conftest import (
+    FAKE_REQUIREMENTS,
+    FAKE_INCEPTION,
+    FAKE_USER_STORIES,
+    FAKE_TEST_CASES,
+    FAKE_DIAGRAMS,
+)
+
+
+@pytest.fixture
+def fake_agents():
+    """Replace every agent with a canned result so no LLM is called."""
+    outputs = {
+        "run_ba_agent": {"requirements": FAKE_REQUIREMENTS},
+        "run_product_agent": {"inception": {"inceptions": [FAKE_INCEPTION]}},
+        "run_analyst_agent": {"user_stories": FAKE_USER_STORIES},
+        "run_qa_agent": {"test_cases": FAKE_TEST_CASES},
+        "run_design_agent": {"diagrams": FAKE_DIAGRAMS},
+    }
+    with ExitStack() as stack:
+        mocks = {
+            name: stack.enter_context(patch.object(graph, name, AsyncMock(return_value=out)))
+            for name, out in outputs.items()
+        }
+        yield mocks
+
+
+@pytest_asyncio.fixture
+async def checkpointer():
+    await graph.open_checkpointer()
+    yield
+    await graph.close_checkpointer()
+
+
+@pytest_asyncio.fixture
+async def scheduler(checkpointer):
+    await run_scheduler.scheduler.start(graph.advance_run)
+    yield run_scheduler.scheduler
+    await run_scheduler.scheduler.stop()
+
+
+async def _wait_for_stage(run_id: str, stage: str, timeout: float = 5) -> dict:
+    async def poll():
+        while True:
+            run = await db_service.get_run(run_id)
+            if run["current_stage"] == stage:
+                return run
+            await asyncio.sleep(0.01)
+    return await asyncio.wait_for(poll(), timeout)
+
+
+@pytest.mark.asyncio
+async def test_gate_parks_run_without_a_coroutine(fake_agents, checkpointer):
+    run = await db_service.create_run("Brief")
+
+    # Returns as soon as the run reaches the first gate
+    await asyncio.wait_for(graph.run_pipeline(run["id"], "Brief"), timeout=5)
+
+    stored = await db_service.get_run(run["id"])
+    assert stored["status"] == "waiting_hitl"
+    assert stored["current_stage"] == "hitl_ba"
+    assert run["id"] not in graph._active_runs
+    gate = await db_service.get_pending_hitl(run["id"])
+    assert gate["stage"] == "ba"
+
+    await db_service.resolve_hitl(run["id"], "approved", None)
+    await asyncio.wait_for(graph.resume_pipeline(run["id"]), timeout=5)
+
+    stored = await db_service.get_run(run["id"])
+    assert stored["current_stage"] == "hitl_product"
+    fake_agents["run_product_agent"].assert_awaited_once()
+    # Resuming must not re-open the gate it came from
+    logs = await db_service.list_decision_logs(run["id"])
+    assert [log["details"]["stage"] for log in logs if log["action"] == "hitl_gate_created"] == ["ba", "product"]
+
+
+@pytest.mark.asyncio
+async def test_request_changes_reruns_agent_with_feedback(fake_agents, checkpointer):
+    run = await db_service.create_run("Brief")
+    await graph.run_pipeline(run["id"], "Brief")
+
+    await db_service.resolve_hitl(run["id"], "changes", "Más requisitos")
+    await graph.resume_pipeline(run["id"])
+
+    assert fake_agents["run_ba_agent"].await_count == 2
+    retry_state = fake_agents["run_ba_agent"].await_args.args[0]
+    assert retry_state["hitl_feedback"] == "Más requisitos"
+    assert (await db_service.get_pending_hitl(run["id"]))["stage"] == "ba"
+
+
+@pytest.mark.asyncio
+async def test_request_changes_rerun_uses_interactive_llm_lane(fake_agents, checkpointer):
+    lanes = []
+    fake_agents["run_ba_agent"].side_effect = lambda state: (
+        lanes.append(llm_limiter._priority.get()) or {"requirements": FAKE_REQUIREMENTS}
+    )
+    run = await db_service.create_run("Brief")
+    await graph.run_pipeline(run["id"], "Brief")
+    await db_service.resolve_hitl(run["id"], "changes", "Más requisitos")
+    await graph.resume_pipeline(run["id"])
+
+    assert lanes == [llm_limiter.PRIORITY_BATCH, llm_limiter.PRIORITY_INTERACTIVE]
+
+
+@pytest.mark.asyncio
+async def test_resume_after_restart(fake_agents, scheduler):
+    run = await db_service.create_run("Brief")
+    await graph.run_pipeline(run["id"], "Brief")
+
+    # Simulate a restart: the gate is approved while no process is running the run
+    await graph.close_checkpointer()
+    await db_service.resolve_hitl(run["id"], "approved", None)
+    await graph.open_checkpointer()
+
+    assert await graph.resume_interrupted_runs() >= 1
+    await _wait_for_stage(run["id"], "hitl_product")
+
+
+@pytest.mark.asyncio
+async def test_resume_starts_runs_that_never_ran(fake_agents, scheduler):
+    run = await db_service.create_run("Brief")
+
+    assert await graph.resume_interrupted_runs() >= 1
+    await _wait_for_stage(run["id"], "hitl_ba")
+
+
+@pytest.mark.asyncio
+async def test_in_process_wait_without_checkpointer(fake_agents):
+    run = await db_service.create_run("Brief")
+    task = asyncio.create_task(graph.run_pipeline(run["id"], "Brief"))
+
+    await _wait_for_stage(run["id"], "hitl_ba")
+    assert not task.done()  # no checkpoints: the coroutine waits on the gate
+    await db_service.resolve_hitl(run["id"], "rejected", None)
+
+    await asyncio.wait_for(task, timeout=5)
+    assert (await db_service.get_run(run["id"]))["status"] == "rejected"
+
+
+async def _approve_until(run_id: str, stage: str) -> None:
+    while (await db_service.get_pending_hitl(run_id))["stage"] != stage:
+        await db_service.resolve_hitl(run_id, "approved", None)
+        await graph.resume_pipeline(run_id)
+
+
+@pytest.mark.asyncio
+async def test_qa_and_design_run_as_parallel_branches(fake_agents, checkpointer):
+    running, overlapped = set(), []
+
+    def branch(name, output):
+        async def agent(state):
+            running.add(name)
+            await asyncio.sleep(0.1)
+            overlapped.append(running == {"qa", "design"})
+            running.discard(name)
+            return output
+        return agent
+
+    fake_agents["run_qa_agent"].side_effect = branch("qa", {"test_cases": FAKE_TEST_CASES})
+    fake_agents["run_design_agent"].side_effect = branch("design", {"diagrams": FAKE_DIAGRAMS})
+    run = await db_service.create_run("Brief")
+    await graph.run_pipeline(run["id"], "Brief")
+    await _approve_until(run["id"], "final")
+
+    assert overlapped[0]
+    design_state = fake_agents["run_design_agent"].await_args.args[0]
+    assert design_state["user_stories"] == FAKE_USER_STORIES and design_state["test_cases"] is None
+    logs = await db_service.list_decision_logs(run["id"])
+    parallel = [log["details"] for log in logs if log["action"] == "parallel_stages"]
+    assert parallel[0]["saved_s"] > 0.05 and parallel[0]["sequential_s"] > parallel[0]["wall_s"]
+    assert set(parallel[0]["stages"]) == {"qa", "design"}
+
+    # Changes at the final gate re-run both branches, which join again
+    await db_service.resolve_hitl(run["id"], "changes", "Más casos")
+    await graph.resume_pipeline(run["id"])
+    assert fake_agents["run_qa_agent"].await_count == fake_agents["run_design_agent"].await_count == 2
+    assert (await db_service.get_pending_hitl(run["id"]))["stage"] == "final"
+
+    await db_service.resolve_hitl(run["id"], "approved", None)
+    await graph.resume_pipeline(run["id"])
+    assert (await db_service.get_run(run["id"]))["status"] == "completed"
+    snapshot = await graph._pipeline.aget_state(graph._config(run["id"]))
+    assert set(snapshot.values["stage_timings"]) == {"ba", "product", "analyst", "qa", "design"}
+
+
+@pytest.mark.asyncio
+async def test_speculative_stage_commits_on_approval_and_discards_on_changes(fake_agents, checkpointer, monkeypatch):
+    monkeypatch.setattr(speculation.speculator, "enabled", True)
+    analyst_started, analyst_cancelled = asyncio.Event(), []
+
+    async def product(state):
+        await db_service.save_artifact(state["run_id"], "INC-001", "product_agent", "inception", FAKE_INCEPTION)
+        await db_service.log_decision(state["run_id"], "product_agent", "completed", {})
+        return {"inception": {"inceptions": [FAKE_INCEPTION]}}
+
+    async def analyst(state):
+        analyst_started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            analyst_cancelled.append(True)
+            raise
+
+    fake_agents["run_product_agent"].side_effect = product
+    fake_agents["run_analyst_agent"].side_effect = analyst
+    run = await db_service.create_run("Brief")
+    run_id = run["id"]
+    await graph.run_pipeline(run_id, "Brief")
+
+    # The product agent runs while hitl_ba is pending, but nothing reaches the run yet
+    await asyncio.wait_for(speculation.speculator._running[(run_id, "product")].task, timeout=5)
+    assert await db_service.list_artifacts(run_id) == []
+    assert await db_service.count_staged(run_id, "product") == 2
+
+    await db_service.resolve_hitl(run_id, "approved", None)
+    await graph.resume_pipeline(run_id)
+    assert fake_agents["run_product_agent"].await_count == 1  # not run again
+    assert [a["id"] for a in await db_service.list_artifacts(run_id)] == ["INC-001"]
+    assert await db_service.count_staged(run_id, "product") == 0
+    assert (await db_service.get_pending_hitl(run_id))["stage"] == "product"
+
+    # Changes at hitl_product cancel the analyst speculation
+    await asyncio.wait_for(analyst_started.wait(), timeout=5)
+    await db_service.resolve_hitl(run_id, "changes", "Otra fase")
+    await graph.resume_pipeline(run_id)
+    assert analyst_cancelled == [True]
+    assert (run_id, "analyst") in speculation.speculator._running  # restarted by the new gate
+    await speculation.speculator.discard(run_id, "analyst", "test")
+
+    stats = await db_service.get_speculation_stats(run_id)
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+    assert stats["hit_rate"] == pytest.approx(1 / 3, abs=1e-3)
+
+
+# ---------- run scheduler ----------
+
+@pytest.mark.asyncio
+async def test_scheduler_bounds_slots_and_orders_by_priority():
+    started, releases = [], {}
+
+    async def runner(run_id):
+        started.append(run_id)
+        releases[run_id] = asyncio.Event()
+        await releases[run_id].wait()
+
+    async def wait_started(n):
+        while len(started) < n:
+            await asyncio.sleep(0.01)
+
+    scheduler = run_scheduler.RunScheduler(slots=1, drain_timeout=5, poll_interval=0.05)
+    await scheduler.start(runner)
+    first = await db_service.create_run("First")
+    second = await db_service.create_run("Second")
+    urgent = await db_service.create_run("Urgent", priority=5)
+    await scheduler.enqueue(first["id"])
+    await asyncio.wait_for(wait_started(1), timeout=5)
+    await scheduler.enqueue(second["id"])
+    await scheduler.enqueue(urgent["id"])
+
+    stats = await scheduler.stats()
+    assert (stats["running"], stats["queued"]) == (1, 2)
+    assert (await db_service.get_run(urgent["id"]))["queue_position"] == 1
+
+    releases[first["id"]].set()
+    await asyncio.wait_for(wait_started(2), timeout=5)
+    releases[urgent["id"]].set()
+    await asyncio.wait_for(wait_started(3), timeout=5)
+    releases[second["id"]].set()
+    await scheduler.stop()
+
+    assert started == [first["id"], urgent["id"], second["id"]]
+    stats = await scheduler.stats()
+    assert (stats["completed"], stats["queued"]) == (3, 0)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_stop_drains_then_hands_back_cancelled_runs():
+    finished, stuck = [], asyncio.Event()
+
+    async def runner(run_id):
+        if run_id == slow["id"]:
+            await stuck.wait()
+        await asyncio.sleep(0.05)
+        finished.append(run_id)
+
+    quick = await db_service.create_run("Quick")
+    slow = await db_service.create_run("Slow")
+    scheduler = run_scheduler.RunScheduler(slots=2, drain_timeout=0.5, poll_interval=0.05)
+    await scheduler.start(runner)
+    await scheduler.enqueue(quick["id"])
+    await scheduler.enqueue(slow["id"])
+    await asyncio.sleep(0.01)
+
+    await scheduler.stop()
+    assert finished == [quick["id"]]  # drained; the stuck run was cancelled and handed back
+    assert await db_service.count_queued_runs() == {"queued": 1, "running": 0}
+
+    stuck.set()
+    await scheduler.start(runner)  # the cancelled run gets a slot again
+    for _ in range(500):
+        if len(finished) == 2:
+            break
+        await asyncio.sleep(0.01)
+    await scheduler.stop()
+    assert finished == [quick["id"], slow["id"]]
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 0}
+
+
+@pytest.mark.asyncio
+async def test_scheduled_run_resumes_after_gate_resolution(fake_agents, scheduler):
+    run = await db_service.create_run("Brief")
+    await scheduler.enqueue(run["id"])
+    await _wait_for_stage(run["id"], "hitl_ba")
+
+    await db_service.resolve_hitl(run["id"], "approved", None)
+    await scheduler.enqueue(run["id"])
+    await _wait_for_stage(run["id"], "hitl_product")
+    fake_agents["run_product_agent"].assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_worker_schedulers_share_the_queue_and_reclaim_stuck_runs():
+    started, release = [], asyncio.Event()
+
+    async def runner(run_id):
+        started.append(run_id)
+        await release.wait()
+
+    # Two workers against the same store; worker A hangs without renewing its lease
+    worker_a = run_scheduler.RunScheduler(slots=1, lease=0.2, heartbeat_interval=60, poll_interval=0.05,
+                                          worker_id="worker-a")
+    worker_b = run_scheduler.RunScheduler(slots=1, lease=60, poll_interval=0.05, worker_id="worker-b")
+    run = await db_service.create_run("Brief")
+    await worker_a.start(runner)
+    await worker_a.enqueue(run["id"])
+    for _ in range(100):
+        if started:
+            break
+        await asyncio.sleep(0.01)
+    assert started == [run["id"]]
+
+    await worker_b.start(runner)
+    for _ in range(200):
+        if len(started) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert started == [run["id"], run["id"]]  # reclaimed once the lease expired
+    assert (await worker_b.stats())["reclaimed"] == 1
+
+    await worker_a.renew()  # its next heartbeat finds the lease gone and cancels its copy
+    assert (await worker_a.stats())["leases_lost"] == 1
+    assert worker_a._running == {}
+    release.set()
+    await worker_b.stop()
+    await worker_a.stop()
+    assert await db_service.count_queued_runs() == {"queued": 0, "running": 0}
+
+
+@pytest.mark.asyncio
+async def test_worker_process_executes_runs_enqueued_by_the_api(fake_agents, monkeypatch):
+    from workers.__main__ import run_worker
+
+    monkeypatch.setattr(run_scheduler.scheduler, "poll_interval", 0.05)
+    run = await db_service.create_run("Brief")
+    await db_service.enqueue_run(run["id"])  # what the API does with RUN_EXECUTION=workers
+
+    stop = asyncio.Event()
+    worker = asyncio.create_task(run_worker(stop))
+    await _wait_for_stage(run["id"], "hitl_ba")
+    stop.set()
+    await asyncio.wait_for(worker, timeout=5)
+    fake_agents["run_ba_agent"].assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_cancel_stops_running_run_and_frees_its_slot(fake_agents, checkpointer, monkeypatch):
+    from api import routes_runs
+
+    in_flight, aborted = asyncio.Event(), []
+
+    async def slow_ba(state):
+        if state["brief"] == "Next":
+            return {"requirements": FAKE_REQUIREMENTS}
+        in_flight.set()
+        try:
+            await asyncio.sleep(10)  # an LLM call in flight
+        except asyncio.CancelledError:
+            aborted.append(state["run_id"])
+            raise
+
+    fake_agents["run_ba_agent"].side_effect = slow_ba
+    scheduler = run_scheduler.RunScheduler(slots=1, poll_interval=0.05)
+    monkeypatch.setattr(routes_runs, "scheduler", scheduler)
+    await scheduler.start(graph.advance_run)
+    run = await db_service.create_run("Brief")
+    waiting = await db_service.create_run("Next")
+    await scheduler.enqueue(run["id"])
+    await asyncio.wait_for(in_flight.wait(), timeout=5)
+    await scheduler.enqueue(waiting["id"])
+    assert (await db_service.get_run(waiting["id"]))["queue_position"] == 1
+
+    cancelled = await routes_runs.cancel_run(run["id"])
+    assert cancelled["status"] == "cancelled"
+    assert aborted == [run["id"]]
+    assert run["id"] not in scheduler._running
+    await _wait_for_stage(waiting["id"], "hitl_ba")  # the freed slot went to the queued run
+    await scheduler.stop()
+    assert (await scheduler.stats())["cancelled"] == 1
+    assert (await db_service.get_run(run["id"]))["status"] == "cancelled"
+
+
+@pytest.mark.asyncio
+async def test_cancel_ends_run_waiting_in_process(fake_agents):
+    run = await db_service.create_run("Brief")
+    task = asyncio.create_task(graph.run_pipeline(run["id"], "Brief"))
+    await _wait_for_stage(run["id"], "hitl_ba")
+
+    await db_service.cancel_run(run["id"])
+    await asyncio.wait_for(task, timeout=5)
+    fake_agents["run_product_agent"].assert_not_awaited()
+    assert (await db_service.get_run(run["id"]))["status"] == "cancelled"
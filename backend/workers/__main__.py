@@ -0,0 +1,65 @@
+"""Pipeline worker process.
+
+Executes queued pipeline runs outside the API process, so long stages do not
+share the API's event loop. Start the API with ``RUN_EXECUTION=workers`` and
+any number of workers, on this machine or on others that share the database
+file (see ``services.run_scheduler`` for leases and heartbeats). SIGINT or
+SIGTERM drains the worker's slots and hands unfinished runs back to the queue.
+
+Usage (from ``backend/``)::
+
+    python -m workers
+    python -m workers --slots 2 --db /shared/sdlc_pipeline.db
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+
+import database
+from agents.graph import advance_run, close_checkpointer, open_checkpointer, resume_interrupted_runs
+from services.run_scheduler import scheduler
+from services.speculation import speculator
+
+logger = logging.getLogger("workers")
+
+
+async def run_worker(stop: asyncio.Event) -> None:
+    """Execute queued runs until ``stop`` is set."""
+    await database.init_db()
+    await database.open_pool()
+    await database.start_writer()
+    await open_checkpointer()
+    try:
+        await scheduler.start(advance_run)
+        await resume_interrupted_runs()
+        logger.info("Worker %s started with %d slots", scheduler.worker_id, scheduler.slots)
+        await stop.wait()
+    finally:
+        await scheduler.stop()
+        await speculator.shutdown()
+        await close_checkpointer()
+        await database.stop_writer()
+        await database.close_pool()
+    logger.info("Worker %s stopped", scheduler.worker_id)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m workers", description=__doc__.splitlines()[0])
+    parser.add_argument("--slots", type=int, default=scheduler.slots, help="runs executed at once (RUN_WORKERS)")
+    parser.add_argument("--db", default=database.DB_PATH, help="SQLite file shared with the API")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    database.DB_PATH = args.db
+    scheduler.slots = args.slots
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await run_worker(stop)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
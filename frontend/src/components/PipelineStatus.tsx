@@ -26,7 +26,10 @@ export default function PipelineStatus({ run }: Props) {
     <div style={{ marginTop: 12 }}>
       <div className="row" style={{ justifyContent: "space-between", marginBottom: 8 }}>
         <h2 style={{ margin: 0 }}>Pipeline Status</h2>
-        <span className="badge">{run.status}</span>
+        <span className="badge">
+          {run.status}
+          {run.queue_position ? ` #${run.queue_position}` : ""}
+        </span>
       </div>
 
       <div style={{ display: "flex", gap: 6, flexWrap: "wrap" }}>
@@ -1,9 +1,11 @@
 import { useEffect, useState, useCallback } from "react";
 import { useParams } from "react-router-dom";
 import {
+  cancelRun,
   getRun,
   getArtifacts,
   getDecisionLogs,
+  subscribeRunEvents,
   type Run,
   type Artifact,
   type DecisionLogEntry,
@@ -41,16 +43,40 @@ export default function RunDetail() {
 
   useEffect(() => {
     refresh();
-    const interval = setInterval(refresh, 3000);
-    return () => clearInterval(interval);
-  }, [refresh]);
+    if (!runId) return;
+    // Refresh when the backend pushes a change; the slow interval is only a safety net
+    const unsubscribe = subscribeRunEvents(runId, () => refresh());
+    const interval = setInterval(refresh, 30000);
+    return () => {
+      unsubscribe();
+      clearInterval(interval);
+    };
+  }, [refresh, runId]);
 
   if (!run) return <p>Loading...</p>;
 
+  const finished = ["completed", "rejected", "error", "cancelled"].includes(run.status);
+
+  const handleCancel = async () => {
+    try {
+      await cancelRun(run.id);
+    } catch (err) {
+      console.error(err);
+    }
+    refresh();
+  };
+
   return (
     <div>
       <div className="card">
-        <h1 style={{ marginTop: 0 }}>Run {run.id}</h1>
+        <div className="row" style={{ justifyContent: "space-between" }}>
+          <h1 style={{ marginTop: 0 }}>Run {run.id}</h1>
+          {!finished && (
+            <button className="btn-bad" onClick={handleCancel}>
+              Cancel run
+            </button>
+          )}
+        </div>
 
         <PipelineStatus run={run} />
 
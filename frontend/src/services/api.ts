@@ -11,6 +11,16 @@ export interface Run {
   current_stage: string;
   created_at: string;
   updated_at: string;
+  brief_truncated?: boolean;
+  priority?: number;
+  queue_position?: number | null; // 1 = next to start while the run is queued
+}
+
+export interface ListRunsParams {
+  limit?: number;
+  after?: string; // id of the last run of the previous page
+  status?: string;
+  stage?: string;
 }
 
 export interface Artifact {
@@ -49,8 +59,8 @@ export async function createRun(brief: string): Promise<Run> {
   return data;
 }
 
-export async function listRuns(): Promise<Run[]> {
-  const { data } = await api.get<Run[]>("/runs");
+export async function listRuns(params: ListRunsParams = {}): Promise<Run[]> {
+  const { data } = await api.get<Run[]>("/runs", { params });
   return data;
 }
 
@@ -59,6 +69,11 @@ export async function getRun(runId: string): Promise<Run> {
   return data;
 }
 
+export async function cancelRun(runId: string): Promise<Run> {
+  const { data } = await api.post<Run>(`/runs/${runId}/cancel`);
+  return data;
+}
+
 export async function getRunStatus(runId: string) {
   const { data } = await api.get<{ id: string; status: string; current_stage: string }>(`/runs/${runId}/status`);
   return data;
@@ -103,3 +118,24 @@ export async function getDiagram(runId: string, type: "er" | "sequence") {
   const { data } = await api.get(`/runs/${runId}/diagrams/${type}`);
   return data;
 }
+
+// --- Server-Sent Events ---
+
+export type RunEventType = "stage" | "log" | "hitl_gate" | "artifact";
+
+/**
+ * Subscribe to live run events. The browser reconnects automatically and
+ * resumes from the last received event via the Last-Event-ID header.
+ * Returns a function that closes the stream.
+ */
+export function subscribeRunEvents(
+  runId: string,
+  onEvent: (type: RunEventType, data: unknown) => void,
+): () => void {
+  const source = new EventSource(`/api/runs/${runId}/events`);
+  const types: RunEventType[] = ["stage", "log", "hitl_gate", "artifact"];
+  for (const type of types) {
+    source.addEventListener(type, (e) => onEvent(type, JSON.parse((e as MessageEvent).data)));
+  }
+  return () => source.close();
+}